@@ -0,0 +1,19 @@
+"""
+Standalone benchmark scripts, run with `python -m benchmarks.<script>`. The grbot modules parse the command line
+when imported, for --config only (see configurator.py): the other arguments are set apart here, before any grbot
+import, and parsed by the script (see parse_args).
+"""
+from grbot.utils import split_config_arguments
+
+import sys
+
+config_arguments, script_arguments = split_config_arguments(sys.argv[1:])
+sys.argv = sys.argv[:1] + config_arguments
+
+
+def parse_args(parser):
+    """
+    :return: the arguments of the script parsed by parser, --config being accepted
+    """
+    parser.add_argument('--config', help="Path to configuration JSON file, for the benchmarks of the Matcher")
+    return parser.parse_args(script_arguments + config_arguments)
@@ -0,0 +1,84 @@
+"""
+Per-post enrichment latency: DataFrame re-indexing vs BookInfoIndex. Then the id -> row lookup of BookInfoIndex
+alone: dict vs the binary search of IdIndex, latency per lookup and memory per id.
+
+    python -m benchmarks.bench_book_info --rows 1000000
+"""
+from grbot.catalog import BookInfoIndex, IdIndex
+from tests.synthetic import make_dim_books
+from benchmarks import parse_args
+
+import argparse
+import gc
+import time
+import tracemalloc
+import numpy as np
+
+# A post with 5 queries, each enriching the top-4 book and top-4 series candidates
+LOOKUPS_PER_POST = 5 * (4 + 4)
+
+
+def time_posts(lookup, ids, n_posts):
+    timings = []
+    for post in range(n_posts):
+        start = time.perf_counter()
+        for book_id in ids[post * LOOKUPS_PER_POST:(post + 1) * LOOKUPS_PER_POST]:
+            lookup(book_id)
+        timings.append(time.perf_counter() - start)
+    return np.array(timings)
+
+
+def report(name, timings):
+    print(f"{name:<28} p50={np.percentile(timings, 50)*1000:10.3f} ms   "
+          f"p95={np.percentile(timings, 95)*1000:10.3f} ms   ({len(timings)} posts)")
+
+
+def traced_size(build):
+    """
+    :return: (object built, bytes allocated by build)
+    """
+    gc.collect()
+    tracemalloc.start()
+    built = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return built, size
+
+
+def compare_id_lookups(book_ids, ids):
+    rows = {}
+    for name, build in [('dict', lambda: {book_id: row for row, book_id in enumerate(book_ids.tolist())}),
+                        ('IdIndex', lambda: IdIndex(book_ids))]:
+        index, size = traced_size(build)
+        lookups = ids.tolist()
+        start = time.perf_counter()
+        rows[name] = [index.get(book_id) for book_id in lookups]
+        seconds = time.perf_counter() - start
+        print(f"id -> row {name:<18} {seconds / len(lookups) * 1e6:8.3f} us per lookup   "
+              f"{size / len(book_ids):6.1f} bytes per id   ({size / 2**20:.1f} MiB)")
+    assert rows['dict'] == rows['IdIndex']
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--posts', type=int, default=200)
+    parser.add_argument('--old-posts', type=int, default=3, help="Posts timed with the old lookup (slow)")
+    args = parse_args(parser)
+
+    book_db = make_dim_books(args.rows)
+    ids = np.random.default_rng(1).choice(book_db['book_id'].to_numpy(), size=args.posts * LOOKUPS_PER_POST)
+
+    start = time.perf_counter()
+    book_info = BookInfoIndex(book_db, key='book_id')
+    print(f"BookInfoIndex built in {time.perf_counter() - start:.2f} s on {args.rows} rows")
+
+    report("set_index().loc[].to_dict()",
+           time_posts(lambda i: book_db.set_index('book_id').loc[i].to_dict(), ids, args.old_posts))
+    report("BookInfoIndex[]", time_posts(lambda i: book_info[i], ids, args.posts))
+    report("BookInfoIndex[].to_dict()", time_posts(lambda i: book_info[i].to_dict(), ids, args.posts))
+    compare_id_lookups(book_db['book_id'].to_numpy(), ids)
+
+
+if __name__ == "__main__":
+    main()
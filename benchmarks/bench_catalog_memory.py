@@ -0,0 +1,74 @@
+"""
+Memory footprint of the Matcher catalog: DataFrames + one Book object per row (legacy) vs columnar storage.
+
+    python -m benchmarks.bench_catalog_memory --config config.json --rows 1000000
+"""
+from grbot.catalog import BookInfoIndex, IdMap
+from grbot.matching import BookList, clean_title, clean_author
+from grbot.utils import extract_last_name
+from tests.synthetic import make_dim_books, make_dim_series
+from benchmarks import parse_args
+
+import argparse
+import gc
+import tracemalloc
+
+
+class LegacyBook:
+    """Book as stored before the columnar catalog: one object and one info dict per row"""
+
+    def __init__(self, book_id, title, author, is_series=False):
+        self.id = book_id
+        self.title = title
+        self.clean_title = clean_title(title)
+        self.lateralized_title = ""
+        self.short_title = ""
+        self.author = author
+        self.clean_author = clean_author(author)
+        self.clean_author_last_name = extract_last_name(self.clean_author)
+        self.is_series = is_series
+        self.info = {}
+
+
+def build_legacy(book_db, series_db):
+    books = [LegacyBook(*row) for row in zip(book_db['book_id'], book_db['book_title'], book_db['author'])]
+    series = [LegacyBook(*row, is_series=True)
+              for row in zip(series_db['series_id'], series_db['series_title'], series_db['author'])]
+    first_books = book_db.dropna(subset=['series_id']).groupby('series_id').head(1)
+    return book_db, series_db, books, series, first_books.set_index('series_id')['book_id'].to_dict()
+
+
+def build_columnar(book_db, series_db):
+    book_info = BookInfoIndex(book_db, key='book_id')
+    books = BookList(book_info.ids, book_info.columns['book_title'], book_info.columns['author'])
+    series = BookList(series_db['series_id'], series_db['series_title'], series_db['author'], is_series=True)
+    first_books = book_db.dropna(subset=['series_id']).groupby('series_id').head(1)
+    return book_info, books, series, IdMap(first_books['series_id'], first_books['book_id'])
+
+
+def measure(build, rows):
+    gc.collect()
+    tracemalloc.start()
+    book_db = make_dim_books(rows)
+    catalog = build(book_db, make_dim_series(book_db))
+    del book_db
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del catalog
+    return current, peak
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=1000000)
+    args = parse_args(parser)
+
+    print(f"Catalog of {args.rows} books")
+    for name, build in [('legacy (DataFrames + Book objects)', build_legacy), ('columnar', build_columnar)]:
+        current, peak = measure(build, args.rows)
+        print(f"{name:<36} resident: {current / 2**20:8.1f} MiB   peak while building: {peak / 2**20:8.1f} MiB")
+
+
+if __name__ == "__main__":
+    main()
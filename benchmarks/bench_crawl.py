@@ -0,0 +1,39 @@
+"""
+Crawl wall time vs number of subreddits, listings fetched one after the other vs concurrently,
+against the local fake Reddit (see tests/fake_reddit.py) with a simulated network latency.
+
+    python -m benchmarks.bench_crawl --subreddits 1 4 16 --latency 0.05
+"""
+from tests.fake_reddit import FakeReddit, fake_config
+from grbot.crawler import crawl
+from benchmarks import parse_args
+
+import argparse
+import asyncio
+import time
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--subreddits', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--posts', type=int, default=250, help="New posts per listing since the last crawl")
+    parser.add_argument('--latency', type=float, default=0.05)
+    args = parse_args(parser)
+
+    for n in args.subreddits:
+        subreddits = [f"sub{i}" for i in range(n)]
+        fake = FakeReddit(subreddits, posts_per_listing=args.posts + 50, latency=args.latency, start_utc=10**9)
+        config = fake_config(fake.start(), subreddits)
+        last_timestamps = {sub: 10**9 - args.posts for sub in subreddits}
+        timings = {}
+        for concurrent in [False, True]:
+            start = time.perf_counter()
+            comments, submissions = asyncio.run(crawl(config, last_timestamps, limit=1000, concurrent=concurrent))
+            timings[concurrent] = time.perf_counter() - start
+        fake.stop()
+        print(f"{n:3d} subreddits, {len(comments) + len(submissions):6d} posts   "
+              f"sequential {timings[False]:6.2f} s   concurrent {timings[True]:6.2f} s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,56 @@
+"""
+Recommendation quality, latency and memory of quantized embeddings vs float32: recall@k of the top-k neighbours.
+
+    python -m benchmarks.bench_embeddings_recall --rows 200000 --dim 100
+    python -m benchmarks.bench_embeddings_recall --w2v path/to/w2v.pkl
+"""
+from grbot.reco import Embeddings, QUANTIZATIONS
+from grbot.utils import load_pickle
+from tests.synthetic import make_embeddings
+from benchmarks import parse_args
+
+import argparse
+import time
+import numpy as np
+
+
+def recall_at_k(neighbours, exact_neighbours):
+    return np.mean([
+        len(np.intersect1d(found, exact)) / len(exact) for found, exact in zip(neighbours, exact_neighbours)
+    ])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--dim', type=int, default=100)
+    parser.add_argument('--w2v', default=None, help="Pickled KeyedVectors to use instead of synthetic embeddings")
+    parser.add_argument('--queries', type=int, default=1000)
+    parser.add_argument('--k', type=int, nargs='+', default=[5, 10])
+    args = parse_args(parser)
+
+    embeddings = Embeddings.from_keyed_vectors(load_pickle(args.w2v)) if args.w2v \
+        else make_embeddings(args.rows, args.dim)
+    rows = np.random.default_rng(1).choice(len(embeddings), size=min(args.queries, len(embeddings)), replace=False)
+    k_max = max(args.k)
+    print(f"{len(embeddings)} embeddings of dim {embeddings.vectors.shape[1]}, {len(rows)} queries")
+
+    start = time.perf_counter()
+    exact_neighbours, _ = embeddings.search(rows, k_max)
+    float32_time = time.perf_counter() - start
+    print(f"{'float32':<8} {embeddings.vectors.nbytes / 2**20:8.1f} MiB   "
+          f"{float32_time / len(rows) * 1000:7.3f} ms/query")
+
+    for quantization in QUANTIZATIONS:
+        quantized = embeddings.quantized(quantization)
+        start = time.perf_counter()
+        neighbours, _ = quantized.search(rows, k_max)
+        elapsed = time.perf_counter() - start
+        size = quantized.vectors.nbytes + (0 if quantized.scales is None else quantized.scales.nbytes)
+        recalls = '   '.join(
+            f"recall@{k}={recall_at_k(neighbours[:, :k], exact_neighbours[:, :k]):.4f}" for k in args.k)
+        print(f"{quantization:<8} {size / 2**20:8.1f} MiB   {elapsed / len(rows) * 1000:7.3f} ms/query   {recalls}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Matching and recommendation latency of a Matcher built on a synthetic catalog: p50 / p95 / p99 latency, throughput
+and peak RSS of each code path, for realistic query mixes (exact, misspelled, "title by author", title prefix and
+series). Each code path runs in a process forked from the one holding the catalog, so that its peak RSS is its own.
+
+    python -m benchmarks.bench_matcher --config config_template.json --rows 10000 100000 1000000
+    python -m benchmarks.bench_matcher --config config_template.json --rows 2000000 --ngram-candidates 5000 --queries 100
+"""
+from grbot.configurator import config
+from grbot.matching import Matcher, Query
+from tests.synthetic import make_dim_books, make_dim_series, make_embeddings, make_queries, SyntheticStorage
+from benchmarks import parse_args
+
+import argparse
+import copy
+import multiprocessing
+import os
+import pickle
+import resource
+import sys
+import tempfile
+import time
+import numpy as np
+
+QUERY_KINDS = ['exact', 'misspelled', 'by_author', 'prefix', 'series']
+
+
+def peak_rss():
+    """
+    :return: peak resident set size of the process, in bytes
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def time_calls(function, args_list, warmup=2):
+    for args in args_list[:warmup]:
+        function(*args)
+    timings = []
+    for args in args_list:
+        start = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - start)
+    return {'timings': np.array(timings), 'peak_rss': peak_rss()}
+
+
+def run_isolated(function, *args):
+    """
+    Runs function(*args) in a forked process (which shares the catalog pages of this one), in this process when
+    fork is not available
+    """
+    if not hasattr(os, 'fork'):
+        return function(*args)
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+
+    def target():
+        try:
+            sender.send(function(*args))
+        except Exception as e:
+            sender.send(e)
+        sender.close()
+
+    process = context.Process(target=target)
+    process.start()
+    result = receiver.recv()
+    process.join()
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+
+def bench_config(args, w2v_path):
+    config['matching'].setdefault('draw_settle_key', 'sort_n')  # Read from the global config by process_posts
+    bench = copy.deepcopy(config)
+    bench['matching'].update({
+        'ngram_candidates': args.ngram_candidates, 'cache_size': args.cache_size, 'snapshot_path': None})
+    bench['reco'].update({
+        'w2v_path': w2v_path, 'precomputed_neighbours': args.precomputed_neighbours, 'quantization': args.quantization})
+    bench.setdefault('bq', {}).update({'local_path_dim_books': None, 'local_path_dim_series': None})
+    return bench
+
+
+def code_paths(matcher, queries, post_size, k):
+    """
+    :return: [(name, function, [args of each call])]
+    """
+    paths = [(f"process_one_query[{kind}]", matcher.process_one_query, [(query,) for query in queries[kind]])
+             for kind in QUERY_KINDS]
+    mixed = [query for group in zip(*queries.values()) for query in group]
+    posts = [mixed[start:start + post_size] for start in range(0, len(mixed), post_size)]
+    paths.append((f"process_posts[{post_size} queries]", lambda post: matcher.process_posts([post]),
+                  [(post,) for post in posts]))
+    titles = [Query(query).clean_q for query in queries['exact'] + queries['misspelled']]
+    paths.append(("match_process[books]", lambda title: matcher.match_process(title, search_series=False),
+                  [(title,) for title in titles]))
+    matches = [matcher.process_one_query(query) for query in queries['exact']]
+    paths.append((f"recommend_books[k={k}]", lambda match: matcher.recommend_books([match], k),
+                  [(match,) for match in matches if match.is_valid()]))
+    return paths
+
+
+def report(name, result):
+    timings = result['timings'] * 1000
+    p50, p95, p99 = np.percentile(timings, [50, 95, 99]) if len(timings) else (np.nan,) * 3
+    throughput = len(timings) / (timings.sum() / 1000) if timings.sum() else np.nan
+    print(f"  {name:<34} p50={p50:9.3f} ms  p95={p95:9.3f} ms  p99={p99:9.3f} ms  "
+          f"{throughput:9.1f} calls/s  peak RSS {result['peak_rss'] / 2**20:8.1f} MiB  ({len(timings)} calls)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000],
+                        help="Catalog sizes (books) to benchmark, from 10k to 2M")
+    parser.add_argument('--dim', type=int, default=64, help="Dimension of the synthetic embeddings")
+    parser.add_argument('--queries', type=int, default=200, help="Queries of each kind")
+    parser.add_argument('--post-size', type=int, default=5, help="Queries per post for process_posts")
+    parser.add_argument('--k', type=int, default=5, help="Recommendations per match")
+    parser.add_argument('--ngram-candidates', type=int, default=config['matching'].get('ngram_candidates', 0))
+    parser.add_argument('--precomputed-neighbours', type=int, default=0)
+    parser.add_argument('--quantization', default=None)
+    parser.add_argument('--cache-size', type=int, default=0, help="Match cache size, 0 to time every query")
+    args = parse_args(parser)
+
+    for rows in args.rows:
+        book_db = make_dim_books(rows)
+        series_db = make_dim_series(book_db)
+        queries = make_queries(book_db, series_db, args.queries)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            w2v_path = os.path.join(tmp_dir, 'w2v.pkl')
+            with open(w2v_path, 'wb') as handle:
+                pickle.dump(make_embeddings(rows, args.dim), handle)
+            start = time.perf_counter()
+            matcher = Matcher(config=bench_config(args, w2v_path), use_snapshot=False,
+                              storage=SyntheticStorage(book_db, series_db))
+            build_time = time.perf_counter() - start
+        del book_db
+        print(f"Catalog of {rows} books, {len(series_db)} series: Matcher built in {build_time:.2f} s, "
+              f"peak RSS {peak_rss() / 2**20:.1f} MiB")
+        for name, function, args_list in code_paths(matcher, queries, args.post_size, args.k):
+            report(name, run_isolated(time_calls, function, args_list))
+
+
+if __name__ == "__main__":
+    main()
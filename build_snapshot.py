@@ -0,0 +1,190 @@
+"""
+Offline build of the Matcher catalog: the memory-mapped snapshot (see grbot/snapshot.py) opened by Matcher when
+matching.snapshot_path is set. All the preprocessing happens here, once per build: cleaning of the dim tables,
+popularity order, title and author normalization, series -> first book map, author and trigram indexes, embeddings
+and precomputed recommendations. The bot then only maps the arrays.
+The dim tables are validated before the build, the written arrays are checksummed and verified after.
+    python build_snapshot.py --config config.json [--from-bq | --books FILE --series FILE] [--output DIR]
+    python build_snapshot.py --config config.json --verify [--output DIR]
+"""
+from grbot.utils import split_config_arguments
+
+import sys
+
+# configurator.py parses the command line when imported, for --config only: the build arguments are set apart
+# before, and parsed by main
+config_arguments, build_arguments = split_config_arguments(sys.argv[1:])
+sys.argv = sys.argv[:1] + config_arguments
+
+from grbot.configurator import config, setup_logging
+from grbot.matching import Matcher
+from grbot.storage import clean_dim_table, from_config as open_storage
+from grbot import snapshot
+
+import argparse
+import logging
+import os
+import pickle
+import numpy as np
+import pandas as pd
+
+BOOKS_COLUMNS = ['book_id', 'book_title', 'author', 'series_id', 'book_number']
+SERIES_COLUMNS = ['series_id', 'series_title', 'author']
+
+
+class DimTables:
+    """
+    Storage serving the dim tables read by the build to the Matcher (see storage.py)
+    """
+
+    def __init__(self, book_db, series_db):
+        self.book_db = book_db
+        self.series_db = series_db
+
+    def download_book_db(self, local_path=None):
+        return self.book_db
+
+    def download_series_db(self, local_path=None):
+        return self.series_db
+
+
+def read_table(path):
+    """
+    Dim table from a parquet file or a pickled DataFrame, cleaned like the ones downloaded (see clean_dim_table)
+    """
+    if path.endswith('.parquet'):
+        df = pd.read_parquet(path)
+    else:
+        with open(path, 'rb') as handle:
+            df = pickle.load(handle)
+    return clean_dim_table(df)
+
+
+def popularity_order(df, column):
+    """
+    Most popular first: the matching searches the lists by popularity tier (see matching.popularity_tiers)
+    """
+    if column not in df.columns:
+        logging.info(f"No {column} column, table order kept")
+        return df
+    return df.sort_values(column, ascending=False, kind='stable', na_position='last').reset_index(drop=True)
+
+
+def validate_tables(book_db, series_db):
+    """
+    :return: problems preventing the build
+    """
+    problems = []
+    for name, df, key, columns in [('dim_books', book_db, 'book_id', BOOKS_COLUMNS),
+                                   ('dim_series', series_db, 'series_id', SERIES_COLUMNS)]:
+        missing = [column for column in columns if column not in df.columns]
+        if missing:
+            problems.append(f"{name} misses the columns {missing}")
+            continue
+        if df[key].isna().any():
+            problems.append(f"{name} has {df[key].isna().sum()} rows without {key}")
+        if df[key].duplicated().any():
+            problems.append(f"{name} has {df[key].duplicated().sum()} duplicated {key}")
+        title = 'book_title' if key == 'book_id' else 'series_title'
+        for column in [title, 'author']:
+            if df[column].isna().any():
+                problems.append(f"{name} has {df[column].isna().sum()} rows without {column}")
+    if not problems:
+        orphans = set(book_db['series_id'].dropna()) - set(series_db['series_id'])
+        if orphans:  # Their books are still matched, the series are not
+            logging.warning(f"{len(orphans)} series of dim_books are missing from dim_series")
+    return problems
+
+
+def validate_catalog(matcher):
+    """
+    :return: inconsistencies of the catalog built
+    """
+    problems = []
+    catalog = matcher.catalog
+    if len(catalog.books_titles) != len(catalog.book_info):
+        problems.append(f"{len(catalog.books_titles)} book titles for {len(catalog.book_info)} book infos")
+    for name, titles, ngrams in [('books', catalog.books_titles, catalog.books_ngrams),
+                                 ('series', catalog.series_titles, catalog.series_ngrams)]:
+        if len(titles.lengths) != len(titles) or len(titles.clean_titles) != len(titles):
+            problems.append(f"Normalized {name} titles do not match the {name} list")
+        if ngrams is not None and len(ngrams) != len(titles):
+            problems.append(f"Trigram index of {len(ngrams)} {name} for {len(titles)} {name}")
+    missing_first_books = ~np.isin(catalog.series_id_to_book_id.values_array, catalog.book_info.ids)
+    if missing_first_books.any():
+        problems.append(f"{missing_first_books.sum()} series map to a book missing from dim_books")
+    embeddings = matcher.embeddings(catalog)
+    with_vector = sum(book_id in embeddings.key_to_index for book_id in catalog.book_info.ids[:10000].tolist())
+    logging.info(f"{with_vector / max(1, min(10000, len(catalog.book_info))):.1%} of the most popular books "
+                 f"have an embedding")
+    return problems
+
+
+def fail(problems):
+    for problem in problems:
+        logging.error(problem)
+    sys.exit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--output', default=config['matching'].get('snapshot_path'),
+                        help="Snapshot directory (defaults to matching.snapshot_path)")
+    parser.add_argument('--from-bq', action='store_true',
+                        help="Download dim_books and dim_series from BigQuery instead of the local files")
+    parser.add_argument('--books', default=config['bq'].get('local_path_dim_books'),
+                        help="dim_books as a .parquet or pickle file (defaults to bq.local_path_dim_books)")
+    parser.add_argument('--series', default=config['bq'].get('local_path_dim_series'),
+                        help="dim_series as a .parquet or pickle file (defaults to bq.local_path_dim_series)")
+    parser.add_argument('--sort-by', default='sort_n', help="Popularity column, most popular rows first")
+    parser.add_argument('--verify', action='store_true', help="Only check the checksums of an existing snapshot")
+    parser.add_argument('--config', help="Path to configuration JSON file")
+    args = parser.parse_args(build_arguments + config_arguments)
+    if args.output is None:
+        parser.error("No --output directory nor matching.snapshot_path in config")
+
+    setup_logging()
+    if args.verify:
+        if not os.path.isfile(os.path.join(args.output, snapshot.MANIFEST)):
+            fail([f"No snapshot in {args.output}"])
+        corrupted = snapshot.verify(args.output)
+        if corrupted:
+            fail([f"Snapshot {args.output}: {name} is missing or corrupted" for name in corrupted])
+        logging.info(f"Snapshot {args.output} is intact")
+        return
+
+    if args.from_bq:
+        config['bq']['local_path_dim_books'] = None
+        config['bq']['local_path_dim_series'] = None
+        storage = open_storage(config)
+        book_db, series_db = storage.download_book_db(), storage.download_series_db()
+        source = 'bq'
+    else:
+        if args.books is None or args.series is None:
+            parser.error("No --books / --series files nor bq.local_path_dim_* in config, use --from-bq")
+        book_db, series_db = read_table(args.books), read_table(args.series)
+        source = f"{args.books}, {args.series}"
+
+    problems = validate_tables(book_db, series_db)
+    if problems:
+        fail(problems)
+    book_db = popularity_order(book_db, args.sort_by)
+    series_db = popularity_order(series_db, args.sort_by)
+
+    logging.info(f"Building matcher from {len(book_db)} books and {len(series_db)} series")
+    matcher = Matcher(config, use_snapshot=False, storage=DimTables(book_db, series_db))
+    problems = validate_catalog(matcher)
+    if problems:
+        fail(problems)
+    matcher.save_snapshot(args.output, meta={
+        'source': source, 'popularity_column': args.sort_by, 'books': len(matcher.catalog.book_info),
+        'series': len(matcher.catalog.series_titles)})
+
+    corrupted = snapshot.verify(args.output)
+    if corrupted:
+        fail([f"{name} does not match its checksum once written" for name in corrupted])
+    logging.info(f"Catalog version {matcher.catalog.catalog_version} built in {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,153 @@
+"""
+Write-behind acknowledgements of the processed posts: their reply logs, error logs and removal from the queue are
+buffered and written in one batch (one append per log table, one DELETE from the queue) instead of one by one.
+Every acknowledgement is first appended to a local journal, so that those not written yet survive a crash.
+"""
+from grbot import metrics
+
+import json
+import logging
+import os
+import threading
+import time
+
+
+def to_json(value):
+    if hasattr(value, 'item'):  # numpy scalars
+        return value.item()
+    return str(value)
+
+
+class AckBuffer:
+    """
+    Usage: add_reply_logs / add_error_log / add_removed for each processed post, flush at the end of each cycle.
+    The buffer is also flushed when it holds `max_posts` posts or its oldest post is `max_seconds` old.
+    Thread-safe: posts can be added while another thread flushes.
+    """
+
+    def __init__(self, storage, max_posts=50, max_seconds=60, journal_path=None, background=False):
+        """
+        :param storage: module or object with save_reply_logs, add_logs_in_error_table and remove_post_ids_to_match
+        (e.g. grbot.bq)
+        :param journal_path: JSON lines file of the acknowledgements not written yet, None for no journal
+        :param background: True if another thread flushes the buffer when due(), instead of the thread adding posts
+        """
+        self.storage = storage
+        self.max_posts = max_posts
+        self.max_seconds = max_seconds
+        self.journal_path = journal_path
+        self.background = background
+        self.entries = []  # {'post_id', 'reply_logs': [row], 'error_logs': [row]}
+        self.oldest = None
+        self.lock = threading.Lock()
+        self.replay()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def replay(self):
+        """
+        Acknowledgements left in the journal by a previous run, written at the next flush
+        """
+        if self.journal_path is None or not os.path.exists(self.journal_path):
+            return
+        with open(self.journal_path) as journal:
+            for line in journal:
+                try:
+                    self.entries.append(json.loads(line))
+                except ValueError:  # Line cut by the crash
+                    logging.info(f"Skipping a truncated line of the ack journal {self.journal_path}")
+        if self.entries:
+            logging.info(f"Replaying {len(self.entries)} acknowledgements from the journal {self.journal_path}")
+            self.oldest = time.monotonic()
+
+    def add(self, post_id, reply_logs=(), error_logs=()):
+        entry = {'post_id': post_id, 'reply_logs': list(reply_logs), 'error_logs': list(error_logs)}
+        with self.lock:
+            if self.journal_path is not None:
+                with open(self.journal_path, 'a') as journal:
+                    journal.write(json.dumps(entry, default=to_json) + '\n')
+                    journal.flush()
+                    os.fsync(journal.fileno())
+            self.entries.append(entry)
+            if self.oldest is None:
+                self.oldest = time.monotonic()
+        if not self.background and self.due():
+            self.flush()
+
+    def due(self):
+        """
+        :return: True if the buffer holds `max_posts` posts or its oldest post is `max_seconds` old
+        """
+        with self.lock:
+            return bool(self.entries) and (
+                len(self.entries) >= self.max_posts or time.monotonic() - self.oldest >= self.max_seconds)
+
+    def add_reply_logs(self, post_id, rows):
+        """
+        :param rows: reply logs of the post, as dicts of the reply logs columns
+        """
+        self.add(post_id, reply_logs=rows)
+
+    def add_error_log(self, post_id, row):
+        self.add(post_id, error_logs=[row])
+
+    def add_removed(self, post_ids):
+        """
+        Posts only removed from the queue, without logs
+        """
+        for post_id in post_ids:
+            self.add(post_id)
+
+    def flush(self):
+        """
+        Writes the logs first, then removes the posts from the queue: posts in the reply logs are not matched again,
+        so a crash at any point leaves no post replied to twice. On failure, the acknowledgements are kept for the
+        next flush, without the logs already written so that they are not written twice.
+        :return: True if everything was written
+        """
+        with self.lock:
+            entries, oldest = self.entries, self.oldest
+            self.entries, self.oldest = [], None
+        if not entries:
+            return True
+        reply_logs = [row for entry in entries for row in entry['reply_logs']]
+        error_logs = [row for entry in entries for row in entry['error_logs']]
+        post_ids = list(dict.fromkeys(entry['post_id'] for entry in entries))
+        try:
+            with metrics.timed('ack'):
+                if reply_logs:
+                    self.storage.save_reply_logs(reply_logs)
+                    for entry in entries:
+                        entry['reply_logs'] = []
+                if error_logs:
+                    self.storage.add_logs_in_error_table(error_logs)
+                    for entry in entries:
+                        entry['error_logs'] = []
+                self.storage.remove_post_ids_to_match(ids=post_ids)
+        except Exception as e:
+            logging.info(f"Failed to flush {len(entries)} acknowledgements, kept for the next flush: {e}")
+            with self.lock:
+                self.entries = entries + self.entries
+                self.oldest = oldest
+                self.write_journal()
+            return False
+        metrics.count('posts_acknowledged', len(entries))
+        logging.info(f"Flushed {len(entries)} acknowledgements: {len(reply_logs)} reply logs, "
+                     f"{len(error_logs)} error logs")
+        with self.lock:  # Only the acknowledgements added during the flush are left to journal
+            self.write_journal()
+        return True
+
+    def write_journal(self):
+        """
+        Rewrites the journal with the acknowledgements of the buffer, the lock being held. Written to a temporary
+        file then renamed, so that a crash meanwhile leaves the previous journal.
+        """
+        if self.journal_path is None:
+            return
+        tmp_path = self.journal_path + '.tmp'
+        with open(tmp_path, 'w') as journal:
+            for entry in self.entries:
+                journal.write(json.dumps(entry, default=to_json) + '\n')
+        os.replace(tmp_path, self.journal_path)
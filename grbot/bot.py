@@ -1,42 +1,64 @@
-from grbot import praw_wrapper, bq, utils
+from grbot import praw_wrapper, utils, crawler, checkpoints, ratelimit, metrics
+from grbot.storage import from_config as open_storage
+from grbot.acks import AckBuffer
+from grbot.cache import LRUCache
 from grbot.configurator import config
 from grbot.formatting import Formatter, Reply
 from grbot.matching import Matcher
+from grbot.pool import MatcherPool
+from grbot.scheduler import ReplyScheduler
 
 import logging
 import pandas as pd
+import time
 
 class Reader:
 
-    def __init__(self, config=config):
-        self.reddit = praw_wrapper.init(config)
+    def __init__(self, config=config, reddit=None, storage=None):
+        self.config = config
+        self.reddit = praw_wrapper.init(config) if reddit is None else reddit
+        self.storage = open_storage(config) if storage is None else storage
         self.subreddits = {sub: self.reddit.subreddit(sub) for sub in config['reddit']['subreddits']}
         self.limit = config['reddit']['limit']
+        # Listings of all subreddits fetched concurrently (see crawler.py) instead of one after the other with praw
+        self.async_crawl = config['reddit'].get('async_crawl', False)
+        # Streaming mode (see stream_posts)
+        self.checkpoint_seconds = config['reddit'].get('stream_checkpoint_seconds', 60)
+        self.stream_pause_seconds = config['reddit'].get('stream_pause_seconds', 5)
+        self.streamed_ids = LRUCache(
+            maxsize=config['reddit'].get('stream_dedupe_size', 10000), name="Streamed post ids")
         self.exc_authors = config['reddit']['excluded_authors']
-        self.last_timestamps = bq.get_last_timestamps(list(self.subreddits.keys()))
+        # Crawl timestamps, cached in memory and upserted by subreddit (see checkpoints.py)
+        self.checkpoints = checkpoints.from_config(config, self.storage)
+        self.last_timestamps = self.checkpoints.timestamps(list(self.subreddits.keys()))
         self.latest_comments = []
         self.latest_submissions = []
 
     def refresh_crawl_timestamp(self):
-        self.last_timestamps = bq.get_last_timestamps(list(self.subreddits.keys()))
+        self.last_timestamps = self.checkpoints.timestamps(list(self.subreddits.keys()))
         return self
 
     def read_posts(self):
 
-        for sub in list(self.subreddits.keys()):
-            self.read_posts_from(sub)
+        with metrics.timed('crawl'):
+            if self.async_crawl:
+                comments, submissions = crawler.crawl_subreddits(self.config, self.last_timestamps, self.limit)
+                self.latest_comments += comments
+                self.latest_submissions += submissions
+            else:
+                for sub in list(self.subreddits.keys()):
+                    self.read_posts_from(sub)
+        metrics.count('posts_crawled', len(self.latest_comments), type='comment')
+        metrics.count('posts_crawled', len(self.latest_submissions), type='submission')
 
         logging.info(f'Got {len(self.latest_submissions)} posts and {len(self.latest_comments)} comments')
 
         if self.latest_submissions or self.latest_comments:
-            new_timestamps = pd.DataFrame(
-                data = [[post.subreddit.display_name, post.created_utc]
-                         for post in (self.latest_submissions + self.latest_comments)],
-                columns = ["subreddit", "crawl_timestamp"]
-            ).groupby('subreddit')['crawl_timestamp'].max().reset_index()
-
-            logging.info(f'Updating timestamp with {new_timestamps}')
-            bq.update_timestamps(new_timestamps)
+            new_timestamps = {}
+            for post in self.latest_submissions + self.latest_comments:
+                sub = post.subreddit.display_name
+                new_timestamps[sub] = max(new_timestamps.get(sub, 0), post.created_utc)
+            self.checkpoints.update(new_timestamps)
             self.refresh_crawl_timestamp()
 
     def read_posts_from(self, sub):
@@ -59,27 +81,117 @@ class Reader:
 
         return self
 
+    def stream_posts(self, on_post=None, on_checkpoint=None, stop=None):
+        """
+        Follows the new comments and submissions of all subreddits continuously, instead of polling their listings.
+        Posts are deduped by id, the triggering ones are saved to match and passed to on_post right away.
+        Crawl timestamps are flushed every `checkpoint_seconds`, once both streams are caught up: after a crash, the
+        posts seen since the last flush are seen again. Not when a stream fails, since the other one may be behind.
+        Streams started again (e.g. after an error) replay their latest posts, skipped as already seen.
+        :param on_post: function of (post, post_type) called for each triggering post
+        :param on_checkpoint: function called after each checkpoint flush
+        :param stop: function returning True to stop streaming, None to stream forever
+        """
+        subreddits = self.reddit.subreddit('+'.join(self.subreddits.keys()))
+        streams = {
+            'comment': subreddits.stream.comments(pause_after=0),
+            'submission': subreddits.stream.submissions(pause_after=0)
+        }
+        new_timestamps, last_checkpoint = {}, time.monotonic()
+        logging.info(f"Started streaming {subreddits.display_name}")
+        while stop is None or not stop():
+            n_new = 0
+            for post_type, stream in streams.items():
+                for post in stream:
+                    if post is None:  # Nothing new on this stream for now
+                        break
+                    n_new += self.stream_post(post, post_type, new_timestamps, on_post)
+            if time.monotonic() - last_checkpoint > self.checkpoint_seconds:
+                self.flush_timestamps(new_timestamps)
+                self.streamed_ids.log_stats()
+                new_timestamps, last_checkpoint = {}, time.monotonic()
+                if on_checkpoint is not None:
+                    on_checkpoint()
+            if not n_new:
+                time.sleep(self.stream_pause_seconds)
+        self.flush_timestamps(new_timestamps)
+
+    def stream_post(self, post, post_type, new_timestamps, on_post):
+        """
+        :return: 1 if the post is new, else 0
+        """
+        sub = post.subreddit.display_name
+        if self.streamed_ids.get(post.id) is not None or post.created_utc <= self.last_timestamps.get(sub, 0):
+            return 0
+        metrics.count('posts_crawled', type=post_type)
+        triggers = utils.comment_triggers(post, self.exc_authors)
+        if triggers:
+            metrics.count('posts_triggering', type=post_type)
+            logging.info(f"Streamed triggering {post_type} {post.id} on {sub}")
+            self.storage.save_post_ids_to_match([[sub, post.id, post.created_utc, post_type]])
+        # Once saved: a post failing to be saved is not marked as seen, to be saved when the streams replay it
+        self.streamed_ids.put(post.id, True)
+        new_timestamps[sub] = max(new_timestamps.get(sub, 0), post.created_utc)
+        if triggers and on_post is not None:
+            on_post(post, post_type)
+        return 1
+
+    def flush_timestamps(self, new_timestamps):
+        if new_timestamps:
+            self.checkpoints.update(new_timestamps)
+            self.refresh_crawl_timestamp()
+
     def save_posts(self):
+        """
+        Saves the triggering posts crawled since the last call to match
+        :return: [(post, post_type)] saved
+        """
         filtered_comments = [c for c in self.latest_comments if utils.comment_triggers(c, self.exc_authors)]
         filtered_submissions = [s for s in self.latest_submissions if utils.comment_triggers(s, self.exc_authors)]
 
+        metrics.count('posts_triggering', len(filtered_comments), type='comment')
+        metrics.count('posts_triggering', len(filtered_submissions), type='submission')
         if filtered_comments or filtered_submissions:
             # Store IDs to treat in Big Query
             comment_ids = [[comment.subreddit.display_name, comment.id, comment.created_utc, 'comment']
                            for comment in filtered_comments]
             submission_ids = [[submission.subreddit.display_name, submission.id, submission.created_utc, 'submission']
                               for submission in filtered_submissions]
-            bq.save_post_ids_to_match(comment_ids + submission_ids)
+            self.storage.save_post_ids_to_match(comment_ids + submission_ids)
 
         self.latest_comments, self.latest_submissions = [], []
 
-        return True
+        return [(comment, 'comment') for comment in filtered_comments] + \
+               [(submission, 'submission') for submission in filtered_submissions]
 
 
 class Poster:
 
-    def __init__(self, config):
-        self.reddit = praw_wrapper.init(config)
+    def __init__(self, config, reddit=None, storage=None, acks=None):
+        """
+        :param acks: AckBuffer of the replies, built from the config if None. Only one buffer must replay the journal.
+        """
+        self.reddit = praw_wrapper.init(config) if reddit is None else reddit
+        self.storage = open_storage(config) if storage is None else storage
+        # Reply / error logs and removals from the queue, written in batches (see acks.py)
+        self.acks = AckBuffer(
+            self.storage,
+            max_posts=config['flow'].get('ack_max_posts', 50),
+            max_seconds=config['flow'].get('ack_max_seconds', 60),
+            journal_path=config['flow'].get('ack_journal_path')) if acks is None else acks
+        # Replies sent within the rate limit of the account, deferred and retried when refused (see scheduler.py)
+        self.scheduler = None
+        if config['reddit'].get('reply_scheduler', False):
+            self.scheduler = ReplyScheduler(
+                ratelimit.for_account(config['creds']['reddit_username']),
+                on_done=self.monitoring_after_reply,
+                send=self.reply_to,
+                reserve=config['reddit'].get('reply_reserve', 10),
+                max_attempts=config['reddit'].get('reply_max_attempts', 10),
+                retry_seconds=config['reddit'].get('reply_retry_seconds', 60))
+            scheduler = self.scheduler
+            metrics.register_gauge('scheduled_replies', lambda: {'pending': len(scheduler), **scheduler.stats},
+                                   label='state')
 
     def get_formatters(self, title_matches, books_requested, all_books_recommended_along):
         return [
@@ -94,17 +206,63 @@ class Poster:
             in enumerate(zip(title_matches, books_requested, all_books_recommended_along))
         ]
 
-    def post_reply(self, post, reply_text):
+    def reply_to(self, post, post_type, reply_text):
+        """
+        Replies with the Reddit client of the Poster. praw clients are not thread-safe: posts fetched by another
+        client (e.g. by the crawl thread of the pipeline) are bound to this one first, without fetching them again.
+        """
+        if getattr(post, '_reddit', None) is not self.reddit:
+            post = self.reddit.submission(id=post.id) if post_type == 'submission' else self.reddit.comment(id=post.id)
+        return post.reply(reply_text)
+
+    def post_reply(self, post, post_type, reply_text):
         try:
             logging.info(f"Answering post {post.id} with text : {reply_text}")
-            reply = post.reply(reply_text)
+            with metrics.timed('post'):
+                reply = self.reply_to(post, post_type, reply_text)
             return reply
 
         except Exception as e:
-            print(f"Error posting reply: {e}")
+            logging.exception(f"Error posting reply to post {post.id}: {e}")
+            metrics.count('errors', stage='post')
             return None
 
+    def send_reply(self, post, post_type, reply_text, formatters):
+        """
+        Posts the reply and logs it, or hands it to the scheduler which does both once the rate limit allows
+        """
+        if self.scheduler is None:
+            reply = self.post_reply(post, post_type, reply_text)
+            self.monitoring_after_reply(post, post_type, reply, formatters)
+        else:
+            self.scheduler.submit(post, post_type, reply_text, formatters)
+            self.scheduler.run()
+
+    def pending_ids(self):
+        """
+        :return: ids of the posts whose reply waits in the scheduler: still in the storage queue, but not to be
+        matched again (the scheduler retries them with their reply)
+        """
+        return set(self.scheduler.post_ids) if self.scheduler is not None else set()
+
+    def send_scheduled(self):
+        """
+        Posts the scheduled replies which can be posted now
+        """
+        if self.scheduler is not None:
+            self.scheduler.run()
+            self.scheduler.log_stats()
+
+    def flush(self):
+        """
+        End of a cycle: scheduled replies posted if possible, then acknowledgements written. The posts whose reply
+        is still pending stay in the queue.
+        """
+        self.send_scheduled()
+        self.acks.flush()
+
     def monitoring_after_reply(self, post, post_type, reply, formatter_list):
+        metrics.count('replies', outcome='posted' if reply else 'not_posted')
         if not reply:
             log_list = [post.subreddit.display_name, post.id, post_type, None]
         else:
@@ -118,63 +276,255 @@ class Poster:
             df_to_log = pd.DataFrame([
                 log_list + [None, None, None]
             ], columns=['subreddit', 'post_id', 'post_type', 'reply_id', 'master_grlink', 'score', 'author'])
-        print(df_to_log)
-        bq.save_reply_logs(df_to_log=df_to_log)
-        bq.remove_post_ids_to_match(ids=[post.id])
+        logging.info(f"Reply logs:\n{df_to_log}")
+        self.acks.add_reply_logs(post.id, df_to_log.to_dict('records'))
         return
 
     def classify_as_error(self, post, error):
-        bq.add_log_in_error_table(post = post, error= error)
-        bq.remove_post_ids_to_match(ids=[post.id])
+        metrics.count('errors', stage='reply')
+        self.acks.add_error_log(post.id, utils.error_log_row(post, error))
         return
 
 class Bot:
 
-    def __init__(self, config):
+    def __init__(self, config, storage=None, acks=None):
+        """
+        :param acks: AckBuffer of the Poster, built from the config if None
+        """
+        self.config = config
         self.subreddits_str = config['reddit']['subreddits']
+        # Stage timings and counters, exposed locally if metrics.enabled (see metrics.py)
+        metrics.configure(config)
+        # Queue, checkpoints and logs: BigQuery or a local database depending on flow.mode (see storage.py)
+        self.storage = open_storage(config) if storage is None else storage
+        # One Reddit client (and HTTP session) shared by the Reader and the Poster
+        if config['flow']['run_reader'] or config['flow']['run_poster']:
+            self.reddit = praw_wrapper.init(config)
+        # Rate limit budget of the account, shared by all its clients (see ratelimit.for_account)
+        self.rate_limit = ratelimit.for_account(config['creds']['reddit_username'])
+        self.reply_reserve = config['reddit'].get('reply_reserve', 10)
+        metrics.register_gauge(
+            'rate_limit_available', lambda: {config['creds']['reddit_username']: self.rate_limit.available() or 0},
+            label='account')
         if config['flow']['run_reader']:
-            self.reader = Reader(config)
+            self.reader = Reader(config, reddit=self.reddit, storage=self.storage)
+        self.matcher_pool = None
         if config['flow']['run_matcher']:
-            self.matcher = Matcher(config)
+            self.matcher = Matcher(config, storage=self.storage)
+            # Matching processes, forked once the catalog is loaded (0 to match in this process)
+            if config['flow'].get('matching_processes', 0) > 0:
+                self.matcher_pool = MatcherPool(self.matcher, processes=config['flow']['matching_processes'])
+        # Catalog changes picked up every catalog_refresh_minutes (0 to keep the catalog loaded at start)
+        self.catalog_refresh_seconds = 60 * config['matching'].get('catalog_refresh_minutes', 0)
+        self.last_catalog_refresh = time.monotonic()
         if config['flow']['run_poster']:
-            self.poster = Poster(config)
+            self.poster = Poster(config, reddit=self.reddit, storage=self.storage, acks=acks)
 
-    def check_scores(self, comment_limit=50, karma_threshold=1):
+    def refresh_catalog_if_due(self, restart_pool=True):
+        """
+        Refreshes the catalog of the Matcher (see Matcher.refresh_catalog) if catalog_refresh_minutes have passed
+        since the last refresh. Matching goes on meanwhile, on the previous version.
+        :param restart_pool: True to fork the matching processes again if the catalog was loaded in full (see
+        MatcherPool.restart_if_reloaded), only if no other thread runs. Changes reach them without a restart.
+        """
+        if not self.catalog_refresh_seconds or not self.config['flow']['run_matcher'] \
+                or time.monotonic() - self.last_catalog_refresh < self.catalog_refresh_seconds:
+            return
+        self.last_catalog_refresh = time.monotonic()
+        try:
+            with metrics.timed('catalog_refresh'):
+                self.matcher.refresh_catalog(self.config)
+                if restart_pool and self.matcher_pool is not None:
+                    self.matcher_pool.restart_if_reloaded()
+        except Exception as e:
+            logging.info(f"Catalog refresh failed, still on version {self.matcher.catalog_version}: {e}")
+
+    def check_scores(self, comment_limit=50, karma_threshold=1, reddit=None):
         """Check recently posted comments and delete if the karma score is below given threshold."""
+        available = self.rate_limit.available()
+        if available is not None and available < self.reply_reserve:  # Left to the crawl and the replies
+            logging.info(f"Skipping the score check, {available:.0f} requests left in the rate limit budget")
+            return
         logging.info("Checking comment scores...")
+        reddit = self.poster.reddit if reddit is None else reddit
 
-        for posted_comment in self.poster.reddit.user.me().comments.new(limit=comment_limit):
-            if posted_comment.score < karma_threshold:
-                posted_comment.delete()
-                url = posted_comment.permalink.replace(posted_comment.id, posted_comment.parent_id[3:])
-                logging.info("Downvoted comment removed: https://www.reddit.com" + url)
+        with metrics.timed('check_scores'):
+            for posted_comment in reddit.user.me().comments.new(limit=comment_limit):
+                if posted_comment.score < karma_threshold:
+                    posted_comment.delete()
+                    metrics.count('replies', outcome='deleted')
+                    url = posted_comment.permalink.replace(posted_comment.id, posted_comment.parent_id[3:])
+                    logging.info("Downvoted comment removed: https://www.reddit.com" + url)
 
     def run_crawling(self):
         self.reader.read_posts()
         self.reader.save_posts()
 
+    def match_post(self, books_requested, post_id=None):
+        """
+        :param post_id: id of the post, to trace the matching spans with (see metrics.tracing)
+        """
+        try:
+            with metrics.tracing(post_id), metrics.timed('match_post'):
+                metrics.count('queries_requested', len(books_requested))
+                title_matches = self.matcher.process_queries(books_requested)
+                return title_matches, self.matcher.recommend_books(title_matches, k=5)
+        except Exception as e:
+            return e
+
+    def match_posts(self, books_requested_by_post, post_ids=None):
+        """
+        :return: iterator over (title matches, recommendations) or the exception raised, for each post in order
+        """
+        if self.matcher_pool is not None:
+            return self.matcher_pool.match_posts(books_requested_by_post, k=5)
+        post_ids = [None] * len(books_requested_by_post) if post_ids is None else post_ids
+        return (self.match_post(books_requested, post_id)
+                for books_requested, post_id in zip(books_requested_by_post, post_ids))
+
+    def books_requested(self, post, post_type):
+        if post_type == "comment":
+            return utils.extract_braces(post.body)[0:config['reddit']['max_search_per_post']]
+        elif post_type == "submission":
+            return utils.extract_braces(post.selftext)[0:config['reddit']['max_search_per_post']]
+        else:
+            raise ValueError
+
+    def reply(self, post, post_type, books_requested, matched):
+        """
+        :param matched: (title matches, recommendations) or the exception raised while matching (see match_post)
+        """
+        try:
+            with metrics.tracing(post.id):
+                if len(books_requested) == 0:
+                    self.poster.monitoring_after_reply(post, post_type, None, None)
+                else:
+                    if isinstance(matched, Exception):
+                        raise matched
+                    title_matches, books_recommended_along = matched
+                    with metrics.timed('format'):
+                        formatters = self.poster.get_formatters(title_matches, books_requested, books_recommended_along)
+                        reply_text = Reply(formatters, post.author.name).text()
+                    self.poster.send_reply(post, post_type, reply_text, formatters)
+        except Exception as e:
+            self.poster.classify_as_error(post=post, error=e)
+
     def match_and_reply_one_by_sub(self):
-        for (post_subreddit, post_id, post_type) in bq.get_posts_to_match(self.subreddits_str):
+        posts = []
+        with metrics.timed('queue_fetch'):
+            # Deferred replies left out: the next post of their subreddit gets its turn
+            queued = self.storage.get_posts_to_match(self.subreddits_str, exclude=self.poster.pending_ids())
+        for (post_subreddit, post_id, post_type) in queued:
             logging.info("Working on post_id = " + post_id)
             if post_type == "comment":
-                post = self.reader.reddit.comment(id=post_id)
-                books_requested = utils.extract_braces(post.body)[0:config['reddit']['max_search_per_post']]
+                post = self.reddit.comment(id=post_id)
             elif post_type == "submission":
-                post = self.reader.reddit.submission(id=post_id)
-                books_requested = utils.extract_braces(post.selftext)[0:config['reddit']['max_search_per_post']]
+                post = self.reddit.submission(id=post_id)
             else:
                 raise ValueError
+            posts.append((post, post_type, self.books_requested(post, post_type)))
+
+        # Posts are matched (in parallel with a matcher pool) and replied to in order
+        matched_posts = self.match_posts([books_requested for _, _, books_requested in posts],
+                                         post_ids=[post.id for post, _, _ in posts])
+        try:
+            for (post, post_type, books_requested), matched in zip(posts, matched_posts):
+                self.reply(post, post_type, books_requested, matched)
+            else:
+                logging.info("get_post_ids_to_match returned empty string")
+        finally:
+            self.poster.flush()
+
+    def match_and_reply_batch(self, batch_size):
+        """
+        Replies to the `batch_size` oldest posts waiting in the queue, of all subreddits: the posts are fetched from
+        Reddit together, matched together, and their completions written back at once (see Poster.acks)
+        :return: number of posts taken from the queue
+        """
+        with metrics.timed('queue_fetch'):
+            queued = self.storage.get_posts_to_match(
+                self.subreddits_str, batch_size=batch_size, exclude=self.poster.pending_ids())
+        if not queued:
+            logging.info("No post waiting to be matched")
+            self.poster.flush()
+            return 0
+        logging.info(f"Working on a batch of {len(queued)} posts")
+        posts, missing = self.fetch_queued_posts(queued)
+
+        try:
+            if missing:  # Deleted posts, not returned by Reddit
+                logging.info(f"Posts not found on Reddit, removed from the queue: {missing}")
+                self.poster.acks.add_removed(missing)
+            for matched_post in self.match_batch(posts):
+                self.reply_matched(*matched_post)
+        finally:
+            self.poster.flush()
+        return len(queued)
+
+    def match_batch(self, posts):
+        """
+        :param posts: [(post, post_type)]
+        :return: [(post, post_type, books requested, matched)], see reply_matched
+        """
+        books_requested_by_post = []
+        for post, post_type in posts:
             try:
-                if len(books_requested) == 0:
-                    self.poster.monitoring_after_reply(post, post_type, None, None)
-                else:
-                    title_matches = self.matcher.process_queries(books_requested)
-                    books_recommended_along = self.matcher.recommend_books(title_matches, k=5)
-                    formatters = self.poster.get_formatters(title_matches, books_requested, books_recommended_along)
-                    reply_text = Reply(formatters, post.author.name).text()
-                    reply = self.poster.post_reply(post, reply_text)
-                    self.poster.monitoring_after_reply(post, post_type, reply, formatters)
+                books_requested_by_post.append(self.books_requested(post, post_type))
             except Exception as e:
-                self.poster.classify_as_error(post=post, error=e)
+                books_requested_by_post.append(e)
+        matched_posts = self.match_posts([
+            [] if isinstance(books_requested, Exception) else books_requested
+            for books_requested in books_requested_by_post
+        ], post_ids=[post.id for post, _ in posts])
+        return [
+            (post, post_type, books_requested, matched)
+            for (post, post_type), books_requested, matched in zip(posts, books_requested_by_post, matched_posts)
+        ]
+
+    def reply_matched(self, post, post_type, books_requested, matched):
+        """
+        :param books_requested: list of titles, or the exception raised while extracting them
+        """
+        if isinstance(books_requested, Exception):
+            self.poster.classify_as_error(post=post, error=books_requested)
         else:
-            logging.info("bq.get_post_ids_to_match returned empty string")
+            self.reply(post, post_type, books_requested, matched)
+
+    def fetch_queued_posts(self, queued):
+        """
+        :param queued: [[subreddit, post_id, post_type]] (see get_posts_to_match)
+        :return: ([(post, post_type)] fetched from Reddit together, ids of the posts not found)
+        """
+        fullnames = [('t3_' if post_type == 'submission' else 't1_') + post_id for _, post_id, post_type in queued]
+        with metrics.timed('fetch_posts'):
+            posts_by_id = {post.id: post for post in self.reddit.info(fullnames=fullnames)}
+        posts = [
+            (posts_by_id[post_id], post_type) for _, post_id, post_type in queued if post_id in posts_by_id
+        ]
+        return posts, [post_id for _, post_id, _ in queued if post_id not in posts_by_id]
+
+    def match_and_reply_post(self, post, post_type):
+        logging.info(f"Working on streamed post_id = {post.id}")
+        books_requested = self.books_requested(post, post_type)
+        self.reply(post, post_type, books_requested, self.match_post(books_requested, post_id=post.id))
+
+    def run_streaming(self, stop=None):
+        """
+        Streams new posts (see Reader.stream_posts), replying to the triggering ones as soon as they are seen.
+        Acknowledgements are flushed and scores checked at each crawl checkpoint.
+        """
+        try:
+            self.reader.stream_posts(
+                on_post=self.match_and_reply_post if self.config['flow']['run_poster'] else None,
+                on_checkpoint=self.stream_checkpoint,
+                stop=stop)
+        finally:
+            if self.config['flow']['run_poster']:
+                self.poster.flush()
+
+    def stream_checkpoint(self):
+        self.refresh_catalog_if_due()
+        if self.config['flow']['run_poster']:
+            self.poster.flush()
+        if self.config['flow'].get('run_check_scores'):
+            self.check_scores()
@@ -1,13 +1,16 @@
 from google.cloud import bigquery
 from google.oauth2 import service_account
 from google.cloud.bigquery.schema import SchemaField
-from google.api_core.exceptions import Conflict
-from grbot.utils import replace_nan, remove_zeros, is_submission
+from google.api_core.exceptions import Conflict, NotFound
+from grbot.utils import replace_nan, error_log_row
 from grbot.configurator import config
+from grbot.storage import (REPLY_LOGS_SCHEMA, ERROR_LOGS_SCHEMA, TO_MATCH_SCHEMA, MIN_POST_TIMESTAMP,
+                           clean_dim_table)
 
 import pandas as pd
 import pickle
 import logging
+import uuid
 
 TABLE_DIM_BOOKS = config['bq']['table_dim_books']
 TABLE_DIM_SERIES = config['bq']['table_dim_series']
@@ -24,13 +27,20 @@ if config['flow']['mode'] == 'local':
 else:
     client = bigquery.Client()
 
-def append_to_table(df, table, schema_dic, client=client):
+def append_to_table(df, table, schema_dic, client=client, row_ids=None):
+    """
+    :param row_ids: insert ids of the rows, BigQuery drops rows inserted again with the same id (best effort)
+    """
     table_obj = client.dataset(table.split('.')[0]).table(table.split('.')[1])
     schema = [
         SchemaField(name=column, field_type=typ) for (column,typ) in schema_dic.items()
     ]
     logging.info(f"Attempting to append df {df} to table {table} with schema {schema}")
-    errors = client.insert_rows_from_dataframe(table_obj, df, selected_fields=schema)
+    if row_ids is not None:
+        errors = client.insert_rows_from_dataframe(
+            table_obj, df, selected_fields=schema, chunk_size=max(1, len(df)), row_ids=list(row_ids))
+    else:
+        errors = client.insert_rows_from_dataframe(table_obj, df, selected_fields=schema)
     if errors == [[]]:
         logging.info("Rows appended successfully")
     else:
@@ -97,18 +107,23 @@ def download_book_db(table=TABLE_DIM_BOOKS, local_path=None):
             df = pickle.load(handle)
     else:
         df = sql_to_df(f"""SELECT * FROM {table}""")
-    for col in df.columns:
-        df[col] = df[col].apply(lambda x: replace_nan(x, None))
-    if "book_number" in df.columns:
-        df['book_number'] = df['book_number'].apply(lambda x: remove_zeros(str(x)))
-    return df.rename(columns = {
-        'first_author': 'author',
-        'short_title': 'book_title'
-    })
+    return clean_dim_table(df)
 
 def download_series_db(table=TABLE_DIM_SERIES, local_path=None):
     return download_book_db(table=table, local_path=local_path)
 
+def download_book_db_changes(since, column, table=TABLE_DIM_BOOKS):
+    """
+    Rows of the dim table changed (or added) since a watermark
+    :param since: highest value of `column` already loaded
+    :param column: column set when a row is written, e.g. an update timestamp
+    """
+    since = since if isinstance(since, (int, float)) else f"'{sanitize_for_sql(str(since))}'"
+    return clean_dim_table(sql_to_df(f"""SELECT * FROM {table} WHERE {column} > {since}"""))
+
+def download_series_db_changes(since, column, table=TABLE_DIM_SERIES):
+    return download_book_db_changes(since, column, table=table)
+
 def get_last_timestamps(subreddits, table=TABLE_CRAWL_DATES):
     query = f"""
     SELECT 
@@ -122,28 +137,66 @@ def get_last_timestamps(subreddits, table=TABLE_CRAWL_DATES):
     return df['timestamp'].to_dict()
 
 def update_timestamps(timestamps, table=TABLE_CRAWL_DATES, project_id=PROJECT_ID):
-    timestamps_old = sql_to_df(f"SELECT * FROM {table}")
-    timestamps_to_upload = (
-        pd.concat([timestamps_old, timestamps], axis = 0, sort = False)
-        .groupby(['subreddit'])
-        ['crawl_timestamp'].max()
-        .reset_index()
-    )
-    return overwrite_populate(
-        timestamps_to_upload,
-        table_id = '.'.join([project_id, table]),
-        schema_dic = {"subreddit": "STRING", "crawl_timestamp": "INTEGER"}
+    """
+    Upserts the crawl timestamps of the subreddits, keeping the latest one: one MERGE, the table is created if missing
+    :param timestamps: DataFrame (subreddit, crawl_timestamp)
+    """
+    rows = ", ".join(
+        f"STRUCT('{sanitize_for_sql(subreddit)}' AS subreddit, {int(timestamp)} AS crawl_timestamp)"
+        for subreddit, timestamp in timestamps[['subreddit', 'crawl_timestamp']].values.tolist()
     )
+    merge_query = f"""
+        MERGE {table} T
+        USING (SELECT * FROM UNNEST([{rows}])) S
+        ON T.subreddit = S.subreddit
+        WHEN MATCHED AND S.crawl_timestamp > T.crawl_timestamp THEN
+            UPDATE SET crawl_timestamp = S.crawl_timestamp
+        WHEN NOT MATCHED THEN
+            INSERT (subreddit, crawl_timestamp) VALUES (S.subreddit, S.crawl_timestamp)
+    """
+    logging.info(f"Running query : {merge_query}")
+    try:
+        return client.query(merge_query).result()
+    except NotFound:
+        return overwrite_populate(
+            timestamps.groupby(['subreddit'])['crawl_timestamp'].max().astype(int).reset_index(),
+            table_id = '.'.join([project_id, table]),
+            schema_dic = {"subreddit": "STRING", "crawl_timestamp": "INTEGER"}
+        )
 
 
 def save_post_ids_to_match(post_ids, table=TABLE_TO_MATCH):
     return append_to_table(
-        df=pd.DataFrame(post_ids, columns = ["subreddit", "post_id", "post_timestamp", "post_type"]).drop_duplicates(),
+        df=pd.DataFrame(post_ids, columns = list(TO_MATCH_SCHEMA)).drop_duplicates(),
         table=table,
-        schema_dic={"subreddit": "STRING", "post_id": 'STRING', 'post_timestamp': 'INTEGER', "post_type": 'STRING'}
+        schema_dic=TO_MATCH_SCHEMA
     )
 
-def get_posts_to_match(subreddits, table=TABLE_TO_MATCH, table_already_replied=TABLE_REPLY_LOGS):
+def get_posts_to_match(subreddits, table=TABLE_TO_MATCH, table_already_replied=TABLE_REPLY_LOGS, batch_size=None,
+                       exclude=()):
+    """
+    :param batch_size: None for the oldest post of each subreddit, else the `batch_size` oldest posts of all the
+    subreddits (FIFO)
+    :param exclude: ids of posts left out, e.g. the ones whose reply is pending (see Poster.pending_ids)
+    :return: [[subreddit, post_id, post_type]]
+    """
+    excluded = f"""AND T.post_id NOT IN ('{"', '".join(map(str, exclude))}')""" if exclude else ''
+    if batch_size is not None:
+        df = sql_to_df(f"""
+            SELECT DISTINCT T.subreddit, T.post_id, T.post_type, T.post_timestamp FROM {table} T 
+            LEFT JOIN {table_already_replied} T2 
+                USING (post_id, post_type)
+            WHERE TRUE
+                AND T2.post_id IS NULL -- Post has not been processed yet
+                AND T.subreddit IN ('{"', '".join(subreddits)}') 
+                AND T.post_type = 'comment' -- Answering to submissions will be added later
+                AND T.post_timestamp >= {MIN_POST_TIMESTAMP}
+                {excluded}
+            ORDER BY post_timestamp, post_id
+            LIMIT {int(batch_size)}
+        """)
+        return df[['subreddit', 'post_id', 'post_type']].values.tolist()
+
     df = sql_to_df(f"""
         SELECT T.* FROM {table} T 
         LEFT JOIN {table_already_replied} T2 
@@ -152,7 +205,8 @@ def get_posts_to_match(subreddits, table=TABLE_TO_MATCH, table_already_replied=T
             AND T2.post_id IS NULL -- Post has not been processed yet
             AND T.subreddit IN ('{"', '".join(subreddits)}') 
             AND T.post_type = 'comment' -- Answering to submissions will be added later
-            AND T.post_timestamp >= 1695500000
+            AND T.post_timestamp >= {MIN_POST_TIMESTAMP}
+            {excluded}
         ORDER BY post_timestamp DESC
     """)[['subreddit' , 'post_id', 'post_type']]
 
@@ -169,53 +223,80 @@ def remove_post_ids_to_match(ids, table=TABLE_TO_MATCH):
     )
 
 def add_log_in_error_table(post, error):
-    schema_dic = {"subreddit": "STRING", "post_id": 'STRING', "post_type": 'STRING',
-                  "post_content": 'STRING', "author": "STRING", "error": 'STRING'}
-    df = {
-        "subreddit": [post.subreddit],
-        "post_id" : [post.id],
-        "post_type" : [is_submission(post)],
-        "post_content": [post.selftext if is_submission(post) else post.body],
-        "author": [post.author],
-        "error": [error]
-    }
+    return add_logs_in_error_table([error_log_row(post, error)])
+
+def add_logs_in_error_table(rows):
+    """
+    :param rows: error logs of several posts (see error_log_row), appended at once
+    """
+    df = pd.DataFrame(rows, columns=list(ERROR_LOGS_SCHEMA))
+    # Same id when a log is written again (e.g. replayed from the ack journal), not for another error of the post.
+    # Rows without logged_at (journaled before it was added) get a random one.
+    row_ids = [
+        f"error-{row['post_id']}-{row['logged_at'] if 'logged_at' in row else uuid.uuid4().hex}" for row in rows
+    ]
     return append_to_table(
         df = df,
         table = TABLE_ERROR_LOGS,
-        schema_dic = schema_dic
+        schema_dic = ERROR_LOGS_SCHEMA,
+        row_ids = row_ids
     )
 
 def get_info(book_id_list, table=TABLE_DIM_BOOKS):
+    """
+    :return: {book_id: info dict} of the books, in one query
+    """
     if len(book_id_list) < 1:
         return None
     info_df = sql_to_df(f"""SELECT * FROM {table} WHERE book_id IN ({", ".join(
         [str(book_id) for book_id in book_id_list]
-    )})""")
-    for col in info_df.columns:
-        info_df[col] = info_df[col].apply(lambda x: replace_nan(x, None))
-    return info_df.groupby('book_id').apply(lambda x: x.to_dict('records')[0]).to_dict()
+    )})""").drop_duplicates('book_id')
+    return {
+        record['book_id']: {column: replace_nan(value, None) for column, value in record.items()}
+        for record in info_df.to_dict('records')
+    }
+
+def book_ids_from_series_ids(series_ids, table_book=TABLE_DIM_BOOKS):
+    """
+    :return: {series_id: book_id of its first book} of the series, in one query
+    """
+    if len(series_ids) < 1:
+        return {}
+    df = sql_to_df(f"""
+        SELECT series_id, book_id FROM {table_book}
+        WHERE series_id IN ({", ".join([str(int(series_id)) for series_id in series_ids])})
+        QUALIFY ROW_NUMBER() OVER (
+            PARTITION BY series_id
+            ORDER BY 
+            CASE 
+                WHEN REGEXP_CONTAINS(CAST(book_number AS STRING), r'^[0-9]+$') THEN 1         -- Normal integers
+                WHEN REGEXP_CONTAINS(CAST(book_number AS STRING), r'^[0-9]+.[0-9]+$') THEN 2  -- "0.1" and prologues
+                WHEN REGEXP_CONTAINS(CAST(book_number AS STRING), r'^[0-9]+-[0-9]+$') THEN 3  -- "1-3" and other compilations
+                ELSE 4  -- Other cases
+            END, CAST(book_number AS STRING)
+        ) = 1
+    """)
+    return {int(series_id): int(book_id) for series_id, book_id in zip(df['series_id'], df['book_id'])}
 
 def book_id_from_series_id(
     series_id,
     table_book=TABLE_DIM_BOOKS
 ):
-    return sql_to_df(f"""
-        SELECT book_id FROM {table_book}
-        WHERE series_id = {series_id}
-        ORDER BY 
-        CASE 
-            WHEN book_number REGEXP '^[0-9]+$' THEN 1         -- Normal integers
-            WHEN book_number REGEXP '^[0-9]+.[0-9]+$' THEN 2  -- "0.1" and prologues
-            WHEN book_number REGEXP '^[0-9]+-[0-9]+$' THEN 3  -- "1-3" and other compilations
-            ELSE 4  -- Other cases
-        END, book_number
-        LIMIT 1
-    """).loc[0, 'book_id']
+    """
+    :param series_id: series id, or a list holding it
+    """
+    if isinstance(series_id, (list, tuple)):
+        series_id = series_id[0]
+    return book_ids_from_series_ids([series_id], table_book=table_book)[int(series_id)]
 
 def save_reply_logs(df_to_log, table=TABLE_REPLY_LOGS):
+    """
+    :param df_to_log: DataFrame or list of dicts with the reply logs columns
+    """
+    df = pd.DataFrame(df_to_log, columns=list(REPLY_LOGS_SCHEMA))
     return append_to_table(
-        df=df_to_log,
+        df=df,
         table=table,
-        schema_dic={"subreddit": "STRING", "post_id": 'STRING', "post_type": 'STRING',
-                    "reply_id": 'STRING', "master_grlink": 'STRING', "score": "FLOAT", "author": "STRING"}
-    )
\ No newline at end of file
+        schema_dic=REPLY_LOGS_SCHEMA,
+        row_ids=df['post_id'].astype(str) + '-' + df.groupby('post_id').cumcount().astype(str)
+    )
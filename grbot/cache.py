@@ -0,0 +1,75 @@
+from grbot import metrics
+
+from collections import OrderedDict
+import logging
+import threading
+import time
+
+
+class LRUCache:
+    """
+    Bounded {key: value} cache: least recently used entries are evicted past maxsize, entries older than ttl seconds
+    are dropped on access. Thread-safe, with hit / miss / eviction counters.
+    """
+
+    def __init__(self, maxsize, ttl=None, name='cache'):
+        """
+        :param maxsize: max number of entries, 0 disables the cache
+        :param ttl: time to live of the entries in seconds, None for no expiration
+        :param name: used in the logs
+        """
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.name = name
+        self.entries = OrderedDict()  # key -> (insertion time, value)
+        self.lock = threading.Lock()
+        self.hits, self.misses, self.evictions, self.expirations = 0, 0, 0, 0
+        metrics.caches.add(self)
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and self.ttl is not None and time.monotonic() - entry[0] > self.ttl:
+                del self.entries[key]
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, value):
+        if not self.maxsize:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
+
+    def log_stats(self):
+        stats = self.stats()
+        logging.info(
+            f"{self.name}: {stats['size']} entries, {stats['hits']} hits, {stats['misses']} misses "
+            f"({stats['hit_rate']:.1%} hit rate), {stats['evictions']} evictions, {stats['expirations']} expirations")
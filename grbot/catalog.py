@@ -0,0 +1,443 @@
+from collections.abc import Mapping
+import json
+import numpy as np
+import pandas as pd
+
+
+def python_scalar(value):
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def is_null(value):
+    return value is None or (isinstance(value, float) and value != value)
+
+
+def updated_size(size, positions):
+    """
+    Size of a column of `size` values once values are set at positions, positions past the end being appended
+    """
+    return max(size, max(positions) + 1) if len(positions) else size
+
+
+def array_with_values(array, positions, values):
+    """
+    Copy of a numpy array with the values at positions replaced, positions past the end appended (in order)
+    """
+    updated = np.zeros(updated_size(len(array), positions), dtype=array.dtype)
+    updated[:len(array)] = array
+    for position, value in zip(positions, values):
+        updated[position] = value
+    return updated
+
+
+class StringColumn:
+    """
+    Strings stored as one contiguous utf-8 buffer and their offsets, instead of one Python object per value.
+    None values are flagged in `nulls`.
+    """
+
+    def __init__(self, buffer, offsets, nulls=None):
+        self.buffer = buffer
+        self.offsets = offsets
+        self.nulls = nulls
+
+    @classmethod
+    def from_values(cls, values, nulls=None):
+        if nulls is None:
+            nulls = np.array([value is None for value in values], dtype=bool)
+        encoded = [b'' if null else value.encode() for value, null in zip(values, nulls)]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=offsets[1:])
+        return cls(
+            buffer=np.frombuffer(b''.join(encoded), dtype=np.uint8),
+            offsets=offsets,
+            nulls=nulls if nulls.any() else None
+        )
+
+    def to_arrays(self):
+        arrays = {'buffer': self.buffer, 'offsets': self.offsets}
+        if self.nulls is not None:
+            arrays['nulls'] = self.nulls
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(buffer=arrays['buffer'], offsets=arrays['offsets'], nulls=arrays.get('nulls'))
+
+    def with_values(self, positions, values):
+        """
+        Copy with the strings at positions replaced, positions past the end appended (in order). The unchanged
+        strings are copied by segments of the buffer, nothing is decoded.
+        """
+        size = len(self)
+        encoded = {position: None if is_null(value) else value.encode() for position, value in zip(positions, values)}
+        lengths = array_with_values(
+            np.diff(self.offsets), list(encoded), [len(value or b'') for value in encoded.values()])
+        nulls = array_with_values(self.nulls if self.nulls is not None else np.zeros(size, dtype=bool),
+                                  list(encoded), [value is None for value in encoded.values()])
+        pieces, start = [], 0  # start: first string of the buffer not copied yet
+        for position in sorted(encoded):
+            end = min(position, size)
+            if start < end:
+                pieces.append(self.buffer[self.offsets[start]:self.offsets[end]])
+            pieces.append(np.frombuffer(encoded[position] or b'', dtype=np.uint8))
+            start = position + 1
+        if start < size:
+            pieces.append(self.buffer[self.offsets[start]:self.offsets[size]])
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return StringColumn(
+            buffer=np.concatenate(pieces) if pieces else self.buffer.copy(),
+            offsets=offsets,
+            nulls=nulls if nulls.any() else None
+        )
+
+    def __getitem__(self, i):
+        if self.nulls is not None and self.nulls[i]:
+            return None
+        return self.buffer[self.offsets[i]:self.offsets[i + 1]].tobytes().decode()
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def to_list(self):
+        # Decoding from one bytes copy of the buffer is much faster than value by value
+        data = self.buffer.tobytes()
+        offsets = self.offsets.tolist()
+        values = [data[start:end].decode() for start, end in zip(offsets[:-1], offsets[1:])]
+        if self.nulls is not None:
+            for i in np.flatnonzero(self.nulls):
+                values[i] = None
+        return values
+
+
+class NumberColumn:
+    """
+    Numbers stored as a numpy array, None values flagged in `nulls`. Values are returned as Python scalars.
+    """
+
+    def __init__(self, values, nulls=None):
+        self.values = values
+        self.nulls = nulls
+
+    @classmethod
+    def from_series(cls, series, dtype):
+        nulls = series.isna().to_numpy()
+        return cls(
+            values=series.fillna(0).to_numpy(dtype=dtype),
+            nulls=nulls if nulls.any() else None
+        )
+
+    def to_arrays(self):
+        arrays = {'values': self.values}
+        if self.nulls is not None:
+            arrays['nulls'] = self.nulls
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(values=arrays['values'], nulls=arrays.get('nulls'))
+
+    def with_values(self, positions, values):
+        """
+        Copy with the numbers at positions replaced, positions past the end appended (in order)
+        """
+        nulls = [is_null(value) for value in values]
+        nulls = array_with_values(
+            self.nulls if self.nulls is not None else np.zeros(len(self), dtype=bool), positions, nulls)
+        return NumberColumn(
+            values=array_with_values(self.values, positions, [0 if is_null(value) else value for value in values]),
+            nulls=nulls if nulls.any() else None
+        )
+
+    def __getitem__(self, i):
+        if self.nulls is not None and self.nulls[i]:
+            return None
+        return self.values[i].item()
+
+    def __len__(self):
+        return len(self.values)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+class JsonColumn:
+    """
+    Any JSON-serializable values (e.g. lists of tags), stored as a StringColumn of their JSON
+    """
+
+    def __init__(self, strings):
+        self.strings = strings
+
+    @classmethod
+    def from_values(cls, values):
+        return cls(StringColumn.from_values([
+            None if value is None else json.dumps(value, default=lambda v: v.tolist()) for value in values
+        ]))
+
+    def to_arrays(self):
+        return self.strings.to_arrays()
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(StringColumn.from_arrays(arrays))
+
+    def with_values(self, positions, values):
+        return JsonColumn(self.strings.with_values(positions, [
+            None if is_null(value) else json.dumps(value, default=lambda v: v.tolist()) for value in values
+        ]))
+
+    def __getitem__(self, i):
+        value = self.strings[i]
+        return None if value is None else json.loads(value)
+
+    def __len__(self):
+        return len(self.strings)
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+
+COLUMN_KINDS = {'string': StringColumn, 'number': NumberColumn, 'json': JsonColumn}
+
+
+def column_to_arrays(column):
+    """
+    :return: (kind, arrays) to store a column as plain numpy arrays (see column_from_arrays)
+    """
+    if isinstance(column, np.ndarray):
+        column = JsonColumn.from_values(column)
+    kind = next(kind for kind, column_class in COLUMN_KINDS.items() if isinstance(column, column_class))
+    return kind, column.to_arrays()
+
+
+def column_from_arrays(kind, arrays):
+    return COLUMN_KINDS[kind].from_arrays(arrays)
+
+
+def column_from_series(series):
+    """
+    Compact storage for a DataFrame column: StringColumn for strings, NumberColumn for numbers,
+    the numpy object array otherwise (e.g. lists of tags)
+    """
+    kind = pd.api.types.infer_dtype(series, skipna=True)
+    if kind in ['string', 'empty']:
+        return StringColumn.from_values(series.tolist(), nulls=series.isna().to_numpy())
+    if kind == 'integer':
+        return NumberColumn.from_series(series, dtype=np.int64)
+    if kind in ['floating', 'mixed-integer-float']:
+        return NumberColumn.from_series(series, dtype=np.float64)
+    return series.to_numpy(dtype=object)
+
+
+def column_with_values(column, positions, values):
+    """
+    Copy of a column (see column_from_series) with the values at positions replaced, positions past the end
+    appended (in order)
+    """
+    if isinstance(column, np.ndarray):
+        return array_with_values(column, positions, values)
+    return column.with_values(positions, values)
+
+
+def upsert_positions(index, ids, size):
+    """
+    Positions of ids in a column of `size` values indexed by an IdIndex: the ones of the known ids, the next ones
+    past the end for the others
+    :return: (positions, new ids, their positions)
+    """
+    positions, new_ids = [], []
+    for id in ids:
+        position = index.get(id)
+        if position is None:
+            position = size + len(new_ids)
+            new_ids.append(id)
+        positions.append(position)
+    return positions, new_ids, list(range(size, size + len(new_ids)))
+
+
+class IdIndex:
+    """
+    id -> position, as a binary search over the sorted ids: 16 bytes per id instead of a dict entry and its
+    Python int objects (about 100 bytes), for about 1.5 us more per lookup (see benchmarks/bench_book_info.py).
+    Numpy arrays also stay shared with the forked matching processes (see pool.py), where the reference counts of a
+    dict would copy its pages. Duplicated ids resolve to their first position.
+    """
+
+    def __init__(self, ids):
+        ids = np.asarray(ids)
+        order = np.argsort(ids, kind='stable')
+        self.sorted_ids = ids[order]
+        self.positions = order
+
+    def to_arrays(self):
+        return {'sorted_ids': self.sorted_ids, 'positions': self.positions}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        index = cls.__new__(cls)
+        index.sorted_ids = arrays['sorted_ids']
+        index.positions = arrays['positions']
+        return index
+
+    def with_ids(self, ids, positions):
+        """
+        Copy with the new ids at positions added
+        """
+        ids = np.asarray(ids, dtype=self.sorted_ids.dtype)
+        order = np.argsort(ids, kind='stable')
+        at = np.searchsorted(self.sorted_ids, ids[order], side='right')  # After the equal ids, still resolved first
+        index = IdIndex.__new__(IdIndex)
+        index.sorted_ids = np.insert(self.sorted_ids, at, ids[order])
+        index.positions = np.insert(self.positions, at, np.asarray(positions, dtype=self.positions.dtype)[order])
+        return index
+
+    def get(self, id, default=None):
+        i = np.searchsorted(self.sorted_ids, id)
+        if i < len(self.sorted_ids) and self.sorted_ids[i] == id:
+            return int(self.positions[i])
+        return default
+
+    def __contains__(self, id):
+        return self.get(id) is not None
+
+    def __len__(self):
+        return len(self.sorted_ids)
+
+
+class IdMap(Mapping):
+    """
+    Read-only {key: value} mapping of ids, stored as two numpy arrays (see IdIndex)
+    """
+
+    def __init__(self, keys, values, index=None):
+        self.keys_array = np.asarray(keys)
+        self.values_array = np.asarray(values)
+        self.index = IdIndex(self.keys_array) if index is None else index
+
+    def to_arrays(self):
+        return {'keys': self.keys_array, 'values': self.values_array, 'index': self.index.to_arrays()}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays['keys'], arrays['values'], index=IdIndex.from_arrays(arrays['index']))
+
+    def updated(self, items):
+        """
+        Copy with the {key: value} items set
+        """
+        positions, new_keys, new_positions = upsert_positions(self.index, list(items), len(self.keys_array))
+        return IdMap(
+            array_with_values(self.keys_array, new_positions, new_keys),
+            array_with_values(self.values_array, positions, list(items.values())),
+            index=self.index.with_ids(new_keys, new_positions)
+        )
+
+    def __getitem__(self, key):
+        position = self.index.get(key)
+        if position is None:
+            raise KeyError(key)
+        return python_scalar(self.values_array[position])
+
+    def __iter__(self):
+        return (python_scalar(key) for key in self.keys_array)
+
+    def __len__(self):
+        return len(self.keys_array)
+
+
+class BookRecord(Mapping):
+    """
+    Read-only view on one row of a BookInfoIndex.
+    Behaves like the dict returned by `book_db.set_index('book_id').loc[id].to_dict()`
+    without copying anything out of the catalog.
+    """
+    __slots__ = ('_index', '_row')
+
+    def __init__(self, index, row):
+        self._index = index
+        self._row = row
+
+    def __getitem__(self, key):
+        return self._index.columns[key][self._row]
+
+    def __iter__(self):
+        return iter(self._index.columns)
+
+    def __len__(self):
+        return len(self._index.columns)
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def to_dict(self):
+        return {column: values[self._row] for column, values in self._index.columns.items()}
+
+
+class BookInfoIndex:
+    """
+    book_id -> info index, built once from the book db.
+    Columns are stored columnar and compact (see column_from_series) and a lookup only resolves the row number.
+    """
+
+    def __init__(self, df, key='book_id'):
+        self.key = key
+        self.ids = df[key].to_numpy()
+        self.columns = {column: column_from_series(df[column]) for column in df.columns if column != key}
+        self.rows = IdIndex(self.ids)
+
+    def to_arrays(self):
+        """
+        :return: (column kinds, arrays), see from_arrays
+        """
+        kinds, columns = {}, {}
+        for name, column in self.columns.items():
+            kinds[name], columns[name] = column_to_arrays(column)
+        return kinds, {'ids': self.ids, 'rows': self.rows.to_arrays(), 'columns': columns}
+
+    @classmethod
+    def from_arrays(cls, kinds, arrays, key='book_id'):
+        index = cls.__new__(cls)
+        index.key = key
+        index.ids = arrays['ids']
+        index.columns = {name: column_from_arrays(kind, arrays['columns'][name]) for name, kind in kinds.items()}
+        index.rows = IdIndex.from_arrays(arrays['rows'])
+        return index
+
+    def updated(self, df):
+        """
+        Copy with the rows of df (upserted by key) set: rows of known ids are replaced in place, the others are
+        appended. Unchanged values are not copied out of their columns as Python objects.
+        :return: (BookInfoIndex, positions of the rows of df)
+        """
+        df = df.drop_duplicates(self.key, keep='last')
+        positions, new_ids, new_positions = upsert_positions(self.rows, df[self.key].tolist(), len(self.ids))
+        index = BookInfoIndex.__new__(BookInfoIndex)
+        index.key = self.key
+        index.ids = array_with_values(self.ids, new_positions, new_ids)
+        index.columns = {
+            name: column_with_values(column, positions, df[name].tolist() if name in df else [None] * len(df))
+            for name, column in self.columns.items()
+        }
+        index.rows = self.rows.with_ids(new_ids, new_positions)
+        return index, positions
+
+    def __getitem__(self, book_id):
+        row = self.rows.get(book_id)
+        if row is None:
+            raise KeyError(book_id)
+        return BookRecord(self, row)
+
+    def __contains__(self, book_id):
+        return book_id in self.rows
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get(self, book_id, default=None):
+        row = self.rows.get(book_id)
+        return default if row is None else BookRecord(self, row)
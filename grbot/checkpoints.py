@@ -0,0 +1,138 @@
+"""
+Crawl checkpoints: the timestamp of the latest post crawled on each subreddit. They are cached in memory by
+CheckpointStore and upserted subreddit by subreddit into a backend: the bot storage (BigQuery or SQLite, see
+storage.py), a local JSON file or a SQLite database.
+"""
+import json
+import logging
+import os
+import sqlite3
+
+import pandas as pd
+
+
+class StorageCheckpoints:
+    """
+    Crawl dates table of the storage (see storage.py): for BigQuery, `table_crawl_dates` upserted with a MERGE
+    (see bq.update_timestamps)
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    def load(self, subreddits):
+        return self.storage.get_last_timestamps(subreddits)
+
+    def upsert(self, timestamps):
+        self.storage.update_timestamps(
+            pd.DataFrame(list(timestamps.items()), columns=["subreddit", "crawl_timestamp"]))
+
+
+class FileCheckpoints:
+    """
+    JSON file {subreddit: timestamp}, replaced atomically at each upsert
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as file:
+            return json.load(file)
+
+    def load(self, subreddits):
+        timestamps = self.read()
+        return {sub: timestamps.get(sub, 0) for sub in subreddits}
+
+    def upsert(self, timestamps):
+        all_timestamps = self.read()
+        for sub, timestamp in timestamps.items():
+            all_timestamps[sub] = max(all_timestamps.get(sub, 0), timestamp)
+        with open(self.path + '.tmp', 'w') as file:
+            json.dump(all_timestamps, file)
+        os.replace(self.path + '.tmp', self.path)
+
+
+class SQLiteCheckpoints:
+    """
+    Table crawl_dates (subreddit PRIMARY KEY, crawl_timestamp) of a SQLite database
+    """
+
+    def __init__(self, path, table='crawl_dates'):
+        self.path = path
+        self.table = table
+        with sqlite3.connect(self.path) as connection:
+            connection.execute(
+                f"CREATE TABLE IF NOT EXISTS {self.table} (subreddit TEXT PRIMARY KEY, crawl_timestamp INTEGER)")
+
+    def load(self, subreddits):
+        with sqlite3.connect(self.path) as connection:
+            rows = connection.execute(
+                f"SELECT subreddit, crawl_timestamp FROM {self.table} "
+                f"WHERE subreddit IN ({', '.join('?' * len(subreddits))})", list(subreddits)).fetchall()
+        timestamps = dict(rows)
+        return {sub: timestamps.get(sub, 0) for sub in subreddits}
+
+    def upsert(self, timestamps):
+        with sqlite3.connect(self.path) as connection:
+            connection.executemany(
+                f"INSERT INTO {self.table} (subreddit, crawl_timestamp) VALUES (?, ?) "
+                f"ON CONFLICT(subreddit) DO UPDATE SET "
+                f"crawl_timestamp = MAX(crawl_timestamp, excluded.crawl_timestamp)",
+                [(sub, int(timestamp)) for sub, timestamp in timestamps.items()])
+
+
+class CheckpointStore:
+    """
+    Crawl timestamps by subreddit, read from the backend once and then kept in memory: only the subreddits whose
+    timestamp moved forward are written back.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.cache = {}
+
+    def timestamps(self, subreddits):
+        """
+        :return: {subreddit: crawl timestamp}, 0 for subreddits never crawled
+        """
+        missing = [sub for sub in subreddits if sub not in self.cache]
+        if missing:
+            self.cache.update(self.backend.load(missing))
+        return {sub: self.cache[sub] for sub in subreddits}
+
+    def update(self, timestamps):
+        """
+        :param timestamps: {subreddit: timestamp of the latest post crawled}
+        :return: the timestamps written, those which moved forward
+        """
+        changed = {sub: timestamp for sub, timestamp in timestamps.items() if timestamp > self.cache.get(sub, 0)}
+        if changed:
+            logging.info(f"Updating crawl timestamps with {changed}")
+            self.backend.upsert(changed)
+            self.cache.update(changed)
+        return changed
+
+    def clear(self):
+        """
+        Reads the backend again at the next call to timestamps
+        """
+        self.cache.clear()
+
+
+def from_config(config, storage):
+    """
+    :param storage: bot storage (see storage.py)
+    :return: CheckpointStore over reddit.checkpoint_backend: "storage" (default, the crawl dates table of the
+    storage), "file" or "sqlite", stored at reddit.checkpoint_path (crawl_dates.json or grbot.sqlite if null)
+    """
+    backend = config['reddit'].get('checkpoint_backend', 'storage')
+    if backend in ['storage', 'bigquery']:
+        return CheckpointStore(StorageCheckpoints(storage))
+    if backend == 'file':
+        return CheckpointStore(FileCheckpoints(config['reddit'].get('checkpoint_path') or 'crawl_dates.json'))
+    if backend == 'sqlite':
+        return CheckpointStore(SQLiteCheckpoints(config['reddit'].get('checkpoint_path') or 'grbot.sqlite'))
+    raise ValueError(f"Unknown checkpoint backend {backend}")
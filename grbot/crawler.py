@@ -0,0 +1,164 @@
+"""
+Async crawl of the subreddits: comment and submission listings of all subreddits are fetched concurrently, over one
+pooled HTTP session to the Reddit API, within its rate limit (see ratelimit.py).
+"""
+from grbot import metrics, ratelimit
+
+from types import SimpleNamespace
+import aiohttp
+import asyncio
+import logging
+import time
+
+REDDIT_URL = 'https://www.reddit.com'
+OAUTH_URL = 'https://oauth.reddit.com'
+LISTINGS = {'comments': 'comments', 'submissions': 'new'}
+
+
+class ListingPost:
+    """
+    Comment or submission of a listing, with the attributes of the praw objects used by the bot
+    """
+
+    def __init__(self, kind, data):
+        self.id = data['id']
+        self.created_utc = data['created_utc']
+        self.subreddit = SimpleNamespace(display_name=data['subreddit'])
+        self.author = SimpleNamespace(name=data['author'])
+        if kind == 't3':  # Submission (utils.is_submission checks for selftext)
+            self.selftext = data.get('selftext', '')
+        else:
+            self.body = data['body']
+
+
+class AsyncReddit:
+    """
+    Minimal async Reddit API client (script app, password grant), used as an async context manager
+    """
+
+    def __init__(self, config, max_connections=10):
+        self.creds = config['creds']
+        self.reddit_url = config['reddit'].get('reddit_url', REDDIT_URL)
+        self.oauth_url = config['reddit'].get('oauth_url', OAUTH_URL)
+        self.max_connections = max_connections
+        self.rate_limit = ratelimit.for_account(self.creds['reddit_username'])  # Shared with the praw clients
+        self.session = None
+        self.token, self.token_expires_at = None, 0.0
+        self.token_lock = asyncio.Lock()
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.max_connections),
+            headers={'User-Agent': self.creds['reddit_user_agent']})
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def authorization(self):
+        async with self.token_lock:
+            if self.token is None or time.monotonic() > self.token_expires_at:
+                async with self.session.post(
+                        f"{self.reddit_url}/api/v1/access_token",
+                        auth=aiohttp.BasicAuth(self.creds['reddit_client_id'], self.creds['reddit_client_secret']),
+                        data={'grant_type': 'password',
+                              'username': self.creds['reddit_username'],
+                              'password': self.creds['reddit_password']}) as response:
+                    response.raise_for_status()
+                    token = await response.json()
+                self.token = token['access_token']
+                self.token_expires_at = time.monotonic() + token['expires_in'] - 60
+        return {'Authorization': f"bearer {self.token}"}
+
+    async def request(self, method, path, max_attempts=5, **kwargs):
+        for attempt in range(max_attempts):
+            headers = await self.authorization()
+            await self.rate_limit.wait_async()
+            try:
+                response = await self.session.request(method, self.oauth_url + path, headers=headers, **kwargs)
+            except Exception:
+                self.rate_limit.release()
+                raise
+            async with response:
+                self.rate_limit.release(response.headers)
+                if response.status == 429:
+                    logging.info(f"Rate limited on {path}, waiting for the reset")
+                    self.rate_limit.exhaust(response.headers.get('Retry-After'))
+                    continue
+                response.raise_for_status()
+                return await response.json()
+        raise RuntimeError(f"Still rate limited on {path} after {max_attempts} attempts")
+
+    async def listing(self, path, limit, stop=None):
+        """
+        Items of a listing, newest first, following its pages of 100 items
+        :param stop: function of a post, the listing is cut at the first post for which it is True
+        """
+        posts, after = [], None
+        while len(posts) < limit:
+            params = {'limit': min(100, limit - len(posts)), 'raw_json': 1}
+            if after is not None:
+                params['after'] = after
+            data = (await self.request('GET', path, params=params))['data']
+            for child in data['children']:
+                post = ListingPost(child['kind'], child['data'])
+                if stop is not None and stop(post):
+                    return posts
+                posts.append(post)
+            after = data.get('after')
+            if not after or not data['children']:
+                break
+        return posts
+
+
+async def crawl_subreddit(reddit, sub, last_timestamp, limit, concurrent=True):
+    """
+    :return: (comments, submissions) of sub created after last_timestamp
+    """
+    requests = [reddit.listing(f"/r/{sub}/{LISTINGS[listing]}", limit,
+                               stop=lambda post: post.created_utc <= last_timestamp) for listing in LISTINGS]
+    if concurrent:
+        results = await asyncio.gather(*requests, return_exceptions=True)  # Both done before raising
+    else:
+        results = [await request for request in requests]
+    for result in results:
+        if isinstance(result, Exception):
+            raise result
+    return results
+
+
+async def crawl(config, last_timestamps, limit, concurrent=True):
+    """
+    A subreddit failing to be crawled is left out, the others are returned: its timestamp stays where it was, so its
+    posts are crawled at the next try. Its listings are left out together, as its timestamp moves forward with the
+    posts of both.
+    :param last_timestamps: {subreddit: crawl timestamp}, only posts created after it are returned
+    :param limit: max number of posts per listing
+    :param concurrent: False to fetch the listings one after the other (for comparison)
+    :return: (comments, submissions) of all subreddits
+    """
+    async with AsyncReddit(config) as reddit:
+        requests = [crawl_subreddit(reddit, sub, last_timestamp, limit, concurrent=concurrent)
+                    for sub, last_timestamp in last_timestamps.items()]
+        if concurrent:
+            results = await asyncio.gather(*requests, return_exceptions=True)
+        else:
+            results = []
+            for request in requests:
+                try:
+                    results.append(await request)
+                except Exception as e:
+                    results.append(e)
+    comments, submissions = [], []
+    for sub, result in zip(last_timestamps, results):
+        if isinstance(result, Exception):
+            logging.info(f"Crawl of {sub} failed, crawled again at the next try: {result!r}")
+            metrics.count('errors', stage='crawl')
+            continue
+        comments += result[0]
+        submissions += result[1]
+    return comments, submissions
+
+
+def crawl_subreddits(config, last_timestamps, limit):
+    return asyncio.run(crawl(config, last_timestamps, limit))
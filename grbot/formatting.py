@@ -54,7 +54,7 @@ class Formatter:
         self.score = int(best_match.raw_score)
         self.is_series = best_match.is_serie
         self.book_requested = book_requested
-        self.book_info = best_match.book.info
+        self.book_info = best_match.info
         self.reco_separators = (', ', "") if (self.total > 1) else ("", "\n>  \- ")
         self.books_recommended_info = books_recommended_info # List of dict [{'short_title': .., 'author': ..}]
 
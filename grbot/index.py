@@ -0,0 +1,327 @@
+from grbot.catalog import StringColumn
+from grbot.utils import extract_last_name
+
+from array import array
+from collections import defaultdict
+from rapidfuzz import process, fuzz
+import numpy as np
+
+VOWELS = set('aeiouy')
+
+
+def ngrams(s, n=3):
+    """
+    Set of character n-grams of s, padded with spaces so that short words and word starts count
+    """
+    s = f" {s} "
+    return {s[i:i+n] for i in range(len(s) - n + 1)}
+
+
+def initials(name):
+    """
+    Initials form of a clean author name: given names reduced to their initials, last name kept.
+    "j r r tolkien", "jrr tolkien" and "john ronald reuel tolkien" all give "jrr tolkien"
+    """
+    words = name.split()
+    if len(words) < 2:
+        return name
+    given_names = [
+        word if (len(word) <= 2 or not VOWELS.intersection(word)) else word[0]  # "jk", "jrr" are already initials
+        for word in words[:-1]
+    ]
+    return ''.join(given_names) + ' ' + words[-1]
+
+
+def best_positions(scores, limit):
+    if len(scores) <= limit:
+        return np.arange(len(scores))
+    return np.argpartition(-scores, limit)[:limit]
+
+
+class NgramIndex:
+    """
+    Inverted index of character n-grams over a list of strings, stored as CSR arrays:
+    the positions of the strings holding gram g are postings[offsets[g]:offsets[g+1]].
+    Used to shortlist fuzzy matching candidates before scoring them.
+    """
+
+    def __init__(self, strings, n=3):
+        self.n = n
+        self.gram_ids = {}
+        gram_list, position_list = array('i'), array('i')
+        sizes = np.zeros(len(strings), dtype=np.int32)
+        for position, s in enumerate(strings):
+            grams = ngrams(s, n)
+            sizes[position] = len(grams)
+            for gram in grams:
+                gram_list.append(self.gram_ids.setdefault(gram, len(self.gram_ids)))
+                position_list.append(position)
+        gram_list = np.frombuffer(gram_list, dtype=np.int32)
+        order = np.argsort(gram_list, kind='stable')
+        self.postings = np.frombuffer(position_list, dtype=np.int32)[order]
+        self.offsets = np.zeros(len(self.gram_ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(gram_list, minlength=len(self.gram_ids)), out=self.offsets[1:])
+        self.sizes = sizes
+
+    def to_arrays(self):
+        return {
+            'grams': StringColumn.from_values(list(self.gram_ids.keys())).to_arrays(),
+            'offsets': self.offsets,
+            'postings': self.postings,
+            'sizes': self.sizes,
+            'n': np.array(self.n)
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        index = cls.__new__(cls)
+        index.n = int(arrays['n'])
+        index.gram_ids = {gram: i for i, gram in enumerate(StringColumn.from_arrays(arrays['grams']))}
+        index.offsets = arrays['offsets']
+        index.postings = arrays['postings']
+        index.sizes = arrays['sizes']
+        return index
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def similarity(self, s):
+        """
+        n-gram similarity between s and all the indexed strings: shared grams / (grams of s + grams of the string),
+        the string grams being capped to the ones of s so that titles starting with s are not penalized
+        """
+        grams = [self.gram_ids[gram] for gram in ngrams(s, self.n) if gram in self.gram_ids]
+        if not grams:
+            return np.zeros(len(self), dtype=np.float32)
+        shared = np.bincount(
+            np.concatenate([self.postings[self.offsets[g]:self.offsets[g + 1]] for g in grams]),
+            minlength=len(self)
+        )
+        n_grams = len(ngrams(s, self.n))
+        return (shared / (n_grams + np.minimum(self.sizes, n_grams))).astype(np.float32)
+
+    def closest(self, s, limit):
+        """
+        Sparse shortlist, only touching the postings of the grams of s. Strings are ranked by Dice coefficient
+        (no cap on their grams), so that exact matches come first.
+        :return: sorted positions of the (at most) `limit` strings closest to s
+        """
+        grams = [self.gram_ids[gram] for gram in ngrams(s, self.n) if gram in self.gram_ids]
+        if not grams:
+            return np.zeros(0, dtype=np.int64)
+        positions, shared = np.unique(
+            np.concatenate([self.postings[self.offsets[g]:self.offsets[g + 1]] for g in grams]),
+            return_counts=True
+        )
+        scores = 2 * shared / (len(ngrams(s, self.n)) + self.sizes[positions])
+        return np.sort(positions[best_positions(scores, limit)])
+
+    def shortlist(self, s, limit, top=None):
+        """
+        :param s: searched string
+        :param limit: number of candidates to keep
+        :param top: also keep the `limit` best candidates among the first `top` strings (popularity tier), or among
+        the first strings of each tier of a list
+        :return: sorted positions of the candidates
+        """
+        scores = self.similarity(s)
+        candidates = [best_positions(scores, limit)]
+        for end in ([top] if np.isscalar(top) else top or []):
+            if end:
+                candidates.append(best_positions(scores[:end], limit))
+        return np.unique(np.concatenate(candidates))
+
+
+class Buckets:
+    """
+    Positions grouped by key, stored as CSR arrays: the positions of the i-th key are
+    positions[offsets[i]:offsets[i+1]]. The key -> i dict is only built if looked up by key.
+    """
+
+    def __init__(self, keys, offsets, positions):
+        self.keys = keys
+        self.offsets = offsets
+        self.positions = positions
+        self._key_ids = None
+
+    @classmethod
+    def from_dict(cls, dic):
+        offsets = np.zeros(len(dic) + 1, dtype=np.int64)
+        np.cumsum([len(positions) for positions in dic.values()], out=offsets[1:])
+        positions = np.fromiter((p for positions in dic.values() for p in positions), dtype=np.int64, count=offsets[-1])
+        return cls(list(dic.keys()), offsets, positions)
+
+    def to_arrays(self):
+        return {
+            'keys': StringColumn.from_values(list(self.keys)).to_arrays(),
+            'offsets': self.offsets,
+            'positions': self.positions
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(StringColumn.from_arrays(arrays['keys']), arrays['offsets'], arrays['positions'])
+
+    def __getitem__(self, i):
+        return self.positions[self.offsets[i]:self.offsets[i + 1]]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def get(self, key):
+        if self._key_ids is None:
+            self._key_ids = {k: i for i, k in enumerate(self.keys)}
+        i = self._key_ids.get(key)
+        return None if i is None else self[i]
+
+
+class AuthorIndex:
+    """
+    Positions of the books of a search list by author, for "title by author" queries.
+    Authors are bucketed by last name (and by initials form), with n-gram indexes over the bucket keys and the full
+    names so that the closest authors are found without scanning all of them.
+    """
+
+    def __init__(self, clean_authors, shortlist_size=200):
+        self.shortlist_size = shortlist_size
+        by_last_name, by_initials, by_full_name = defaultdict(list), defaultdict(list), defaultdict(list)
+        for position, author in enumerate(clean_authors):
+            by_last_name[extract_last_name(author)].append(position)
+            by_initials[initials(author)].append(position)
+            by_full_name[author].append(position)
+
+        self.by_last_name = Buckets.from_dict(by_last_name)
+        self.last_names_ngrams = NgramIndex(self.by_last_name.keys)
+
+        self.by_initials = Buckets.from_dict(by_initials)
+
+        self.by_full_name = Buckets.from_dict(by_full_name)
+        self.full_names_ngrams = NgramIndex(self.by_full_name.keys)
+
+    def to_arrays(self):
+        return {
+            'shortlist_size': np.array(self.shortlist_size),
+            'by_last_name': self.by_last_name.to_arrays(),
+            'last_names_ngrams': self.last_names_ngrams.to_arrays(),
+            'by_initials': self.by_initials.to_arrays(),
+            'by_full_name': self.by_full_name.to_arrays(),
+            'full_names_ngrams': self.full_names_ngrams.to_arrays()
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        index = cls.__new__(cls)
+        index.shortlist_size = int(arrays['shortlist_size'])
+        index.by_last_name = Buckets.from_arrays(arrays['by_last_name'])
+        index.last_names_ngrams = NgramIndex.from_arrays(arrays['last_names_ngrams'])
+        index.by_initials = Buckets.from_arrays(arrays['by_initials'])
+        index.by_full_name = Buckets.from_arrays(arrays['by_full_name'])
+        index.full_names_ngrams = NgramIndex.from_arrays(arrays['full_names_ngrams'])
+        return index
+
+    def closest_keys(self, name, keys, ngram_index, scorer, limit, min_ratio):
+        """
+        Positions (in keys) of the `limit` keys closest to name, scoring above min_ratio.
+        Only the keys shortlisted by ngram_index are scored, in their original order so that ties are settled
+        like a process.extract over all keys.
+        """
+        shortlist = ngram_index.closest(name, self.shortlist_size)
+        return [
+            shortlist[result[2]] for result in process.extract(
+                name,
+                [keys[i] for i in shortlist],
+                scorer=scorer,
+                limit=limit,
+                score_cutoff=min_ratio)
+            if result[1] > min_ratio
+        ]
+
+    def closest(self, author, limit=5, min_ratio=85):
+        """
+        Books of the authors closest to the one requested:
+        1) authors whose last name is among the `limit` closest to the requested one
+        2) plus authors with the same initials form ("jk rowling" for "j k rowling")
+        3) if none, authors whose full name is among the `limit` closest to the requested one
+        :return: positions in the search list, grouped by author
+        """
+        buckets = [
+            self.by_last_name[i] for i in self.closest_keys(
+                author.split(' ')[-1], self.by_last_name.keys, self.last_names_ngrams, fuzz.ratio, limit, min_ratio)
+        ]
+        same_initials = self.by_initials.get(initials(author))
+        if same_initials is not None:
+            buckets.append(same_initials)
+        if not buckets:
+            buckets = [
+                self.by_full_name[i] for i in self.closest_keys(
+                    author, self.by_full_name.keys, self.full_names_ngrams, fuzz.token_set_ratio, limit, min_ratio)
+            ]
+        if not buckets:
+            return np.zeros(0, dtype=np.int64)
+        positions = np.concatenate(buckets)
+        _, first = np.unique(positions, return_index=True)
+        return positions[np.sort(first)]
+
+
+class NgramIndexDelta:
+    """
+    NgramIndex of a list of strings changed since it was built: the strings changed or added since (at most a
+    refresh worth of them) are indexed apart, in a small NgramIndex whose similarities override the ones of the base
+    index. Stacked deltas are merged, so the base index is never rebuilt until the next full load.
+    """
+
+    def __init__(self, base, strings):
+        """
+        :param base: NgramIndex (or NgramIndexDelta) of the list before the changes
+        :param strings: {position: string} changed or added, positions past the end of base being appended
+        """
+        if isinstance(base, NgramIndexDelta):
+            strings = {**base.strings, **strings}
+            base = base.base
+        self.base = base
+        self.n = base.n
+        self.strings = strings
+        self.positions = np.array(sorted(strings), dtype=np.int64)
+        self.delta = NgramIndex([strings[position] for position in self.positions], n=base.n)
+        self.size = max(len(base), int(self.positions[-1]) + 1 if len(self.positions) else 0)
+
+    def __len__(self):
+        return self.size
+
+    def similarity(self, s):
+        scores = np.zeros(len(self), dtype=np.float32)
+        scores[:len(self.base)] = self.base.similarity(s)
+        scores[self.positions] = self.delta.similarity(s)
+        return scores
+
+    shortlist = NgramIndex.shortlist
+
+
+class AuthorIndexDelta:
+    """
+    AuthorIndex of a search list changed since it was built: the books whose author changed or that were added
+    since are indexed apart, in a small AuthorIndex, and left out of the results of the base index
+    """
+
+    def __init__(self, base, clean_authors):
+        """
+        :param base: AuthorIndex (or AuthorIndexDelta) of the list before the changes
+        :param clean_authors: {position: clean author} changed or added
+        """
+        if isinstance(base, AuthorIndexDelta):
+            clean_authors = {**base.clean_authors, **clean_authors}
+            base = base.base
+        self.base = base
+        self.clean_authors = clean_authors
+        self.positions = np.array(sorted(clean_authors), dtype=np.int64)
+        self.delta = AuthorIndex([clean_authors[position] for position in self.positions])
+
+    def closest(self, author, limit=5, min_ratio=85):
+        """
+        :return: positions in the search list, the ones of the base index first
+        """
+        positions = self.base.closest(author, limit=limit, min_ratio=min_ratio)
+        return np.concatenate([
+            positions[~np.isin(positions, self.positions)],
+            self.positions[self.delta.closest(author, limit=limit, min_ratio=min_ratio)]
+        ])
@@ -0,0 +1,98 @@
+"""
+Book info fetched from the storage (see storage.py), for the books not held in memory by a Matcher: ids are
+resolved in batches, one query for many books or series, and kept in a bounded cache shared by all the callers.
+"""
+from grbot.cache import LRUCache
+from grbot.configurator import config
+from grbot.storage import clean_info, from_config
+
+import logging
+
+MISSING = object()
+
+
+class BookInfoLoader:
+
+    def __init__(self, storage=None, series_id_to_book_id=None, maxsize=10000, ttl=3600):
+        """
+        :param storage: storage to query (see storage.py), opened from the config on first use if None
+        :param series_id_to_book_id: in-memory {series id: first book id} (see Matcher.find_series_first_book),
+        the storage is queried for the series missing from it
+        :param maxsize: max number of books and series cached, 0 disables the cache
+        :param ttl: time to live of the cached info in seconds
+        """
+        self.storage = storage
+        self.series_id_to_book_id = series_id_to_book_id
+        self.books = LRUCache(maxsize=maxsize, ttl=ttl, name="Book info cache")
+        self.series = LRUCache(maxsize=maxsize, ttl=ttl, name="Series first book cache")
+
+    def db(self):
+        if self.storage is None:
+            self.storage = from_config(config)
+        return self.storage
+
+    def get_info(self, book_ids):
+        """
+        :return: {book id: info dict (columns renamed as in the Matcher catalog)}, for the books found
+        """
+        book_ids = list(dict.fromkeys(book_ids))
+        info = {book_id: self.books.get(book_id, MISSING) for book_id in book_ids}
+        missing = [book_id for book_id, book_info in info.items() if book_info is MISSING]
+        if missing:
+            logging.info(f"Fetching the info of {len(missing)} books")
+            fetched = self.db().get_info(missing) or {}
+            for book_id in missing:
+                info[book_id] = clean_info(fetched[book_id]) if book_id in fetched else None
+                self.books.put(book_id, info[book_id])  # None for books not found, so that they are not queried again
+        return {book_id: book_info for book_id, book_info in info.items() if book_info is not None}
+
+    def first_book_ids(self, series_ids):
+        """
+        :return: {series id: id of its first book}, for the series found
+        """
+        series_ids = list(dict.fromkeys(series_ids))
+        first_books, missing = {}, []
+        for series_id in series_ids:
+            book_id = MISSING
+            if self.series_id_to_book_id is not None:
+                book_id = self.series_id_to_book_id.get(series_id, MISSING)
+            if book_id is MISSING:
+                book_id = self.series.get(series_id, MISSING)
+            if book_id is MISSING:
+                missing.append(series_id)
+            else:
+                first_books[series_id] = book_id
+        if missing:
+            logging.info(f"Fetching the first book of {len(missing)} series")
+            fetched = self.db().book_ids_from_series_ids(missing)
+            for series_id in missing:
+                first_books[series_id] = fetched.get(series_id)
+                self.series.put(series_id, first_books[series_id])
+        return {series_id: book_id for series_id, book_id in first_books.items() if book_id is not None}
+
+    def get_series_info(self, series_ids):
+        """
+        :return: {series id: info dict of its first book}, for the series found
+        """
+        first_books = self.first_book_ids(series_ids)
+        info = self.get_info(first_books.values())
+        return {series_id: info[book_id] for series_id, book_id in first_books.items() if book_id in info}
+
+    def log_stats(self):
+        self.books.log_stats()
+        self.series.log_stats()
+
+
+shared_loader = None
+
+
+def get_loader():
+    """
+    :return: BookInfoLoader shared by the process, sized by matching.info_cache_size / info_cache_ttl
+    """
+    global shared_loader
+    if shared_loader is None:
+        shared_loader = BookInfoLoader(
+            maxsize=config['matching'].get('info_cache_size', 10000),
+            ttl=config['matching'].get('info_cache_ttl', 3600))
+    return shared_loader
@@ -1,14 +1,55 @@
 from grbot.configurator import config
 from grbot.utils import alphanumeric, extract_last_name, load_pickle, clean_start
-from grbot import bq
-
-from collections import defaultdict
-from rapidfuzz import process, fuzz
+from grbot.catalog import (BookInfoIndex, IdIndex, IdMap, NumberColumn, StringColumn, array_with_values,
+                           python_scalar, upsert_positions)
+from grbot.index import NgramIndex, NgramIndexDelta, AuthorIndex, AuthorIndexDelta
+from grbot.reco import Embeddings, NeighbourTable
+from grbot.cache import LRUCache
+from grbot.info import get_loader as info_loader
+from grbot import metrics, snapshot, storage
+
+from collections.abc import Sequence
+from contextlib import contextmanager
+from rapidfuzz import process
+from rapidfuzz.distance import LCSseq
 import logging
 import numpy as np
+import os
+import pandas as pd
+import threading
+import time
 
 START_WORDS_TO_EXCLUDE = ['the ', 'a ', 'an ']
 
+def ratio_from_lcs(lcs, len_searched, len_choices):
+    """
+    fuzz.ratio computed from LCS lengths, with the exact same float formula as rapidfuzz
+    :param lcs: array of LCS lengths between the searched string and the choices
+    :param len_searched: length of the searched string
+    :param len_choices: array of lengths of the choices
+    :return: array of scores (/100)
+    """
+    lensum = len_searched + len_choices
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(lensum > 0, (1.0 - (lensum - 2 * lcs) / lensum) * 100, 100.0)
+
+def tier_name(fraction):
+    return 'all' if fraction >= 1 else f"top{fraction * 100:g}%"
+
+def strip_series(title):
+    return title[0:-7] if title[-7:] == ' series' else title
+
+def top_k(scores, k):
+    """
+    Positions of the k best scores, ordered like process.extract (best first, then first in list)
+    """
+    if len(scores) <= k:
+        candidates = np.arange(len(scores))
+    else:
+        threshold = np.partition(scores, len(scores) - k)[len(scores) - k]
+        candidates = np.flatnonzero(scores >= threshold)
+    return candidates[np.lexsort((candidates, -scores[candidates]))][:k]
+
 class Query:
 
     def __init__(self, query):
@@ -28,41 +69,117 @@ class Queries:
         queries = [Query(book) for book in self.books_requested]
         return any([(not query.has_by) for query in queries])
 
-class Book:
-    def __init__(self, book_id, title=None, author=None, is_series=False):
-        self.id = book_id
-
-        self.title = title
-        self.clean_title = clean_start(
-            s=alphanumeric(str.lower(self.title)),
-            words_to_exclude=START_WORDS_TO_EXCLUDE
-        )
-        self.lateralized_title = ""
-        self.short_title = ""
+def clean_title(title):
+    return clean_start(
+        s=alphanumeric(str.lower(title)),
+        words_to_exclude=START_WORDS_TO_EXCLUDE
+    )
 
-        self.author = author
-        self.clean_author = alphanumeric(str.lower(self.author))
-        self.clean_author_last_name = extract_last_name(self.clean_author)
+def clean_author(author):
+    return alphanumeric(str.lower(author))
 
+class Book:
+    """
+    Light view on one book (or series) of a BookList, nothing is copied out of its arrays
+    """
+    __slots__ = ('book_list', 'position')
+
+    def __init__(self, book_list, position):
+        self.book_list = book_list
+        self.position = position
+
+    @property
+    def id(self):
+        return python_scalar(self.book_list.ids[self.position])
+
+    @property
+    def title(self):
+        return self.book_list.titles[self.position]
+
+    @property
+    def clean_title(self):
+        return self.book_list.clean_titles[self.position]
+
+    @property
+    def author(self):
+        return self.book_list.authors[self.position]
+
+    @property
+    def clean_author(self):
+        return clean_author(self.author)
+
+    @property
+    def clean_author_last_name(self):
+        return extract_last_name(self.clean_author)
+
+    @property
+    def is_series(self):
+        return self.book_list.is_series
+
+class BookList(Sequence):
+    """
+    Columnar list of books (or series) to match titles against: ids in a numpy array, titles and authors in
+    StringColumns, only the clean titles (the fuzzy matching choices) are kept as Python strings.
+    Items are Book views, built on access.
+    """
+
+    def __init__(self, ids, titles, authors, is_series=False, clean_titles=None, lengths=None):
+        self.ids = np.asarray(ids)
+        self.titles = titles if isinstance(titles, StringColumn) else StringColumn.from_values(list(titles))
+        self.authors = authors if isinstance(authors, StringColumn) else StringColumn.from_values(list(authors))
         self.is_series = is_series
-        self.info = {}
+        self._clean_titles = [clean_title(title) for title in self.titles] if clean_titles is None else clean_titles
+        self.lengths = np.array([len(title) for title in self._clean_titles], dtype=np.int32) \
+            if lengths is None else lengths
+
+    @property
+    def clean_titles(self):
+        # rapidfuzz needs Python strings: the ones of a snapshot are only materialized on first use
+        if not isinstance(self._clean_titles, list):
+            self._clean_titles = self._clean_titles.to_list()
+        return self._clean_titles
+
+    def to_arrays(self, with_names=True):
+        arrays = {
+            'ids': self.ids,
+            'clean_titles': StringColumn.from_values(self.clean_titles).to_arrays(),
+            'lengths': self.lengths,
+            'is_series': np.array(self.is_series)
+        }
+        if with_names:
+            arrays['titles'] = self.titles.to_arrays()
+            arrays['authors'] = self.authors.to_arrays()
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays, titles=None, authors=None):
+        return cls(
+            ids=arrays['ids'],
+            titles=StringColumn.from_arrays(arrays['titles']) if titles is None else titles,
+            authors=StringColumn.from_arrays(arrays['authors']) if authors is None else authors,
+            is_series=bool(arrays['is_series']),
+            clean_titles=StringColumn.from_arrays(arrays['clean_titles']),
+            lengths=arrays['lengths']
+        )
 
-    def lateralize_title(self, until):
-        self.lateralized_title = self.clean_title.ljust(until, '#')
-        return self
+    def updated(self, positions, new_titles, ids, titles, authors):
+        """
+        Copy with the titles at positions replaced, positions past the end appended
+        :param new_titles: titles at positions
+        :param ids, titles, authors: ids, titles and authors of the whole updated list
+        """
+        clean_titles = list(self.clean_titles)
+        clean_titles += [None] * (len(ids) - len(clean_titles))
+        for position, title in zip(positions, new_titles):
+            clean_titles[position] = clean_title(title)
+        lengths = array_with_values(self.lengths, positions, [len(clean_titles[position]) for position in positions])
+        return BookList(ids, titles, authors, is_series=self.is_series, clean_titles=clean_titles, lengths=lengths)
 
-    def shorten_title(self, at):
-        self.short_title = self.clean_title[0:at]
-        return self
+    def __getitem__(self, position):
+        return Book(self, position)
 
-    def get_info(self):
-        if self.is_series:
-            self.info = bq.get_info(
-                bq.book_id_from_series_id([self.id])
-            )
-        else:
-            self.info = bq.get_info([self.id])
-        return self
+    def __len__(self):
+        return len(self.ids)
 
 
 class Match:
@@ -70,6 +187,7 @@ class Match:
         self.is_serie = is_serie
         self.title_was_shortened = title_was_shortened
         self.book = book
+        self.info = {}
         self.raw_score = fuzz_score
         self.score = None
 
@@ -85,63 +203,411 @@ class Match:
             score -= 1
         if self.title_was_shortened:
             score -= 5
-        if self.book.info['ratings_count'] >= 100000:
+        if self.info['ratings_count'] >= 100000:
             score += 6
         self.score = score
         return self
 
 
-class Matcher:
+class CatalogVersion:
+    """
+    Everything the Matcher reads from the catalog, swapped as a whole (see Matcher.swap). A version is not modified
+    once swapped in: refreshes build a new one, sharing the unchanged parts, so queries in flight keep reading the
+    version they started on.
+    """
+    FIELDS = ('catalog_version', 'base_version', 'watermarks', 'w2v', 'series_id_to_book_id', 'book_info',
+              'books_titles', 'series_titles', 'books_by_author', 'series_by_author', 'books_ngrams', 'series_ngrams',
+              'neighbours', 'changes')
 
-    def __init__(self, config=config):
+    def __init__(self, **fields):
+        """
+        :param catalog_version: id of the version, in the cache keys
+        :param base_version: catalog_version of the snapshot the version derives from, None if loaded from the dbs
+        :param watermarks: {'books': .., 'series': ..} highest matching.catalog_watermark_column of the dim tables
+        :param changes: changes applied since the catalog was loaded in full, oldest first: ((previous version,
+        version, changed books, changed series), ..), replayed by the processes of a MatcherPool (see pool.py)
+        """
+        for name in self.FIELDS:
+            setattr(self, name, fields.get(name))
+
+    def replace(self, **fields):
+        return CatalogVersion(**{**{name: getattr(self, name) for name in self.FIELDS}, **fields})
 
-        # Matching data:
-        self.w2v = load_pickle(config['reco']['w2v_path'])
 
-        self.book_db = bq.download_book_db(local_path=config['bq']['local_path_dim_books'])
-        self.series_db = bq.download_series_db(local_path=config['bq']['local_path_dim_series'])
+def new_catalog_version(previous=None):
+    version = int(time.time() * 1000)
+    return version if previous is None else max(version, previous + 1)
 
-        self.series_id_to_book_id = self.find_series_first_book()
 
-        self.books_titles = self.init_book_list()
-        self.series_titles = self.init_series_list()
+class Matcher:
 
-        self.books_by_author = self.init_book_list_by_author(is_serie=False)
-        self.series_by_author = self.init_book_list_by_author(is_serie=True)
+    def __init__(self, config=config, use_snapshot=True, storage=None):
+        """
+        :param storage: storage of the dim tables (see storage.py), opened from the config if needed
+        """
+        self.storage = storage
+        self.use_snapshot = use_snapshot
+        # Snapshot files checked against their sha256 before being opened (reads them whole)
+        self.snapshot_verify = config['matching'].get('snapshot_verify', False)
+        self.local = threading.local()  # Catalog version pinned by the thread (see pinned)
+        self.refresh_lock = threading.Lock()
 
         self.min_ratio = config['matching']['min_ratio']
         self.author_min_ratio = config['matching']['author_min_ratio']
+        self.batch_queries = config['matching'].get('batch_queries', True)
+        self.workers = config['matching'].get('workers', -1)
+
+        # Popularity tiers of the search lists (fractions, most popular first), searched in turn until one holds a
+        # valid match
+        self.popularity_tiers = sorted({
+            fraction for fraction in config['matching'].get('popularity_tiers', [0.1, 1.0]) if 0 < fraction < 1
+        }) + [1.0]
+        # Queries reaching / settled by each tier: {(search list, tier): [reached, settled]}
+        self.tier_stats = {}
+        self.tier_stats_lock = threading.Lock()
+
+        # Candidates shortlisted by the n-gram indexes before fuzzy scoring (0 to scan the whole lists)
+        self.ngram_candidates = config['matching'].get('ngram_candidates', 0)
+
+        # Column of the dim tables set when a row is written, to refresh only the rows changed since the last load
+        # (None to only reload rebuilt snapshots)
+        self.watermark_column = config['matching'].get('catalog_watermark_column')
+
+        # Number of recommendations precomputed per book (0 to search them at reply time)
+        self.precomputed_neighbours = config['reco'].get('precomputed_neighbours', 0)
+        # Embeddings kept as 'float16' or 'int8' instead of float32 (None)
+        self.quantization = config['reco'].get('quantization')
+
+        # Best match by (catalog version, normalized query), so that repeated queries skip matching
+        self.cache = LRUCache(
+            maxsize=config['matching'].get('cache_size', 10000),
+            ttl=config['matching'].get('cache_ttl', 86400),
+            name="Match cache")
+
+        self.load_catalog(config, use_snapshot=use_snapshot)
+
+    def __getattr__(self, name):
+        # Catalog data, from the version pinned by the thread if any
+        if name in CatalogVersion.FIELDS:
+            return getattr(self.current_catalog(), name)
+        raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+
+    def current_catalog(self):
+        return getattr(self.local, 'catalog', None) or self.catalog
+
+    @contextmanager
+    def pinned(self, catalog=None):
+        """
+        Reads of the catalog by this thread all go to the same version inside, even if a refresh swaps a new one in
+        meanwhile. Nested calls keep the outer version.
+        :param catalog: version to pin, the current one if None
+        """
+        previous = getattr(self.local, 'catalog', None)
+        self.local.catalog = previous or catalog or self.catalog
+        try:
+            yield self.local.catalog
+        finally:
+            self.local.catalog = previous
 
-        # Result
-
-        self.query = None
-        self.possible_matches = [] # List of Match
-        self.result = None         # Book
-
-    def init_book_list(self):
-        return [Book(book_id, title, author) for book_id, title, author in zip(
-            self.book_db['book_id'], self.book_db['book_title'], self.book_db['author']
-        )]
-
-    def init_series_list(self):
-        return [Book(series_id, title, author, is_series=True) for series_id, title, author in zip(
-            self.series_db['series_id'], self.series_db['series_title'], self.series_db['author']
-        )]
-
-    def init_book_list_by_author(self, is_serie=False):
-        dic = defaultdict(list)
-        for book in (self.series_titles if is_serie else self.books_titles):
-            dic[book.clean_author_last_name].append(book)
-        return dic
-
-    def find_series_first_book(self):
-        self.book_db['book_number_category'] = np.where(
-            self.book_db['book_number'].apply(lambda s: str(s).isdigit() and s != "0"), 1, np.where(
-            self.book_db['book_number'].str.contains("."), 2, np.where(
-            self.book_db['book_number'].str.contains("-"), 3, 4
+    def load_catalog(self, config=config, use_snapshot=True):
+        """
+        (Re)loads the matching data, from the prebuilt snapshot if any (see build_snapshot.py)
+        """
+        snapshot_path = config['matching'].get('snapshot_path')
+        if use_snapshot and snapshot_path and os.path.isdir(snapshot_path):
+            catalog = self.catalog_from_snapshot(snapshot_path)
+        else:
+            catalog = self.catalog_from_dbs(config)
+
+        if self.ngram_candidates and catalog.books_ngrams is None:
+            self.init_ngrams(catalog)
+        if self.precomputed_neighbours and (
+                catalog.neighbours is None or catalog.neighbours.k < self.precomputed_neighbours):
+            self.init_neighbours(catalog)
+        if self.quantization and self.embeddings(catalog).quantization != self.quantization:
+            # After the neighbours, that are precomputed with the exact float32 vectors
+            catalog.w2v = self.embeddings(catalog).quantized(self.quantization)
+
+        if info_loader().storage is None:
+            info_loader().storage = self.storage
+        self.swap(catalog)
+
+    def swap(self, catalog):
+        """
+        Makes catalog the current version. Cached matches of the previous versions are dropped.
+        """
+        self.catalog = catalog
+        # Books looked up in the storage resolve their series with the in-memory map
+        info_loader().series_id_to_book_id = catalog.series_id_to_book_id
+        self.cache.clear()
+        logging.info(f"Catalog version {catalog.catalog_version} loaded")
+
+    def catalog_from_dbs(self, config):
+        # The DataFrames are only kept during init, the catalog is then stored columnar (see catalog.py)
+        if self.storage is None:
+            self.storage = storage.from_config(config)
+        book_db = self.storage.download_book_db(local_path=config['bq']['local_path_dim_books'])
+        series_db = self.storage.download_series_db(local_path=config['bq']['local_path_dim_series'])
+
+        book_info = BookInfoIndex(book_db, key='book_id')
+        books_titles = self.init_book_list(book_info)
+        series_titles = self.init_series_list(series_db)
+        return CatalogVersion(
+            catalog_version=new_catalog_version(),
+            watermarks={'books': self.watermark(book_db), 'series': self.watermark(series_db)},
+            w2v=load_pickle(config['reco']['w2v_path']),
+            series_id_to_book_id=self.find_series_first_book(book_db),
+            book_info=book_info,
+            books_titles=books_titles,
+            series_titles=series_titles,
+            books_by_author=AuthorIndex([clean_author(author) for author in books_titles.authors]),
+            series_by_author=AuthorIndex([clean_author(author) for author in series_titles.authors])
+        )
+
+    def catalog_from_snapshot(self, path):
+        """
+        Everything is memory-mapped: nothing is read nor recomputed until used, and processes opening the same
+        snapshot share its pages
+        """
+        logging.info(f"Opening matcher snapshot {path}")
+        meta, arrays = snapshot.load(path, verify_checksums=self.snapshot_verify)
+        book_info = BookInfoIndex.from_arrays(meta['info_columns'], arrays['book_info'])
+        return CatalogVersion(
+            catalog_version=meta['catalog_version'],
+            base_version=meta['catalog_version'],
+            watermarks=meta.get('watermarks', {}),
+            w2v=Embeddings.from_arrays(arrays['embeddings']),
+            series_id_to_book_id=IdMap.from_arrays(arrays['series_id_to_book_id']),
+            book_info=book_info,
+            books_titles=BookList.from_arrays(
+                arrays['books_titles'],
+                titles=book_info.columns['book_title'],
+                authors=book_info.columns['author']),
+            series_titles=BookList.from_arrays(arrays['series_titles']),
+            books_by_author=AuthorIndex.from_arrays(arrays['books_by_author']),
+            series_by_author=AuthorIndex.from_arrays(arrays['series_by_author']),
+            books_ngrams=NgramIndex.from_arrays(arrays['books_ngrams']),
+            series_ngrams=NgramIndex.from_arrays(arrays['series_ngrams']),
+            neighbours=NeighbourTable.from_arrays(arrays['neighbours']) if 'neighbours' in arrays else None
+        )
+
+    def init_ngrams(self, catalog):
+        catalog.books_ngrams = NgramIndex(catalog.books_titles.clean_titles)
+        catalog.series_ngrams = NgramIndex(catalog.series_titles.clean_titles)
+
+    def init_neighbours(self, catalog):
+        catalog.neighbours = NeighbourTable.from_embeddings(self.embeddings(catalog), self.precomputed_neighbours)
+
+    def embeddings(self, catalog=None):
+        w2v = (catalog or self.current_catalog()).w2v
+        return w2v if isinstance(w2v, Embeddings) else Embeddings.from_keyed_vectors(w2v)
+
+    def save_snapshot(self, path, meta=None):
+        """
+        :param meta: extra metadata of the snapshot, e.g. how it was built (see build_snapshot.py)
+        """
+        with self.pinned() as catalog:
+            # Indexes updated since the load (see apply_changes) are saved whole
+            books_ngrams, series_ngrams = catalog.books_ngrams, catalog.series_ngrams
+            if not isinstance(books_ngrams, NgramIndex) or not isinstance(series_ngrams, NgramIndex):
+                books_ngrams, series_ngrams = NgramIndex(self.books_choices), NgramIndex(self.series_choices)
+            books_by_author, series_by_author = catalog.books_by_author, catalog.series_by_author
+            if not isinstance(books_by_author, AuthorIndex):
+                books_by_author = AuthorIndex([clean_author(author) for author in catalog.books_titles.authors])
+            if not isinstance(series_by_author, AuthorIndex):
+                series_by_author = AuthorIndex([clean_author(author) for author in catalog.series_titles.authors])
+            info_columns, book_info = catalog.book_info.to_arrays()
+            optional_arrays = {}
+            if catalog.neighbours is not None:
+                optional_arrays['neighbours'] = catalog.neighbours.to_arrays()
+            snapshot.save(
+                path,
+                meta={**(meta or {}), 'info_columns': info_columns, 'catalog_version': catalog.catalog_version,
+                      'watermarks': catalog.watermarks or {}},
+                arrays={
+                    **optional_arrays,
+                    'embeddings': self.embeddings(catalog).to_arrays(),
+                    'series_id_to_book_id': catalog.series_id_to_book_id.to_arrays(),
+                    'book_info': book_info,
+                    'books_titles': catalog.books_titles.to_arrays(with_names=False), # Shared with book_info
+                    'series_titles': catalog.series_titles.to_arrays(),
+                    'books_by_author': books_by_author.to_arrays(),
+                    'series_by_author': series_by_author.to_arrays(),
+                    'books_ngrams': books_ngrams.to_arrays(),
+                    'series_ngrams': series_ngrams.to_arrays()
+                }
+            )
+
+    def init_book_list(self, book_info):
+        # Titles and authors are shared with the info columns
+        return BookList(book_info.ids, book_info.columns['book_title'], book_info.columns['author'])
+
+    def init_series_list(self, series_db):
+        return BookList(series_db['series_id'], series_db['series_title'], series_db['author'], is_series=True)
+
+    # Immutable choices for fuzzy matching, with their lengths
+
+    @property
+    def books_choices(self):
+        return self.books_titles.clean_titles
+
+    @property
+    def books_lengths(self):
+        return self.books_titles.lengths
+
+    @property
+    def series_choices(self):
+        return self.series_titles.clean_titles
+
+    @property
+    def series_lengths(self):
+        return self.series_titles.lengths
+
+    def find_series_first_book(self, book_db):
+        book_db['book_number_category'] = np.where(
+            book_db['book_number'].apply(lambda s: str(s).isdigit() and s != "0"), 1, np.where(
+            book_db['book_number'].str.contains("."), 2, np.where(
+            book_db['book_number'].str.contains("-"), 3, 4
         )))
-        return self.book_db.set_index("series_id").sort_values(["book_number_category", "book_number"])\
-                           .groupby("series_id").head(1)["book_id"].to_dict()
+        first_books = book_db.sort_values(["book_number_category", "book_number"])\
+                             .groupby("series_id").head(1)
+        return IdMap(first_books['series_id'], first_books['book_id'])
+
+    # Refreshes
+
+    def watermark(self, df):
+        """
+        Highest value of the watermark column of a dim table (the rows changed since are above it), None if missing
+        """
+        if not self.watermark_column or self.watermark_column not in df.columns:
+            return None
+        values = df[self.watermark_column].dropna()
+        if values.empty:
+            return None
+        value = python_scalar(values.max())
+        return value if isinstance(value, (int, float, str)) else str(value)  # Kept in the snapshot meta (JSON)
+
+    def refresh_catalog(self, config=config):
+        """
+        Picks up the catalog changes without a restart: reloads the snapshot if it was rebuilt since (see
+        build_snapshot.py), then applies the rows of the dim tables changed since the watermarks of the current
+        version (see apply_changes). Queries in flight finish on the version they started on.
+        :return: True if a new version was swapped in
+        """
+        with self.refresh_lock:
+            swapped = False
+            snapshot_path = config['matching'].get('snapshot_path')
+            if self.use_snapshot and snapshot_path and os.path.isdir(snapshot_path) \
+                    and snapshot.load_manifest(snapshot_path)['meta'].get('catalog_version') \
+                    != self.catalog.base_version:
+                self.load_catalog(config)
+                swapped = True
+
+            watermarks = self.catalog.watermarks or {}
+            if not self.watermark_column or all(watermark is None for watermark in watermarks.values()):
+                return swapped
+            if self.storage is None:
+                self.storage = storage.from_config(config)
+            books, series = None, None
+            if watermarks.get('books') is not None:
+                books = self.storage.download_book_db_changes(watermarks['books'], self.watermark_column)
+            if watermarks.get('series') is not None:
+                series = self.storage.download_series_db_changes(watermarks['series'], self.watermark_column)
+            if (books is None or books.empty) and (series is None or series.empty):
+                return swapped
+            self.swap(self.apply_changes(self.catalog, books=books, series=series))
+            return True
+
+    def apply_changes(self, catalog, books=None, series=None, catalog_version=None):
+        """
+        New catalog version with the changed rows of the dim tables upserted. The title lists, info index and series
+        map are copied with the changed rows replaced and the new ones appended: past the top tiers, new books only
+        make the popularity tier at the next full load. The author and n-gram indexes get a delta index over the
+        changed rows (see index.py). The embeddings are kept: books added since they were trained get no
+        recommendations until then.
+        :param books: changed rows of dim_books (see storage.download_book_db_changes), None if none
+        :param series: changed rows of dim_series, None if none
+        :param catalog_version: id of the new version, a new one if None
+        """
+        catalog_version = new_catalog_version(catalog.catalog_version) if catalog_version is None else catalog_version
+        changes = {'catalog_version': catalog_version, 'watermarks': dict(catalog.watermarks or {}),
+                   'changes': (catalog.changes or ()) + ((catalog.catalog_version, catalog_version, books, series),)}
+        if books is not None and not books.empty:
+            books = books.drop_duplicates('book_id', keep='last')
+            changes.update(self.apply_books_changes(catalog, books))
+            changes['watermarks']['books'] = self.watermark(books)
+        if series is not None and not series.empty:
+            series = series.drop_duplicates('series_id', keep='last')
+            changes.update(self.apply_series_changes(catalog, series))
+            changes['watermarks']['series'] = self.watermark(series)
+        logging.info(f"Catalog changes: {0 if books is None else len(books)} books, "
+                     f"{0 if series is None else len(series)} series")
+        return catalog.replace(**changes)
+
+    def apply_books_changes(self, catalog, books):
+        book_info, positions = catalog.book_info.updated(books)
+        books_titles = catalog.books_titles.updated(
+            positions, books['book_title'].tolist(),
+            ids=book_info.ids, titles=book_info.columns['book_title'], authors=book_info.columns['author'])
+        changes = {
+            'book_info': book_info,
+            'books_titles': books_titles,
+            'books_by_author': AuthorIndexDelta(catalog.books_by_author, {
+                position: clean_author(author) for position, author in zip(positions, books['author'].tolist())})
+        }
+        if catalog.books_ngrams is not None:
+            changes['books_ngrams'] = NgramIndexDelta(
+                catalog.books_ngrams, {position: books_titles.clean_titles[position] for position in positions})
+        if 'series_id' in books.columns:
+            # Series of the changed books, before and after the change
+            series_column = catalog.book_info.columns['series_id']
+            series_ids = set(books['series_id'].dropna().tolist()) | {
+                series_column[position] for position in positions if position < len(catalog.book_info)}
+            changes['series_id_to_book_id'] = self.updated_series_map(
+                catalog.series_id_to_book_id, book_info, series_ids - {None})
+        return changes
+
+    def apply_series_changes(self, catalog, series):
+        series_titles = catalog.series_titles
+        positions, _, _ = upsert_positions(
+            IdIndex(series_titles.ids), series['series_id'].tolist(), len(series_titles))
+        titles, authors = series['series_title'].tolist(), series['author'].tolist()
+        series_titles = series_titles.updated(
+            positions, titles,
+            ids=array_with_values(series_titles.ids, positions, series['series_id'].tolist()),
+            titles=series_titles.titles.with_values(positions, titles),
+            authors=series_titles.authors.with_values(positions, authors))
+        changes = {
+            'series_titles': series_titles,
+            'series_by_author': AuthorIndexDelta(catalog.series_by_author, {
+                position: clean_author(author) for position, author in zip(positions, authors)})
+        }
+        if catalog.series_ngrams is not None:
+            changes['series_ngrams'] = NgramIndexDelta(
+                catalog.series_ngrams, {position: series_titles.clean_titles[position] for position in positions})
+        return changes
+
+    def updated_series_map(self, series_map, book_info, series_ids):
+        """
+        series_map with the first book of the series recomputed, from all their books in book_info
+        """
+        if not series_ids:
+            return series_map
+        series_ids = list(series_ids)
+        column = book_info.columns['series_id']
+        if isinstance(column, NumberColumn):
+            in_series = np.isin(column.values, series_ids)
+            if column.nulls is not None:
+                in_series &= ~column.nulls
+        else:
+            in_series = pd.Series(list(column)).isin(series_ids).to_numpy()
+        rows = np.flatnonzero(in_series)
+        first_books = self.find_series_first_book(pd.DataFrame({
+            'book_id': book_info.ids[rows],
+            'series_id': [column[row] for row in rows],
+            'book_number': [book_info.columns['book_number'][row] for row in rows]
+        }))
+        return series_map.updated(dict(first_books.items()))
 
     def recommend_books(self, title_matches, k):
         """
@@ -150,182 +616,408 @@ class Matcher:
         :param title_matches:
         :return: [ [Top k reco for title_match1], [Top k reco for title_match2], ..]
         """
-        recommendations = []
+        return self.recommendation_infos(self.recommend_ids(title_matches, k))
 
-        for title_match in title_matches:
-            book_id = title_match.book.id
+    def recommendation_infos(self, recommendations):
+        """
+        :param recommendations: [[reco book ids] for each title match], see recommend_ids
+        :return: [[reco info] for each title match], without the books found neither in the catalog nor the storage
+        """
+        with self.pinned():
+            infos = self.retrieve_infos([reco for recos in recommendations for reco in recos])
+        return [[infos[reco] for reco in recos if reco in infos] for recos in recommendations]
 
-            if book_id in self.w2v.key_to_index:
-                recommendations.append([
-                    self.retrieve_info_from_book_db(id=reco[0]) for reco in self.w2v.most_similar(book_id, topn=k)
-                ])
-            else:
-                logging.info(f"Key '{book_id}' not present in vocabulary")
-                recommendations.append([])
-                # Handle the case when the key is not present in the vocabulary, e.g., provide default recommendations
+    def recommend_ids(self, title_matches, k):
+        """
+        :return: [ [Top k reco book ids for title_match1], [Top k reco book ids for title_match2], ..]
+        """
+        with metrics.timed('recommend'), self.pinned():
+            recommendations = []
+
+            for title_match in title_matches:
+                book_id = title_match.book.id
+                neighbours = None if self.neighbours is None else self.neighbours.get(book_id, k)
 
-        return recommendations
+                if neighbours is not None:
+                    recommendations.append(neighbours)
+                elif book_id in self.w2v.key_to_index:  # Live search, for the books added since the precompute
+                    recommendations.append([reco[0] for reco in self.w2v.most_similar(book_id, topn=k)])
+                else:
+                    logging.info(f"Key '{book_id}' not present in vocabulary")
+                    recommendations.append([])
+                    # Handle the case when the key is not present in the vocabulary, e.g., provide default
+                    # recommendations
+
+            return recommendations
 
     def process_queries(self, queries):
+        if self.batch_queries:
+            return self.process_posts([queries])[0]
         return [
             self.process_one_query(query) for query in queries  # 10 matches max par post to avoid flood
         ]
 
     def process_one_query(self, query):
+        return self.process_posts([[query]])[0][0]
 
-        self.query = Query(query)
-
-        self.possible_matches = []
-        if len(self.query.clean_q) > 150:
-            return self
-
-        if self.query.has_by: # Maybe the user provided the author:
-            self.possible_matches += self.match_process_filtered_on_author(search_series=False) \
-                                     + self.match_process_filtered_on_author(search_series=True)
-            if self.has_a_valid_match():
-                return self.pick_best_match(config['matching']['draw_settle_key'])
-
-        self.possible_matches += self.match_process(title=self.query.clean_q, search_series=False) \
-                                 + self.match_process(title=self.query.clean_q, search_series=True)
-
-        best_match = self.pick_best_match(draw_settle_key='sort_n')
-
-        return best_match
-
-    def has_a_valid_match(self, matches_list=None):
-        return any([match.is_valid() for match in (self.possible_matches if matches_list is None else matches_list)])
+    def process_posts(self, posts):
+        """
+        Batched process_one_query, for all the queries of one or several posts.
+        Queries not settled by their author are scored together against the whole catalog: one multi-threaded
+        LCS matrix (rapidfuzz cdist) per search list, from which the 3 tiers of match_process are derived.
+        Nothing is stored on the Matcher nor on the catalog Books, so one Matcher can serve concurrent calls, and the
+        catalog version is pinned for the whole call (see pinned).
+        :param posts: [[query1, query2, ..] for each post]
+        :return: [[best match for query1, best match for query2, ..] for each post]
+        """
+        with self.pinned():
+            results, to_scan = [], []
+            for query in [Query(query) for post in posts for query in post]:
+                possible_matches = []
+                if len(query.clean_q) > 150:
+                    metrics.count('queries', path='too_long')
+                    results.append(self)
+                    continue
+                cached = self.cache.get((self.catalog_version, query.clean_q))
+                if cached is not None:
+                    metrics.count('queries', path='cache')
+                    results.append(self.match_from_key(cached))
+                    continue
+                if query.has_by: # Maybe the user provided the author:
+                    possible_matches += self.match_process_filtered_on_author(query, search_series=False) \
+                                        + self.match_process_filtered_on_author(query, search_series=True)
+                    if self.has_a_valid_match(possible_matches):
+                        metrics.count('queries', path='author')
+                        results.append(self.pick_best_match(possible_matches, config['matching']['draw_settle_key']))
+                        self.cache_match(query, results[-1])
+                        continue
+                metrics.count('queries', path='scan')
+                to_scan.append((len(results), query, possible_matches))
+                results.append(None)
+
+            if to_scan:
+                titles = [query.clean_q for _, query, _ in to_scan]
+                books_matches = self.scan(titles, search_series=False)
+                series_matches = self.scan(titles, search_series=True)
+                for (position, query, possible_matches), books, series in zip(to_scan, books_matches, series_matches):
+                    results[position] = self.pick_best_match(
+                        possible_matches + books + series, draw_settle_key='sort_n')
+                    self.cache_match(query, results[position])
+                self.log_tier_stats()
+            if self.cache.maxsize:
+                self.cache.log_stats()
+
+            results_by_post, start = [], 0
+            for post in posts:
+                results_by_post.append(results[start:start + len(post)])
+                start += len(post)
+            return results_by_post
+
+    def cache_match(self, query, match):
+        self.cache.put((self.catalog_version, query.clean_q), self.match_key(match))
+
+    def match_key(self, match):
+        """
+        Lightweight (is_serie, position, raw score, title_was_shortened) of a match, valid for this catalog version
+        """
+        return match.is_serie, match.book.position, match.raw_score, match.title_was_shortened
 
-    def pick_best_match(self, draw_settle_key):
-        self.possible_matches = [sorted(self.possible_matches, key=lambda match: match.score, reverse=True)[0]]
-        max_score = self.possible_matches[0].score
+    def match_from_key(self, key):
+        """
+        Fresh Match from a match_key, enriched like a computed one
+        """
+        is_serie, position, raw_score, title_was_shortened = key
+        with self.pinned():
+            search_list = self.series_titles if is_serie else self.books_titles
+            match = Match(fuzz_score=raw_score, is_serie=is_serie, book=search_list[position],
+                          title_was_shortened=title_was_shortened)
+            return self.enrich_match_list([match])[0]
+
+    def has_a_valid_match(self, matches_list):
+        return any([match.is_valid() for match in matches_list])
+
+    def pick_best_match(self, possible_matches, draw_settle_key):
+        possible_matches = [sorted(possible_matches, key=lambda match: match.score, reverse=True)[0]]
+        max_score = possible_matches[0].score
         if max_score < self.min_ratio:
-            return self.possible_matches[0]
+            return possible_matches[0]
         else:
-            best_matches = [match for match in self.possible_matches if match.score >= max_score]
+            best_matches = [match for match in possible_matches if match.score >= max_score]
             if len(best_matches) == 1:
                 return best_matches[0]
             else:
-                return sorted(best_matches, key=lambda match: match.book.info[draw_settle_key], reverse=True)[0]
+                return sorted(best_matches, key=lambda match: match.info[draw_settle_key], reverse=True)[0]
 
     def enrich_match_list(self, match_list):
         logging.info("starting enrich match list")
-        for match in match_list:
-            if match.is_serie:
-                match.book.info = self.retrieve_info_from_book_db(id=self.series_id_to_book_id[match.book.id])
-            else:
-                match.book.info = self.retrieve_info_from_book_db(id=match.book.id)
-            match.bonus_malus_score()
+        with metrics.timed('enrich'):
+            series_info = self.retrieve_series_infos([match.book.id for match in match_list if match.is_serie])
+            books_info = self.retrieve_infos([match.book.id for match in match_list if not match.is_serie])
+            for match in match_list:
+                match.info = (series_info if match.is_serie else books_info)[match.book.id]
+                match.bonus_malus_score()
         return match_list
 
     def retrieve_info_from_book_db(self, id):
-        return self.book_db.set_index('book_id').loc[id].to_dict()
-
-    def match_process_filtered_on_author(self, search_series=False):
-        title, author = self.query.clean_q.rsplit(' by ', 1)
-        last_name = author.split(' ')[-1]
-        search_book_dic = self.series_by_author if search_series else self.books_by_author
-        closest_authors = [fuzz_result[0] for fuzz_result in
-            process.extract(
-                last_name,
-                list(search_book_dic.keys()),
-                scorer=fuzz.ratio,
-                limit=5)
-            if fuzz_result[1] > self.author_min_ratio
-        ]
-        search_book_list_filtered = [
-            book for last_name in closest_authors for book in search_book_dic[last_name]
+        return self.book_info[id]
+
+    def retrieve_infos(self, book_ids):
+        """
+        :return: {book id: info} from the catalog. Books missing from it (e.g. recommended by a w2v model trained on
+        more books) are fetched from the storage in one query, through the shared cached loader (see info.py)
+        """
+        infos = {book_id: self.book_info.get(book_id) for book_id in book_ids}
+        missing = [book_id for book_id, info in infos.items() if info is None]
+        if missing:
+            infos.update(info_loader().get_info(missing))
+        return {book_id: info for book_id, info in infos.items() if info is not None}
+
+    def retrieve_series_infos(self, series_ids):
+        """
+        :return: {series id: info of its first book}. Series without a first book in the catalog are resolved by
+        the storage, like retrieve_infos
+        """
+        first_books = {series_id: self.series_id_to_book_id.get(series_id) for series_id in series_ids}
+        infos = self.retrieve_infos([book_id for book_id in first_books.values() if book_id is not None])
+        series_info = {series_id: infos[book_id] for series_id, book_id in first_books.items() if book_id in infos}
+        missing = [series_id for series_id in series_ids if series_id not in series_info]
+        if missing:
+            series_info.update(info_loader().get_series_info(missing))
+        return series_info
+
+    def match_process_filtered_on_author(self, query, search_series=False):
+        title, author = query.clean_q.rsplit(' by ', 1)
+        author_index = self.series_by_author if search_series else self.books_by_author
+        with metrics.timed('match', tier='author', list='series' if search_series else 'books'):
+            positions = author_index.closest(author, limit=5, min_ratio=self.author_min_ratio)
+        return self.match_process(title, search_series=search_series, positions=positions, k=4)
+
+    def scan(self, titles, search_series=False):
+        """
+        match_process of each title against the whole search list: tier by tier (see cascade), or only against its
+        candidates shortlisted by the n-gram index (the best `ngram_candidates` overall and in each popularity tier).
+        Candidates of all titles are scored together, in one cdist.
+        :return: [possible matches for each title]
+        """
+        list_size = len(self.series_choices if search_series else self.books_choices)
+        if not self.ngram_candidates or list_size <= self.ngram_candidates:
+            return self.cascade(titles, search_series=search_series)
+
+        index = self.series_ngrams if search_series else self.books_ngrams
+        with metrics.timed('shortlist', list='series' if search_series else 'books'):
+            shortlists = [
+                index.shortlist(
+                    strip_series(title) if search_series else title,
+                    limit=self.ngram_candidates,
+                    top=[end for _, end in self.tier_ends(list_size)[:-1]]
+                )
+                for title in titles
+            ]
+        union = np.unique(np.concatenate(shortlists))
+        lcs = self.lcs_matrix(titles, search_series=search_series, positions=union)
+        return [
+            self.match_process(title, search_series=search_series, positions=shortlist,
+                               lcs=lcs[i, np.searchsorted(union, shortlist)], list_size=list_size)
+            for i, (title, shortlist) in enumerate(zip(titles, shortlists))
         ]
-        return self.match_process(
-            title,
-            search_list=search_book_list_filtered,
-            search_series=search_series,
-            k=4,
-            func="full")
-
-    def match_process(self, title, search_list=None, search_series=False, k=4, func="full"):
-        """
-        2 steps:
-        1) search matches among Top 10% of search_list
-        2) search matches among all list AND on start of titles only
-        :param search_series:
+
+    def lcs_matrix(self, titles, search_series=False, positions=None, start=0, end=None, score_cutoff=0):
+        """
+        LCS lengths between each title and the choices of the search list (restricted to positions if given, else
+        to the choices from start to end)
+        :param score_cutoff: LCS below it are not computed, and returned as 0
+        """
+        choices = self.series_choices if search_series else self.books_choices
+        if positions is not None:
+            choices = [choices[position] for position in positions]
+        elif start or end is not None:
+            choices = choices[start:end]
+        if search_series:
+            titles = [strip_series(title) for title in titles]
+        logging.info(f"Matching {len(titles)} queries with a list of len {len(choices)}")
+        if len(choices) == 0:
+            return np.zeros((len(titles), 0), dtype=np.int32)
+        with metrics.timed('scan', list='series' if search_series else 'books'):
+            return process.cdist(titles, choices, scorer=LCSseq.similarity, dtype=np.int32, workers=self.workers,
+                                 score_cutoff=score_cutoff or None)
+
+    def tier_ends(self, size, positions=None, list_size=None):
+        """
+        Popularity tiers of the scored choices, ordered like the search list (most popular first). Lists of 1000
+        choices or less are one tier.
+        :param size: number of choices scored
+        :param positions: positions of the choices in the search list (sorted if list_size is set)
+        :param list_size: size of the list the positions were shortlisted from, None if the choices are the searched
+        list themselves
+        :return: [(tier name, end of the tier in the choices)], the last tier being all of them
+        """
+        total = size if list_size is None else list_size
+        tiers = []
+        if total > 1000:
+            for fraction in self.popularity_tiers[:-1]:
+                end = int(total * fraction)
+                # Shortlisted positions are cut where the list tier ends, other choices (e.g. filtered on author,
+                # grouped by author) at the same fraction of themselves
+                tiers.append((tier_name(fraction), end if list_size is None else int(np.searchsorted(positions, end))))
+        return tiers + [('all', size)]
+
+    def is_settled(self, matches, last_tier):
+        # Earlier tiers settle on a best score at min_ratio, like the last one past it
+        if last_tier:
+            return self.has_a_valid_match(matches)
+        return bool(matches) and max(match.score for match in matches) >= self.min_ratio
+
+    def match_process(self, title, search_series=False, positions=None, lcs=None, list_size=None, k=4):
+        """
+        Cascade over the popularity tiers of the search list (matching.popularity_tiers, e.g. top 1%, top 10% then
+        all): the first tier holding a valid match settles it. If none, matches on the start of titles only.
+        Titles are lateralized with '#' up to the searched length: '#' never matches, so only their length changes
+        and all scores derive from the LCS lengths between title and the choices.
+        :param positions: positions in the search list to restrict the search to (None for all list)
+        :param lcs: precomputed LCS lengths between title and the choices (see lcs_matrix), computed tier by tier
+        if None (see cascade)
+        :param list_size: size of the list the (sorted) positions were shortlisted from, None if the positions
+        are the searched list themselves
         :param k:
-        :param func:
         :return:
         """
-        if search_list is None:
-            search_list = self.series_titles if search_series else self.books_titles
-
-        # If not in a "filtered on author" case, we look on top 10% of books and series
-        if len(search_list) > 1000:
-            possible_matches_on_top = self._match_fuzz(
-                searched_string=title,
-                search_book_list=search_list[:int(len(search_list)*0.1)],
-                is_serie=search_series,
-                k=k,
-                func=func)
-            if max(match.score for match in possible_matches_on_top) >= config['matching']['min_ratio']:
-                return possible_matches_on_top
-
-        # Step 2:
-        results = self._match_fuzz(
-            searched_string=title,
-            search_book_list=search_list,
-            is_serie=search_series,
-            k=k, func=func
-        )
-        if self.has_a_valid_match(results):
-            return results
-        else:
-            return self.match_start_of_titles(
-            searched_string=title,
-            search_list=search_list,
-            search_series=search_series
-        )
+        if lcs is None:
+            if positions is None:
+                return self.cascade([title], search_series=search_series, k=k)[0]
+            lcs = self.lcs_matrix([title], search_series=search_series, positions=positions)[0]
+        lengths = self.series_lengths if search_series else self.books_lengths
+        if positions is not None:
+            lengths = lengths[positions]
+        searched_string = strip_series(title) if search_series else title
+        scores = ratio_from_lcs(lcs, len(searched_string), np.maximum(lengths, len(searched_string)))
+
+        search_list = 'series' if search_series else 'books'
+        tiers = self.tier_ends(len(scores), positions=positions, list_size=list_size)
+        for i, (tier, end) in enumerate(tiers):
+            with metrics.timed('match', tier=tier, list=search_list):
+                results = self.matches_from_scores(scores[:end], is_serie=search_series, positions=positions, k=k)
+            settled = self.is_settled(results, last_tier=i == len(tiers) - 1)
+            self.record_tier(search_list, tier, settled)
+            if settled:
+                return results
+        return self.start_of_titles(
+            searched_string, at=len(title), lcs=lcs, lengths=lengths, search_series=search_series, positions=positions)
+
+    def cascade(self, titles, search_series=False, k=4):
+        """
+        match_process of each title against the whole search list, tier by tier: the LCS of a tier are only computed
+        for the titles not settled by the previous ones, in one cdist. Up to the last tier, the cdist gets the k-th
+        best score so far (the lowest of the titles) as cutoff: the choices that can't make the top k of a title are
+        pruned by rapidfuzz, as reaching a score needs an LCS of at least score * len(title) / 100. The last tier
+        is scored whole, the start of titles fallback needing all the LCS: pruned ones are computed for the titles
+        falling back.
+        :return: [possible matches for each title]
+        """
+        choices = self.series_choices if search_series else self.books_choices
+        lengths = self.series_lengths if search_series else self.books_lengths
+        search_list = 'series' if search_series else 'books'
+        searched = [strip_series(title) if search_series else title for title in titles]
+        lcs = [np.zeros(0, dtype=np.int32) for _ in titles]
+        thresholds = np.zeros(len(titles))  # k-th best score so far
+        results = [None] * len(titles)
+        pruned = []  # (start, end, titles) of the tiers scored with a cutoff
+        pending, start = list(range(len(titles))), 0
+        tiers = self.tier_ends(len(choices))
+        for tier_number, (tier, end) in enumerate(tiers):
+            if not pending:
+                break
+            last_tier = tier_number == len(tiers) - 1
+            cutoff = 0 if last_tier else min(int(thresholds[i] * len(searched[i]) / 100) for i in pending)
+            block = self.lcs_matrix(
+                [titles[i] for i in pending], search_series=search_series, start=start, end=end, score_cutoff=cutoff)
+            if cutoff:
+                pruned.append((start, end, set(pending)))
+            still_pending = []
+            for row, i in enumerate(pending):
+                lcs[i] = np.concatenate([lcs[i], block[row]])
+                scores = ratio_from_lcs(lcs[i], len(searched[i]), np.maximum(lengths[:end], len(searched[i])))
+                with metrics.timed('match', tier=tier, list=search_list):
+                    matches = self.matches_from_scores(scores, is_serie=search_series, k=k)
+                settled = self.is_settled(matches, last_tier=last_tier)
+                self.record_tier(search_list, tier, settled)
+                if settled:
+                    results[i] = matches
+                    continue
+                thresholds[i] = np.partition(scores, len(scores) - k)[len(scores) - k] if len(scores) >= k else 0
+                still_pending.append(i)
+            pending, start = still_pending, end
+
+        for start, end, scored in pruned:
+            rescored = [i for i in pending if i in scored]
+            if rescored:
+                block = self.lcs_matrix(
+                    [titles[i] for i in rescored], search_series=search_series, start=start, end=end)
+                for row, i in enumerate(rescored):
+                    lcs[i][start:end] = block[row]
+        for i in pending:
+            results[i] = self.start_of_titles(
+                searched[i], at=len(titles[i]), lcs=lcs[i], lengths=lengths, search_series=search_series)
+        return results
+
+    def start_of_titles(self, searched_string, at, lcs, lengths, search_series=False, positions=None):
+        search_list = 'series' if search_series else 'books'
+        with metrics.timed('match', tier='start_of_titles', list=search_list):
+            results = self.match_start_of_titles(
+                searched_string, at=at, lcs=lcs, lengths=lengths, search_series=search_series, positions=positions)
+        self.record_tier(search_list, 'start_of_titles', self.has_a_valid_match(results))
+        return results
+
+    def match_start_of_titles(self, searched_string, at, lcs, lengths, search_series=False, positions=None, k=5):
+        """
+        Scores of searched_string vs titles shortened at `at` characters.
+        Titles not longer than `at` are not shortened, so their score is already known. For the others,
+        LCS(searched, title[:at]) <= min(LCS(searched, title), at) bounds the score: only the ones that can
+        still make the top k are shortened and scored.
+        """
+        scores = ratio_from_lcs(np.minimum(lcs, at), len(searched_string), np.minimum(lengths, at))
+        is_long = lengths > at
+        known_scores = np.where(is_long, -1.0, scores)
+        threshold = -1.0 if len(known_scores) <= k else np.partition(known_scores, len(known_scores) - k)[-k]
+        candidates = np.flatnonzero(is_long & (scores >= threshold))
+        if len(candidates) > 0:
+            choices = self.series_choices if search_series else self.books_choices
+            shortened = [
+                choices[i if positions is None else positions[i]][0:at] for i in candidates
+            ]
+            candidates_lcs = process.cdist(
+                [searched_string], shortened, scorer=LCSseq.similarity, dtype=np.int32, workers=self.workers)[0]
+            known_scores[candidates] = ratio_from_lcs(candidates_lcs, len(searched_string), at)
+        return self.matches_from_scores(
+            known_scores, is_serie=search_series, positions=positions, k=k, title_was_shortened=True)
 
-    def match_start_of_titles(self, searched_string, search_list=None, search_series=False):
-        return self._match_fuzz(
-            searched_string=searched_string,
-            search_book_list=[book.shorten_title(at=len(searched_string)) for book in search_list],
-            search_attribute = "short_title",
-            is_serie=search_series,
-            title_was_shortened = True,
-            func='full',
-            lateralize=False,
-            k=5)
-
-    def _match_fuzz(
-        self,
-        searched_string,
-        search_book_list,
-        is_serie,
-        title_was_shortened=False,
-        k=3,
-        search_attribute='clean_title',
-        func="partial",
-        lateralize=True,
-    ):
-        scorer = fuzz.partial_ratio
-        if is_serie and searched_string[-7:] == ' series':
-            searched_string = searched_string[0:-7]
-        if func != "partial":
-            scorer = fuzz.ratio
-        if lateralize:
-            search_book_list = [book.lateralize_title(until=len(searched_string)) for book in search_book_list]
-            search_attribute = "lateralized_title"
-        logging.info(f"Matching {searched_string} with a list of len {len(search_book_list)}")
+    def record_tier(self, search_list, tier, settled):
+        """
+        Counts the queries reaching a tier and the ones it settles, for its hit rate
+        """
+        with self.tier_stats_lock:
+            stats = self.tier_stats.setdefault((search_list, tier), [0, 0])
+            stats[0] += 1
+            stats[1] += settled
+        metrics.count('tier_queries', list=search_list, tier=tier)
+        if settled:
+            metrics.count('matches', list=search_list, tier=tier)
+
+    def log_tier_stats(self):
+        with self.tier_stats_lock:
+            stats = sorted(self.tier_stats.items())
+        logging.info("Popularity tiers: " + ", ".join(
+            f"{search_list} {tier} {settled}/{reached} ({settled / reached:.1%})"
+            for (search_list, tier), (reached, settled) in stats))
+
+    def matches_from_scores(self, scores, is_serie, positions=None, k=4, title_was_shortened=False):
+        search_list = self.series_titles if is_serie else self.books_titles
         matches = [
             Match(
-                fuzz_score=result[1],
+                fuzz_score=float(scores[i]),
                 is_serie=is_serie,
                 title_was_shortened=title_was_shortened,
-                book=search_book_list[result[2]]
+                book=search_list[i if positions is None else positions[i]]
             )
-            for result in process.extract(
-                searched_string,
-                [getattr(book, search_attribute) for book in search_book_list],
-                scorer=scorer,
-                limit=k)
-            ]
+            for i in top_k(scores, k)
+        ]
         return self.enrich_match_list(matches)
-
-
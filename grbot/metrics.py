@@ -0,0 +1,270 @@
+"""
+Instrumentation of the bot: durations of its stages (crawl, queue fetch, match tiers, enrich, recommend, format, post,
+ack...) as histograms, counters of posts, queries and errors, and the stats of the caches. They are exposed in the
+Prometheus text format on a local HTTP endpoint (GET /metrics) and / or written to a textfile (e.g. for the
+node_exporter textfile collector). The spans of each post can also be appended to a JSONL trace file.
+
+    with metrics.timed('match', tier='top'):
+        ...
+    metrics.count('posts_crawled', type='comment')
+    with metrics.tracing(post.id):  # Spans of the stages timed inside are traced with the post id
+        ...
+
+Disabled unless metrics.enabled is set in the config (see configure): timed() and tracing() then return a shared
+no-op context manager and count() returns right away.
+"""
+from bisect import bisect_left
+from contextlib import nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import logging
+import os
+import threading
+import time
+import weakref
+
+PREFIX = 'grbot_'
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+NO_OP = nullcontext()
+
+registry = None  # Registry of the process, None while disabled
+caches = weakref.WeakSet()  # LRUCaches, reported once enabled (see cache.py)
+gauges = {}  # name -> (function returning {label value: value}, label name)
+
+
+def label_string(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+
+class Timer:
+    __slots__ = ('registry', 'stage', 'labels', 'start', 'started_at')
+
+    def __init__(self, registry, stage, labels):
+        self.registry = registry
+        self.stage = stage
+        self.labels = labels
+
+    def __enter__(self):
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.registry.observe(self.stage, self.labels, time.perf_counter() - self.start, self.started_at,
+                              error=exc_type is not None)
+        return False
+
+
+class Tracing:
+    __slots__ = ('registry', 'post_id', 'previous')
+
+    def __init__(self, registry, post_id):
+        self.registry = registry
+        self.post_id = post_id
+
+    def __enter__(self):
+        self.previous = getattr(self.registry.local, 'post_id', None)
+        self.registry.local.post_id = self.post_id
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        self.registry.local.post_id = self.previous
+        return False
+
+
+class Registry:
+    """
+    Histograms of the stage durations and counters, thread-safe
+    """
+
+    def __init__(self, trace_path=None, buckets=BUCKETS):
+        self.buckets = buckets
+        self.histograms = {}  # (stage, labels) -> [count per bucket, sum, count]
+        self.counters = {}  # (name, labels) -> value
+        self.lock = threading.Lock()
+        self.trace_path = trace_path
+        self.trace_file = open(trace_path, 'a') if trace_path else None
+        self.local = threading.local()  # Post traced by the thread (see Tracing)
+
+    def observe(self, stage, labels, seconds, started_at=None, error=False):
+        with self.lock:
+            histogram = self.histograms.get((stage, labels))
+            if histogram is None:
+                histogram = self.histograms[(stage, labels)] = [[0] * len(self.buckets), 0.0, 0]
+            position = bisect_left(self.buckets, seconds)
+            if position < len(self.buckets):
+                histogram[0][position] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+            if error:
+                key = ('errors', (('stage', stage),))
+                self.counters[key] = self.counters.get(key, 0) + 1
+            post_id = getattr(self.local, 'post_id', None)
+            if self.trace_file is not None and post_id is not None:
+                self.trace_file.write(json.dumps({
+                    'post_id': post_id, 'span': stage, **dict(labels), 'start': started_at,
+                    'seconds': round(seconds, 6), 'error': error}) + '\n')
+
+    def count(self, name, labels, value=1):
+        with self.lock:
+            self.counters[(name, labels)] = self.counters.get((name, labels), 0) + value
+
+    def render(self):
+        """
+        :return: all the metrics, in the Prometheus text exposition format
+        """
+        with self.lock:
+            histograms = {key: (list(buckets), total, count)
+                          for key, (buckets, total, count) in self.histograms.items()}
+            counters = dict(self.counters)
+            if self.trace_file is not None:
+                self.trace_file.flush()
+        lines = [f"# HELP {PREFIX}stage_seconds Duration of the stages of the bot",
+                 f"# TYPE {PREFIX}stage_seconds histogram"]
+        for (stage, labels), (buckets, total, count) in sorted(histograms.items()):
+            labels = (('stage', stage),) + labels
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, buckets):
+                cumulative += bucket_count
+                lines.append(f"{PREFIX}stage_seconds_bucket{label_string(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{PREFIX}stage_seconds_bucket{label_string(labels + (('le', '+Inf'),))} {count}")
+            lines.append(f"{PREFIX}stage_seconds_sum{label_string(labels)} {total}")
+            lines.append(f"{PREFIX}stage_seconds_count{label_string(labels)} {count}")
+
+        by_name = {}
+        for (name, labels), value in counters.items():
+            by_name.setdefault(name, []).append((labels, value))
+        for name, series in sorted(by_name.items()):
+            lines.append(f"# TYPE {PREFIX}{name}_total counter")
+            lines += [f"{PREFIX}{name}_total{label_string(labels)} {value}" for labels, value in sorted(series)]
+
+        lines += self.render_caches()
+        for name, (function, label) in sorted(gauges.items()):
+            try:
+                values = function()
+            except Exception as e:
+                logging.info(f"Gauge {name} failed: {e}")
+                continue
+            lines.append(f"# TYPE {PREFIX}{name} gauge")
+            lines += [f"{PREFIX}{name}{label_string(((label, key),))} {value}" for key, value in values.items()]
+        return '\n'.join(lines) + '\n'
+
+    def render_caches(self):
+        """
+        Stats of the LRUCaches alive, summed by cache name
+        """
+        stats = {}
+        for cache in list(caches):
+            cache_stats = cache.stats()
+            totals = stats.setdefault(cache.name, dict.fromkeys(cache_stats, 0))
+            for key, value in cache_stats.items():
+                totals[key] += value
+        lines = []
+        for key, kind in [('size', 'gauge'), ('hits', 'counter'), ('misses', 'counter'), ('evictions', 'counter'),
+                          ('expirations', 'counter')]:
+            name = f"{PREFIX}cache_{key}" + ('_total' if kind == 'counter' else '')
+            lines.append(f"# TYPE {name} {kind}")
+            lines += [f"{name}{label_string((('cache', cache),))} {totals[key]}"
+                      for cache, totals in sorted(stats.items())]
+        return lines
+
+    def write_textfile(self, path):
+        """
+        Written to a temporary file then renamed, so that a collector never reads a partial file
+        """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as handle:
+            handle.write(self.render())
+        os.replace(tmp_path, path)
+
+    def serve(self, port, host='localhost'):
+        """
+        Serves GET /metrics in a background thread
+        :return: the server
+        """
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                if self.path.split('?')[0].rstrip('/') != '/metrics':
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+        logging.info(f"Serving metrics on http://{host}:{server.server_address[1]}/metrics")
+        return server
+
+    def write_textfile_every(self, path, seconds):
+        def run():
+            while True:
+                time.sleep(seconds)
+                try:
+                    self.write_textfile(path)
+                except Exception as e:
+                    logging.info(f"Could not write the metrics to {path}: {e}")
+
+        threading.Thread(target=run, name='metrics_textfile', daemon=True).start()
+
+
+def configure(config):
+    """
+    Enables the metrics of the process if metrics.enabled is set, once: served on metrics.port (if set) and written
+    to metrics.textfile_path every metrics.textfile_seconds (if set), spans of the posts traced to metrics.trace_path
+    (if set)
+    :return: the Registry, None if disabled
+    """
+    global registry
+    settings = config.get('metrics', {})
+    if registry is not None or not settings.get('enabled', False):
+        return registry
+    registry = Registry(trace_path=settings.get('trace_path'))
+    if settings.get('port') is not None:
+        registry.serve(settings['port'], host=settings.get('host', 'localhost'))
+    if settings.get('textfile_path'):
+        registry.write_textfile_every(settings['textfile_path'], settings.get('textfile_seconds', 15))
+    return registry
+
+
+def timed(stage, **labels):
+    """
+    :return: context manager recording the duration of the stage (and an error if it raises)
+    """
+    if registry is None:
+        return NO_OP
+    return Timer(registry, stage, tuple(sorted(labels.items())))
+
+
+def tracing(post_id):
+    """
+    :return: context manager tracing the spans of the stages timed inside (in this thread) with post_id
+    """
+    if registry is None or registry.trace_file is None:
+        return NO_OP
+    return Tracing(registry, post_id)
+
+
+def count(name, value=1, **labels):
+    if registry is None:
+        return
+    registry.count(name, tuple(sorted(labels.items())), value)
+
+
+def register_gauge(name, function, label):
+    """
+    :param function: returns {label value: value}, called at each export. Replaces the gauge of the same name.
+    """
+    gauges[name] = (function, label)
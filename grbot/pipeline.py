@@ -0,0 +1,373 @@
+"""
+Pipelined runtime: crawling, matching and replying run as concurrent stages (threads) connected by bounded
+in-memory queues, so that the matching CPU and the Reddit / storage I/O overlap instead of alternating.
+A full queue blocks the stage feeding it (backpressure). The storage stays the durable record of the posts to match,
+crawl timestamps and logs, written in order by a writer thread.
+
+    crawl --(posts to match)--> match --(matched posts)--> reply
+      '-------------------- storage writes ---------------------'--> writer
+"""
+from grbot import praw_wrapper, metrics
+from grbot.acks import AckBuffer
+from grbot.bot import Bot
+from grbot.cache import LRUCache
+from grbot.storage import from_config as open_storage
+
+import logging
+import queue
+import threading
+import time
+
+STOP = object()  # Sent down the queues once a stage is done
+
+
+class StageStats:
+    """
+    Items processed by a stage, time spent processing them and errors
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.items, self.busy_seconds, self.errors = 0, 0.0, 0
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+
+    def record(self, items, seconds):
+        with self.lock:
+            self.items += items
+            self.busy_seconds += seconds
+        metrics.count('pipeline_items', items, stage=self.name)
+
+    def error(self):
+        with self.lock:
+            self.errors += 1
+        metrics.count('errors', stage=self.name)
+
+    def stats(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        return {
+            'items': self.items,
+            'throughput': self.items / elapsed,  # Items per second
+            'busy': self.busy_seconds / elapsed,  # Share of the time spent processing
+            'errors': self.errors
+        }
+
+    def summary(self):
+        stats = self.stats()
+        return (f"{self.name}: {stats['items']} items ({stats['throughput']:.2f}/s), "
+                f"busy {stats['busy']:.0%}, {stats['errors']} errors")
+
+
+class StorageWriter:
+    """
+    Storage (see storage.py) whose writes are queued and done in order by a background thread (run), with retries.
+    Reads go to the storage directly. The acknowledgements buffer is flushed by the same thread, once the writes
+    queued before it are done: the posts to match are saved before being removed.
+    A write still failing after its retries stops the thread rather than being skipped, since the writes after it
+    may rely on it (e.g. crawl timestamps moved forward once the posts crawled are saved): the writes queued after
+    it are not done, the error is kept in `failure` and raised by the next writes queued.
+    """
+    WRITES = {'save_post_ids_to_match', 'update_timestamps', 'save_reply_logs', 'add_log_in_error_table',
+              'add_logs_in_error_table', 'remove_post_ids_to_match'}
+
+    def __init__(self, storage, acks=None, max_pending=1000, max_attempts=5, poll_seconds=1.0, retry_seconds=1.0):
+        """
+        :param retry_seconds: wait before the first retry of a write, doubled at each retry (30 seconds at most)
+        """
+        self.storage = storage
+        self.acks = acks
+        self.tasks = queue.Queue(maxsize=max_pending)
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        self.poll_seconds = poll_seconds
+        self.stats = StageStats('write')
+        self.failure = None  # Error which stopped the writer thread
+
+    def __getattr__(self, name):
+        attribute = getattr(self.storage, name)
+        if name in self.WRITES:
+            return lambda *args, **kwargs: self.queue_write(name, args, kwargs)
+        return attribute
+
+    def queue_write(self, name, args, kwargs):
+        """
+        Waits while the queue of writes is full, unless the writer thread stopped on a failure
+        """
+        while True:
+            if self.failure is not None:
+                raise RuntimeError(f"Storage writer stopped, {name} not written: {self.failure}") from self.failure
+            try:
+                return self.tasks.put((name, args, kwargs), timeout=self.poll_seconds)
+            except queue.Full:
+                pass
+
+    def write(self, name, args, kwargs):
+        for attempt in range(self.max_attempts):
+            try:
+                return getattr(self.storage, name)(*args, **kwargs)
+            except Exception as e:
+                logging.info(f"Storage write {name} failed (attempt {attempt + 1}/{self.max_attempts}): {e}")
+                if attempt + 1 == self.max_attempts:
+                    self.stats.error()
+                    raise
+                time.sleep(min(self.retry_seconds * 2 ** attempt, 30))
+
+    def run(self, stop):
+        """
+        Writes until `stop` is set and everything queued is written, or until a write fails (see failure)
+        :param stop: threading.Event
+        """
+        try:
+            while not (stop.is_set() and self.tasks.empty()):
+                try:
+                    name, args, kwargs = self.tasks.get(timeout=self.poll_seconds)
+                    start = time.perf_counter()
+                    self.write(name, args, kwargs)
+                    self.stats.record(1, time.perf_counter() - start)
+                except queue.Empty:
+                    pass
+                if self.acks is not None and self.tasks.empty() and self.acks.due():
+                    self.acks.flush()
+        except Exception as e:
+            logging.warning(f"Storage writer stopped, {self.tasks.qsize()} writes left undone: {e}")
+            self.failure = e
+            return
+        if self.acks is not None:
+            self.acks.flush()
+
+
+class Pipeline:
+    """
+    Usage: Pipeline(config).run()
+    The posts left in the storage queue by a previous run are matched first.
+    A stage (or the writer) failing on an error it does not handle stops the whole pipeline: the other stages drop
+    the posts in their queues, left in the storage queue to be matched at the next run, and run raises the error.
+    """
+
+    def __init__(self, config, storage=None, bot=None):
+        """
+        :param storage: bot storage, opened from the config if None
+        :param bot: Bot whose storage is the writer of the pipeline (self.writer), built from the config if None
+        """
+        self.config = config
+        storage = open_storage(config) if storage is None else storage
+        self.acks = AckBuffer(
+            storage,
+            max_posts=config['flow'].get('ack_max_posts', 50),
+            max_seconds=config['flow'].get('ack_max_seconds', 60),
+            journal_path=config['flow'].get('ack_journal_path'),
+            background=True)
+        self.writer = StorageWriter(storage, acks=self.acks)
+        if bot is None:
+            bot = Bot(config, storage=self.writer, acks=self.acks)
+            # praw clients are not thread-safe: the reply stage gets its own, the posts crawled are bound to it to be
+            # replied to (see Poster.reply_to)
+            bot.poster.reddit = praw_wrapper.init(config)
+        self.bot = bot
+
+        queue_size = config['flow'].get('pipeline_queue_size', 100)
+        self.to_match = queue.Queue(maxsize=queue_size)
+        self.to_reply = queue.Queue(maxsize=queue_size)
+        self.match_batch_size = config['flow'].get('match_batch_size') or 10
+        self.crawl_seconds = config['flow'].get('pipeline_crawl_seconds', 180)
+        self.stats_seconds = config['flow'].get('pipeline_stats_seconds', 60)
+        self.streaming = config['flow'].get('streaming', False)
+        self.run_check_scores = config['flow'].get('run_check_scores', False)
+        self.stats = {name: StageStats(name) for name in ['crawl', 'match', 'reply']}
+        self.stats['write'] = self.writer.stats
+        self.stopping = threading.Event()
+        self.failure = None  # (stage, error) which stopped the pipeline
+        # Ids of the posts sent to the match stage, so that a post crawled again is not replied to twice
+        self.enqueued_ids = LRUCache(
+            maxsize=config['reddit'].get('stream_dedupe_size', 10000), name="Pipeline post ids")
+        metrics.register_gauge('pipeline_queue_depth', self.queue_depths, label='queue')
+
+    def queue_depths(self):
+        return {'to_match': self.to_match.qsize(), 'to_reply': self.to_reply.qsize(),
+                'to_write': self.writer.tasks.qsize(), 'acks': len(self.acks)}
+
+    def log_stats(self):
+        logging.info(f"Pipeline queues: {self.queue_depths()}")
+        for stats in self.stats.values():
+            logging.info(stats.summary())
+        if self.bot.poster.scheduler is not None:
+            self.bot.poster.scheduler.log_stats()
+
+    def fail(self, stage, error):
+        """
+        Stops the pipeline on an error of stage
+        """
+        if self.failure is None:
+            logging.warning(f"Pipeline stage {stage} failed, stopping the pipeline: {error!r}")
+            self.failure = (stage, error)
+        self.stopping.set()
+
+    def put(self, stage_queue, item):
+        """
+        Waits while stage_queue is full, unless the pipeline failed: the stage reading it may be gone
+        :return: False if the item was dropped
+        """
+        while self.failure is None:
+            try:
+                stage_queue.put(item, timeout=self.writer.poll_seconds)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def get(self, stage_queue, wait=True):
+        """
+        :param wait: False to raise queue.Empty if no item comes within the poll interval of the writer
+        :return: next item of stage_queue, STOP if the pipeline failed
+        """
+        while self.failure is None:
+            try:
+                return stage_queue.get(timeout=self.writer.poll_seconds)
+            except queue.Empty:
+                if not wait:
+                    raise
+        return STOP
+
+    def enqueue(self, post, post_type):
+        """
+        Sends a post to the match stage, waiting while its queue is full
+        """
+        if self.enqueued_ids.get(post.id) is not None:
+            return
+        self.enqueued_ids.put(post.id, True)
+        self.put(self.to_match, (post, post_type))
+
+    # Stages
+
+    def enqueue_backlog(self):
+        """
+        Posts waiting in the storage queue, e.g. from a previous run
+        """
+        with metrics.timed('queue_fetch'):
+            queued = self.writer.get_posts_to_match(self.bot.subreddits_str, batch_size=10000)
+        for start in range(0, len(queued), 100):
+            posts, missing = self.bot.fetch_queued_posts(queued[start:start + 100])
+            if missing:
+                self.acks.add_removed(missing)
+            for post in posts:
+                self.enqueue(*post)
+        logging.info(f"{len(queued)} posts waiting in the storage queue")
+
+    def crawl(self):
+        try:
+            self.enqueue_backlog()
+        except Exception as e:
+            self.stats['crawl'].error()
+            logging.info(f"Could not fetch the posts waiting in the storage queue: {e}")
+        while not self.stopping.is_set():
+            try:
+                if self.streaming:
+                    self.bot.reader.stream_posts(
+                        on_post=self.enqueue,
+                        on_checkpoint=self.check_scores,
+                        stop=self.stopping.is_set)
+                    continue
+                start = time.perf_counter()
+                self.bot.reader.read_posts()
+                posts = self.bot.reader.save_posts()
+                self.stats['crawl'].record(len(posts), time.perf_counter() - start)
+                for post in posts:
+                    self.enqueue(*post)
+                self.check_scores()
+                self.stopping.wait(self.crawl_seconds)
+            except Exception as e:
+                self.stats['crawl'].error()
+                logging.info(f"ERROR IN CRAWL STAGE ! {e}")
+                self.stopping.wait(60)
+        self.put(self.to_match, STOP)
+
+    def check_scores(self):
+        if self.run_check_scores:
+            self.bot.check_scores(reddit=self.bot.reader.reddit)
+
+    def match(self):
+        done = False
+        while not done:
+            batch = [self.get(self.to_match)]
+            # Up to match_batch_size posts matched together, without waiting for more
+            while batch[-1] is not STOP and len(batch) < self.match_batch_size:
+                try:
+                    batch.append(self.to_match.get_nowait())
+                except queue.Empty:
+                    break
+            if batch[-1] is STOP:
+                batch, done = batch[:-1], True
+            if not batch:
+                continue
+            start = time.perf_counter()
+            try:
+                matched_posts = self.bot.match_batch(batch)
+            except Exception as e:
+                self.stats['match'].error()
+                logging.info(f"ERROR IN MATCH STAGE ! {e}")
+                matched_posts = [(post, post_type, e, None) for post, post_type in batch]
+            self.stats['match'].record(len(batch), time.perf_counter() - start)
+            for matched_post in matched_posts:
+                self.put(self.to_reply, matched_post)
+        self.put(self.to_reply, STOP)
+
+    def reply(self):
+        scheduler = self.bot.poster.scheduler
+        while True:
+            try:
+                matched_post = self.get(self.to_reply, wait=False)
+            except queue.Empty:  # Deferred replies sent while no new post comes (see scheduler.py)
+                if scheduler is not None:
+                    scheduler.run()
+                continue
+            if matched_post is STOP:
+                if self.failure is None and scheduler is not None and len(scheduler):
+                    logging.info(f"{len(scheduler)} deferred replies left in the storage queue for the next run")
+                break
+            start = time.perf_counter()
+            try:
+                self.bot.reply_matched(*matched_post)
+            except Exception as e:
+                self.stats['reply'].error()
+                logging.info(f"ERROR IN REPLY STAGE ! {e}")
+            self.stats['reply'].record(1, time.perf_counter() - start)
+
+    def run_stage(self, stage):
+        try:
+            stage()
+        except Exception as e:
+            self.stats[stage.__name__].error()
+            self.fail(stage.__name__, e)
+
+    def run(self, stop=None):
+        """
+        :param stop: function returning True to stop the pipeline, None to run forever.
+        Once stopped, the posts already crawled are matched, replied to and acknowledged before returning.
+        :raise RuntimeError: if a stage or the writer failed (see fail), once the writes queued are done
+        """
+        writer_stop = threading.Event()
+        stages = [threading.Thread(target=self.run_stage, args=(stage,), name=stage.__name__, daemon=True)
+                  for stage in [self.crawl, self.match, self.reply]]
+        writer = threading.Thread(target=self.writer.run, args=(writer_stop,), name='write', daemon=True)
+        for thread in stages + [writer]:
+            thread.start()
+        last_stats = time.monotonic()
+        while any(thread.is_alive() for thread in stages):
+            time.sleep(0.1)
+            if stop is not None and stop():
+                self.stopping.set()
+            if self.writer.failure is not None:
+                self.fail('write', self.writer.failure)
+            if time.monotonic() - last_stats >= self.stats_seconds:
+                self.log_stats()
+                last_stats = time.monotonic()
+            # The stages run: no fork of the matching processes, they stay on the catalog they can reach by changes
+            self.bot.refresh_catalog_if_due(restart_pool=False)
+        writer_stop.set()
+        writer.join()
+        self.log_stats()
+        if self.failure is None and self.writer.failure is not None:
+            self.failure = ('write', self.writer.failure)
+        if self.failure is not None:
+            stage, error = self.failure
+            raise RuntimeError(f"Pipeline stopped by a failure of its {stage} stage: {error}") from error
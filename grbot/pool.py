@@ -0,0 +1,129 @@
+"""
+Pool of matching processes sharing the catalog of one Matcher.
+Workers are forked after the catalog is loaded: they read the parent's copy (copy-on-write pages, or the shared
+pages of a memory-mapped snapshot) instead of loading their own.
+The changes picked up by the Matcher since (see Matcher.refresh_catalog) are sent along with the posts and replayed
+by each worker on its copy, so the workers are not forked again on every refresh. Only a catalog loaded in full
+(e.g. a snapshot rebuilt) needs new workers (see restart_if_reloaded).
+"""
+import gc
+import logging
+import multiprocessing
+import os
+
+# Matcher of the parent process, inherited by the forked workers
+_matcher = None
+
+
+def init_worker():
+    # One process per core already: no extra rapidfuzz threads
+    _matcher.workers = 1
+
+
+def catch_up(changes, catalog_version):
+    """
+    Runs in a worker: applies the changes it has not applied yet (see CatalogVersion.changes), to match on the
+    same version as the parent
+    """
+    for previous, version, books, series in changes:
+        if _matcher.catalog_version == previous:
+            _matcher.swap(_matcher.apply_changes(_matcher.catalog, books=books, series=series, catalog_version=version))
+    if _matcher.catalog_version != catalog_version:
+        raise RuntimeError(f"Matching process {os.getpid()} on catalog version {_matcher.catalog_version}, "
+                           f"can't reach version {catalog_version}")
+
+
+def match_post(args):
+    """
+    Runs in a worker. Matches and recommendations are sent back as match keys and book ids, much lighter to pickle
+    than Books and their info.
+    :return: ([match key for each query], [[reco book ids] for each query]), or the exception raised
+    """
+    queries, k, changes, catalog_version = args
+    try:
+        catch_up(changes, catalog_version)
+        title_matches = _matcher.process_queries(queries)
+        return [_matcher.match_key(match) for match in title_matches], _matcher.recommend_ids(title_matches, k)
+    except Exception as e:
+        return e
+
+
+class MatcherPool:
+
+    def __init__(self, matcher, processes):
+        """
+        :param matcher: Matcher with its catalog loaded
+        :param processes: number of worker processes
+        """
+        self.matcher = matcher
+        self.processes = processes
+        self.pool = None
+        self.start()
+
+    def start(self):
+        """
+        Forks the workers. As any fork, to be called while no other thread of the process holds a lock (e.g. not
+        while the stages of a Pipeline run): the workers would inherit it held.
+        """
+        global _matcher
+        _matcher = self.matcher
+        # Version the workers were forked with, and the one they match on: the match keys they send back refer to
+        # its positions
+        self.forked_catalog = self.catalog = self.matcher.catalog
+        self.reload_logged = False
+        # Lazy parts of a snapshot are materialized before the fork, and the collector is kept from touching
+        # (hence copying) the inherited objects
+        _ = self.matcher.books_choices, self.matcher.series_choices
+        gc.freeze()
+        self.pool = multiprocessing.get_context('fork').Pool(self.processes, initializer=init_worker)
+        logging.info(f"Started {self.processes} matching processes on catalog version {self.catalog.catalog_version}")
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def reachable(self, catalog):
+        """
+        :return: True if the workers can reach catalog by replaying changes, False if it was loaded in full since
+        """
+        return catalog is self.catalog or any(
+            previous == self.catalog.catalog_version for previous, _, _, _ in catalog.changes or ())
+
+    def restart_if_reloaded(self):
+        """
+        Forks new workers if the catalog of the Matcher was loaded in full since the fork. Same constraint as start:
+        only where no other thread runs (the bot loop between two cycles, not the Pipeline).
+        :return: True if the workers were restarted
+        """
+        if self.reachable(self.matcher.catalog):
+            return False
+        self.close()
+        self.start()
+        return True
+
+    def match_posts(self, posts, k=5):
+        """
+        All posts are dispatched at once, results are yielded in order as soon as they are ready
+        :param posts: [[query1, query2, ..] for each post]
+        :param k: number of recommendations per match
+        :return: iterator over (title matches, recommendations) or the exception raised, for each post
+        """
+        catalog = self.matcher.catalog
+        if self.reachable(catalog):
+            self.catalog = catalog
+        elif not self.reload_logged:
+            logging.info(f"Catalog version {catalog.catalog_version} loaded in full: the matching processes stay on "
+                         f"version {self.catalog.catalog_version} until restarted")
+            self.reload_logged = True
+        catalog = self.catalog
+        changes = [change for change in catalog.changes or () if change[1] > self.forked_catalog.catalog_version]
+        for result in self.pool.imap(match_post, [(queries, k, changes, catalog.catalog_version) for queries in posts]):
+            if isinstance(result, Exception):
+                yield result
+                continue
+            match_keys, recommendations = result
+            # Pinned while resolving the keys only: the consumer runs between two yields, on the current catalog
+            with self.matcher.pinned(catalog):
+                matches = [self.matcher.match_from_key(key) for key in match_keys]
+                recos = self.matcher.recommendation_infos(recommendations)
+            yield matches, recos
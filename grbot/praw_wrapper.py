@@ -1,11 +1,34 @@
+from grbot import ratelimit
+
 import praw
 
 def init(config):
+    # Reddit API urls can be overridden, e.g. to run against tests/fake_reddit.py
+    urls = {key: config['reddit'][key] for key in ['reddit_url', 'oauth_url'] if key in config['reddit']}
     reddit = praw.Reddit(
         client_id=config['creds']['reddit_client_id'],
         client_secret=config['creds']['reddit_client_secret'],
         user_agent=config['creds']['reddit_user_agent'],
         username=config['creds']['reddit_username'],
         password=config['creds']['reddit_password'],
+        **urls
     )
-    return reddit
\ No newline at end of file
+    share_rate_limit(reddit, ratelimit.for_account(config['creds']['reddit_username']))
+    return reddit
+
+def share_rate_limit(reddit, rate_limit):
+    """
+    Feeds the rate limit headers of all the responses to the praw client into `rate_limit`, the budget of the
+    account shared with its other clients (see ratelimit.for_account)
+    """
+    for core in [reddit._authorized_core, reddit._read_only_core]:
+        if core is None:
+            continue
+        limiter = core._rate_limiter
+        update = limiter.update
+
+        def update_shared(response_headers, update=update):
+            update(response_headers=response_headers)
+            rate_limit.observe(response_headers)
+
+        limiter.update = update_shared
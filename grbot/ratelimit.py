@@ -0,0 +1,112 @@
+import asyncio
+import threading
+import time
+
+
+class RateLimit:
+    """
+    Reddit rate limit, from the X-Ratelimit-* headers of its responses: `remaining` requests allowed until the
+    current window resets. Requests are held back once the window's budget is spent, until it resets.
+    Shared by concurrent requests (threads or asyncio tasks): the requests in flight are counted against the budget,
+    since the responses seen so far don't account for them yet.
+    Usage: wait() (or wait_async()) before each request, release(response headers) once it is answered.
+    """
+
+    def __init__(self, poll_interval=0.05):
+        self.remaining = None  # Unknown until the first response: one request at a time until then
+        self.reset_at = 0.0
+        self.limit, self.window = None, 0.0  # Budget and length of a full window, as seen in the headers
+        self.in_flight = 0
+        self.poll_interval = poll_interval
+        self.lock = threading.Lock()
+
+    def take(self, reserve=0):
+        """
+        Takes one request from the budget if possible
+        :param reserve: number of requests of the budget left to the other callers (e.g. the crawl)
+        :return: 0 if taken, else seconds to wait before trying again
+        """
+        with self.lock:
+            now = time.monotonic()
+            if self.remaining is None:
+                if self.in_flight:
+                    return self.poll_interval
+            else:
+                if now >= self.reset_at and self.limit is not None:
+                    # New window: its full budget, until the next responses tell more
+                    self.remaining, self.reset_at = self.limit, now + self.window
+                if self.remaining - self.in_flight < 1 + reserve:
+                    return max(self.reset_at - now, self.poll_interval)
+            self.in_flight += 1
+            return 0.0
+
+    def release(self, headers=None):
+        """
+        Ends a request taken with wait(), updating the budget from its response headers if any
+        """
+        with self.lock:
+            self.in_flight = max(0, self.in_flight - 1)
+        if headers is not None:
+            self.observe(headers)
+
+    def observe(self, headers):
+        """
+        Updates the budget from the headers of a response, e.g. to a request of another client of the same account
+        """
+        with self.lock:
+            remaining, reset = headers.get('X-Ratelimit-Remaining'), headers.get('X-Ratelimit-Reset')
+            if remaining is None or reset is None:
+                return
+            reset_at = time.monotonic() + float(reset)
+            if self.remaining is None or reset_at > self.reset_at + 1:  # New window (resets are in whole seconds)
+                self.remaining, self.reset_at = float(remaining), reset_at
+            else:  # Responses to concurrent requests come in any order: the lowest budget is the latest
+                self.remaining = min(self.remaining, float(remaining))
+            self.window = max(self.window, float(reset))
+            if headers.get('X-Ratelimit-Used') is not None:
+                self.limit = float(remaining) + float(headers['X-Ratelimit-Used'])
+
+    def available(self):
+        """
+        :return: requests left in the budget, None until the first response
+        """
+        with self.lock:
+            if self.remaining is None:
+                return None
+            if time.monotonic() >= self.reset_at and self.limit is not None:
+                return self.limit - self.in_flight
+            return self.remaining - self.in_flight
+
+    def exhaust(self, retry_after=None):
+        """
+        After a 429 response: nothing left until the reset (or Retry-After seconds)
+        """
+        with self.lock:
+            self.remaining = 0.0
+            if retry_after is not None:
+                self.reset_at = time.monotonic() + float(retry_after)
+
+    def wait(self):
+        delay = self.take()
+        while delay > 0:
+            time.sleep(delay)
+            delay = self.take()
+
+    async def wait_async(self):
+        delay = self.take()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.take()
+
+
+accounts = {}
+accounts_lock = threading.Lock()
+
+
+def for_account(username):
+    """
+    :return: RateLimit shared by all the clients of a Reddit account (praw clients, see praw_wrapper.init, and
+    crawler.AsyncReddit): the rate limit is per account, not per client
+    """
+    with accounts_lock:
+        return accounts.setdefault(username, RateLimit())
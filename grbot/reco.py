@@ -0,0 +1,149 @@
+from grbot.catalog import IdIndex, python_scalar
+
+import logging
+import numpy as np
+
+QUANTIZATIONS = ['float16', 'int8']
+
+
+def quantize(vectors, quantization):
+    """
+    :param vectors: float32 matrix
+    :param quantization: 'float16', or 'int8' (each row scaled to [-127, 127])
+    :return: (quantized matrix, per-row float32 scales or None)
+    """
+    if quantization == 'float16':
+        return vectors.astype(np.float16), None
+    if quantization == 'int8':
+        scales = (np.abs(vectors).max(axis=1) / 127).astype(np.float32)
+        scales[scales == 0] = 1
+        return np.round(vectors / scales[:, None]).astype(np.int8), scales
+    raise ValueError(f"Unknown quantization {quantization}, expected one of {QUANTIZATIONS}")
+
+
+class Embeddings:
+    """
+    Unit-normalized book embeddings (e.g. from the w2v KeyedVectors), as plain numpy arrays that can be
+    memory-mapped. Exposes the `key_to_index` / `most_similar` interface of gensim KeyedVectors used by Matcher.
+    Vectors are float32, or quantized (see quantize) with int8 rows scaled by `scales`.
+    """
+
+    def __init__(self, keys, vectors, key_to_index=None, scales=None):
+        self.keys = keys
+        self.vectors = vectors
+        self.scales = scales
+        self.key_to_index = IdIndex(keys) if key_to_index is None else key_to_index
+
+    @classmethod
+    def from_keyed_vectors(cls, w2v):
+        return cls(np.asarray(w2v.index_to_key), w2v.get_normed_vectors())
+
+    def to_arrays(self):
+        arrays = {'keys': self.keys, 'vectors': self.vectors, 'key_to_index': self.key_to_index.to_arrays()}
+        if self.scales is not None:
+            arrays['scales'] = self.scales
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays['keys'], arrays['vectors'], key_to_index=IdIndex.from_arrays(arrays['key_to_index']),
+                   scales=arrays.get('scales'))
+
+    @property
+    def quantization(self):
+        return None if self.vectors.dtype == np.float32 else str(self.vectors.dtype)
+
+    def quantized(self, quantization):
+        vectors, scales = quantize(self.rows(slice(None)), quantization)
+        return Embeddings(self.keys, vectors, key_to_index=self.key_to_index, scales=scales)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def rows(self, rows):
+        """
+        :return: float32 vectors of rows
+        """
+        vectors = self.vectors[rows].astype(np.float32)
+        if self.scales is not None:
+            vectors *= self.scales[rows][:, None]
+        return vectors
+
+    def dot(self, queries, chunk_size=65536):
+        """
+        Similarities between float32 queries and all the vectors. Quantized vectors are converted chunk by chunk,
+        so that no float32 copy of the whole matrix is made.
+        """
+        if self.quantization is None:
+            return queries @ self.vectors.T
+        similarities = np.empty((len(queries), len(self)), dtype=np.float32)
+        for start in range(0, len(self), chunk_size):
+            similarities[:, start:start + chunk_size] = queries @ self.rows(slice(start, start + chunk_size)).T
+        return similarities
+
+    def search(self, rows, topn, block_size=1024):
+        """
+        Batched most_similar: one matrix product per block of rows
+        :param rows: rows (positions in keys) to search the neighbours of
+        :return: (neighbours, similarities) arrays of shape (len(rows), topn), best first, rows themselves excluded
+        """
+        rows = np.asarray(rows, dtype=np.int64)
+        topn = min(topn, len(self) - 1)
+        neighbours = np.zeros((len(rows), topn), dtype=np.int32)
+        similarities = np.zeros((len(rows), topn), dtype=np.float32)
+        for start in range(0, len(rows), block_size):
+            block = rows[start:start + block_size]
+            block_similarities = self.dot(self.rows(block))
+            block_similarities[np.arange(len(block)), block] = -np.inf
+            best = np.argpartition(-block_similarities, topn, axis=1)[:, :topn]
+            best_similarities = np.take_along_axis(block_similarities, best, axis=1)
+            order = np.argsort(-best_similarities, axis=1, kind='stable')
+            neighbours[start:start + len(block)] = np.take_along_axis(best, order, axis=1)
+            similarities[start:start + len(block)] = np.take_along_axis(best_similarities, order, axis=1)
+        return neighbours, similarities
+
+    def most_similar(self, key, topn=10):
+        """
+        :return: [(key, cosine similarity)] of the topn closest keys, best first, key itself excluded
+        """
+        neighbours, similarities = self.search([self.key_to_index.get(key)], topn)
+        return [(python_scalar(self.keys[i]), float(sim)) for i, sim in zip(neighbours[0], similarities[0])]
+
+
+class NeighbourTable:
+    """
+    Precomputed top-k neighbours of every key of an Embeddings: a dense int32 matrix of rows in `keys`, so that
+    recommending is an array slice instead of a search over the whole vocabulary
+    """
+
+    def __init__(self, keys, neighbours, key_to_index=None):
+        self.keys = keys
+        self.neighbours = neighbours
+        self.key_to_index = IdIndex(keys) if key_to_index is None else key_to_index
+
+    @classmethod
+    def from_embeddings(cls, embeddings, k, block_size=1024):
+        logging.info(f"Precomputing the top {k} neighbours of {len(embeddings)} embeddings")
+        neighbours, _ = embeddings.search(np.arange(len(embeddings)), k, block_size=block_size)
+        return cls(embeddings.keys, neighbours, key_to_index=embeddings.key_to_index)
+
+    def to_arrays(self):
+        return {'keys': self.keys, 'neighbours': self.neighbours, 'key_to_index': self.key_to_index.to_arrays()}
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        return cls(arrays['keys'], arrays['neighbours'], key_to_index=IdIndex.from_arrays(arrays['key_to_index']))
+
+    @property
+    def k(self):
+        return self.neighbours.shape[1]
+
+    def get(self, key, k):
+        """
+        :return: keys of the k closest neighbours of key, best first. None if key was not precomputed (e.g. added
+        since) or k is larger than the table
+        """
+        row = self.key_to_index.get(key)
+        if row is None or k > self.k:
+            return None
+        return [python_scalar(self.keys[i]) for i in self.neighbours[row, :k]]
@@ -0,0 +1,194 @@
+"""
+Replies posted within the Reddit rate limit of the account: replies are queued and sent while the budget shared with
+the crawl (see ratelimit.for_account) allows, oldest post first, taking turns between subreddits. Replies refused
+because of the rate limit (429, or Reddit's RATELIMIT error on comments) are deferred and retried, as are those
+failing on server or network errors, instead of being logged without a reply.
+"""
+from grbot import metrics
+from grbot.cache import LRUCache
+
+from collections import deque
+import logging
+import re
+import time
+
+import praw
+import prawcore
+
+DELAY_UNITS = {'millisecond': 0.001, 'second': 1, 'minute': 60}
+
+
+def rate_limit_delay(error):
+    """
+    :return: seconds to wait before replying again if the error comes from the rate limit (0 if Reddit didn't say),
+    else None
+    """
+    if isinstance(error, prawcore.exceptions.TooManyRequests):
+        return float(error.retry_after) if error.retry_after else 0.0
+    if isinstance(error, praw.exceptions.RedditAPIException):
+        for item in error.items:
+            if item.error_type == 'RATELIMIT':
+                # e.g. "Take a break for 3 minutes before trying again."
+                match = re.search(r'(\d+) (millisecond|second|minute)', item.message or '')
+                return int(match.group(1)) * DELAY_UNITS[match.group(2)] if match else 0.0
+    return None
+
+
+def is_transient(error):
+    return isinstance(error, (prawcore.exceptions.ServerError, prawcore.exceptions.RequestException))
+
+
+class ReplyJob:
+
+    def __init__(self, post, post_type, text, formatters, seq):
+        self.post = post
+        self.post_type = post_type
+        self.text = text
+        self.formatters = formatters
+        self.created_utc = post.created_utc
+        self.seq = seq  # Order of submission, for posts created in the same second
+        self.attempts = 0
+        self.not_before = 0.0  # time.monotonic() before which the job is not tried again
+
+
+class ReplyScheduler:
+    """
+    Usage: submit(...) the replies, run() whenever possible (e.g. after each post and at the end of each cycle).
+    Not thread-safe: one thread submits and runs.
+    """
+
+    def __init__(self, rate_limit, on_done, send=None, reserve=10, max_attempts=10, retry_seconds=60):
+        """
+        :param rate_limit: RateLimit of the account (see ratelimit.for_account)
+        :param on_done: function of (post, post_type, reply or None, formatters), called once a reply is posted or
+        given up
+        :param send: function of (post, post_type, text) posting the reply and returning it, post.reply by default
+        :param reserve: number of requests of the rate limit budget left to the crawl
+        :param max_attempts: attempts before giving up a reply failing on server or network errors (replies refused
+        because of the rate limit are retried until posted)
+        :param retry_seconds: delay before retrying a failed reply, doubled at each attempt, and before retrying
+        after a rate limit error when Reddit didn't say how long to wait
+        """
+        self.rate_limit = rate_limit
+        self.on_done = on_done
+        self.send = send if send is not None else lambda post, post_type, text: post.reply(text)
+        self.reserve = reserve
+        self.max_attempts = max_attempts
+        self.retry_seconds = retry_seconds
+        self.pending = {}  # {subreddit: [ReplyJob]}
+        self.turns = deque()  # Subreddits with pending replies, the next one to be served first
+        self.post_ids = set()
+        # Posts replied to (or given up) recently: still in the storage queue until their acknowledgement is written
+        self.done_ids = LRUCache(maxsize=10000, name="Replied post ids")
+        self.seq = 0
+        self.paused_until = 0.0  # After a RATELIMIT error: the account can't comment until then
+        self.stats = {'posted': 0, 'deferred': 0, 'failed': 0}
+
+    def __len__(self):
+        return len(self.post_ids)
+
+    def submit(self, post, post_type, text, formatters):
+        """
+        :return: False if a reply to the post is already pending or done
+        """
+        if post.id in self.post_ids or self.done_ids.get(post.id) is not None:
+            return False
+        self.seq += 1
+        self.push(ReplyJob(post, post_type, text, formatters, self.seq))
+        self.post_ids.add(post.id)
+        return True
+
+    def push(self, job, first=False):
+        """
+        :param first: True to serve the subreddit of the job first
+        """
+        sub = job.post.subreddit.display_name
+        if sub not in self.pending:
+            self.pending[sub] = []
+            self.turns.append(sub)
+        self.pending[sub].append(job)
+        if first:
+            self.turns.remove(sub)
+            self.turns.appendleft(sub)
+
+    def pop_ready(self):
+        """
+        :return: the oldest job ready to be tried of the next subreddit having one, None if no job is ready
+        """
+        now = time.monotonic()
+        for _ in range(len(self.turns)):
+            sub = self.turns[0]
+            self.turns.rotate(-1)
+            ready = [job for job in self.pending[sub] if job.not_before <= now]
+            if ready:
+                job = min(ready, key=lambda job: (job.created_utc, job.seq))
+                self.pending[sub].remove(job)
+                if not self.pending[sub]:
+                    del self.pending[sub]
+                    self.turns.remove(sub)
+                return job
+        return None
+
+    def run(self):
+        """
+        Posts the replies ready to be tried, while the rate limit budget allows
+        :return: number of replies posted
+        """
+        posted = 0
+        while self.turns and time.monotonic() >= self.paused_until:
+            if self.rate_limit.take(self.reserve) > 0:
+                logging.info(f"Rate limit budget spent, {len(self)} replies left for later")
+                break
+            job = self.pop_ready()
+            if job is None:
+                self.rate_limit.release()
+                break
+            try:
+                posted += self.post(job)
+            finally:
+                self.rate_limit.release()  # The budget is updated from the headers by the praw client
+        return posted
+
+    def post(self, job):
+        """
+        :return: 1 if the reply was posted, else 0
+        """
+        job.attempts += 1
+        try:
+            logging.info(f"Answering post {job.post.id} with text : {job.text}")
+            with metrics.tracing(job.post.id), metrics.timed('post'):
+                reply = self.send(job.post, job.post_type, job.text)
+        except Exception as e:
+            delay = rate_limit_delay(e)
+            if delay is not None:  # Refused because of the account, not the post: tried again first, once allowed
+                if isinstance(e, prawcore.exceptions.TooManyRequests):  # Whole API budget of the account spent
+                    self.rate_limit.exhaust(delay or None)
+                else:  # Comment rate limit of the account: all replies wait
+                    self.paused_until = time.monotonic() + (delay or self.retry_seconds)
+                job.attempts -= 1
+                logging.info(f"Reply to post {job.post.id} deferred by the rate limit: {e}")
+                self.stats['deferred'] += 1
+                self.push(job, first=True)
+                return 0
+            if is_transient(e) and job.attempts < self.max_attempts:
+                job.not_before = time.monotonic() + self.retry_seconds * 2 ** (job.attempts - 1)
+                logging.info(f"Reply to post {job.post.id} deferred by {job.not_before - time.monotonic():.0f}s "
+                             f"(attempt {job.attempts}/{self.max_attempts}): {e}")
+                self.stats['deferred'] += 1
+                self.push(job)
+                return 0
+            logging.info(f"Error posting reply to post {job.post.id}: {e}")
+            self.stats['failed'] += 1
+            self.done(job, None)
+            return 0
+        self.stats['posted'] += 1
+        self.done(job, reply)
+        return 1
+
+    def done(self, job, reply):
+        self.post_ids.discard(job.post.id)
+        self.done_ids.put(job.post.id, True)
+        self.on_done(job.post, job.post_type, reply, job.formatters)
+
+    def log_stats(self):
+        logging.info(f"Reply scheduler: {len(self)} pending, {self.stats}")
@@ -0,0 +1,117 @@
+"""
+On-disk snapshot of prebuilt data: nested dicts of numpy arrays saved as one .npy file per array, plus a
+manifest.json. Arrays are opened memory-mapped, so loading is near-instant and the pages are shared between
+the processes opening the same snapshot. The manifest holds the sha256 of each file, checked by verify (at load only
+if asked: that reads every page).
+"""
+import hashlib
+import json
+import logging
+import numpy as np
+import os
+import shutil
+import time
+
+SNAPSHOT_FORMAT = 1
+MANIFEST = 'manifest.json'
+
+
+def flatten(arrays, prefix=''):
+    for name, value in arrays.items():
+        if isinstance(value, dict):
+            yield from flatten(value, prefix=f"{prefix}{name}.")
+        else:
+            yield prefix + name, np.asarray(value)
+
+
+def unflatten(flat_arrays):
+    arrays = {}
+    for name, value in flat_arrays.items():
+        *parents, leaf = name.split('.')
+        node = arrays
+        for parent in parents:
+            node = node.setdefault(parent, {})
+        node[leaf] = value
+    return arrays
+
+
+def save(path, arrays, meta=None):
+    """
+    Written in a temporary directory then swapped in place: processes still mapping the previous snapshot
+    keep reading its (unlinked) files
+    """
+    tmp_path, old_path = path.rstrip('/') + '.tmp', path.rstrip('/') + '.old'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    names, checksums = [], {}
+    for name, array in flatten(arrays):
+        np.save(os.path.join(tmp_path, name + '.npy'), array, allow_pickle=False)
+        names.append(name)
+        checksums[name] = file_checksum(os.path.join(tmp_path, name + '.npy'))
+    with open(os.path.join(tmp_path, MANIFEST), 'w') as handle:
+        json.dump({'format': SNAPSHOT_FORMAT, 'created': int(time.time()), 'arrays': names, 'checksums': checksums,
+                   'meta': meta or {}}, handle)
+    if os.path.exists(path):
+        shutil.rmtree(old_path, ignore_errors=True)
+        os.rename(path, old_path)
+    os.rename(tmp_path, path)
+    shutil.rmtree(old_path, ignore_errors=True)
+    logging.info(f"Snapshot of {len(names)} arrays saved in {path}")
+
+
+def file_checksum(file_path, chunk_size=2**20):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as handle:
+        for chunk in iter(lambda: handle.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def verify(path):
+    """
+    :return: names of the arrays whose file is missing or does not match its checksum (empty if the snapshot is
+    intact)
+    """
+    manifest = load_manifest(path)
+    if manifest['format'] != SNAPSHOT_FORMAT:
+        raise ValueError(f"Snapshot {path} has format {manifest['format']}, expected {SNAPSHOT_FORMAT}")
+    checksums = manifest.get('checksums', {})
+    corrupted = []
+    for name in manifest['arrays']:
+        file_path = os.path.join(path, name + '.npy')
+        if not os.path.exists(file_path) or file_checksum(file_path) != checksums.get(name):
+            corrupted.append(name)
+    return corrupted
+
+
+def load_array(file_path):
+    try:
+        # Plain ndarray view on the mapping: slicing a np.memmap is much slower
+        return np.asarray(np.load(file_path, mmap_mode='r', allow_pickle=False))
+    except ValueError: # Empty arrays can't be memory-mapped
+        return np.load(file_path, allow_pickle=False)
+
+
+def load_manifest(path):
+    """
+    Cheap check of the snapshot in place, e.g. to know if it was rebuilt since loaded
+    """
+    with open(os.path.join(path, MANIFEST), 'r') as handle:
+        return json.load(handle)
+
+
+def load(path, verify_checksums=False):
+    """
+    :param verify_checksums: True to check the files against their sha256 first (see verify)
+    :return: (meta, nested dict of memory-mapped arrays)
+    """
+    manifest = load_manifest(path)
+    if manifest['format'] != SNAPSHOT_FORMAT:
+        raise ValueError(f"Snapshot {path} has format {manifest['format']}, expected {SNAPSHOT_FORMAT}")
+    if verify_checksums:
+        corrupted = verify(path)
+        if corrupted:
+            raise ValueError(f"Snapshot {path}: {', '.join(corrupted)} missing or not matching their sha256")
+    return manifest['meta'], unflatten({
+        name: load_array(os.path.join(path, name + '.npy')) for name in manifest['arrays']
+    })
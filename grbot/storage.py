@@ -0,0 +1,282 @@
+"""
+Persistence of the bot: work queue, crawl checkpoints, reply and error logs, dim tables. The backend is selected by
+flow.mode (see from_config):
+- "local" or any other mode: BigQuery (grbot/bq.py, with a service account key in "local" mode)
+- "sqlite": SQLiteStorage, one local database file, to run everything on one machine without cloud round-trips
+
+A storage provides the functions of grbot/bq.py:
+    download_book_db(local_path=None), download_series_db(local_path=None)
+    download_book_db_changes(since, column), download_series_db_changes(since, column)
+    get_last_timestamps(subreddits), update_timestamps(timestamps)
+    save_post_ids_to_match(post_ids), get_posts_to_match(subreddits, batch_size=None, exclude=()),
+    remove_post_ids_to_match(ids)
+    save_reply_logs(df_to_log), add_log_in_error_table(post, error), add_logs_in_error_table(rows)
+    get_info(book_id_list), book_ids_from_series_ids(series_ids), book_id_from_series_id(series_id)
+"""
+from grbot.checkpoints import SQLiteCheckpoints
+from grbot.utils import replace_nan, remove_zeros, error_log_row
+
+import json
+import logging
+import pickle
+import re
+import sqlite3
+
+import pandas as pd
+
+REPLY_LOGS_SCHEMA = {"subreddit": "STRING", "post_id": 'STRING', "post_type": 'STRING',
+                     "reply_id": 'STRING', "master_grlink": 'STRING', "score": "FLOAT", "author": "STRING"}
+ERROR_LOGS_SCHEMA = {"subreddit": "STRING", "post_id": 'STRING', "post_type": 'STRING',
+                     "post_content": 'STRING', "author": "STRING", "error": 'STRING'}
+TO_MATCH_SCHEMA = {"subreddit": "STRING", "post_id": 'STRING', 'post_timestamp': 'INTEGER', "post_type": 'STRING'}
+SQLITE_TYPES = {'STRING': 'TEXT', 'INTEGER': 'INTEGER', 'FLOAT': 'REAL'}
+MIN_POST_TIMESTAMP = 1695500000
+
+
+DIM_COLUMNS_RENAMING = {
+    'first_author': 'author',
+    'short_title': 'book_title'
+}
+
+
+def clean_dim_table(df):
+    """
+    Dim table as used by the bot: missing values as None, book numbers without ".0", renamed columns
+    """
+    for col in df.columns:
+        df[col] = df[col].apply(lambda x: replace_nan(x, None))
+    if "book_number" in df.columns:
+        df['book_number'] = df['book_number'].apply(lambda x: remove_zeros(str(x)))
+    return df.rename(columns = DIM_COLUMNS_RENAMING)
+
+
+def clean_info(info):
+    """
+    Row of get_info cleaned like clean_dim_table
+    """
+    info = {DIM_COLUMNS_RENAMING.get(column, column): replace_nan(value, None) for column, value in info.items()}
+    if "book_number" in info:
+        info['book_number'] = remove_zeros(str(info['book_number']))
+    return info
+
+
+def book_number_order(book_number):
+    """
+    Sort key of the books of a series, the first book first (see bq.book_id_from_series_id)
+    """
+    book_number = str(book_number)
+    if re.fullmatch(r'[0-9]+', book_number):  # Normal integers
+        category = 1
+    elif re.fullmatch(r'[0-9]+.[0-9]+', book_number):  # "0.1" and prologues
+        category = 2
+    elif re.fullmatch(r'[0-9]+-[0-9]+', book_number):  # "1-3" and other compilations
+        category = 3
+    else:
+        category = 4
+    return category, book_number
+
+
+class SQLiteStorage:
+    """
+    All the tables of the bot in one SQLite database, named after the last part of the BigQuery table names.
+    The dim tables are imported from the local pickles (bq.local_path_dim_*) the first time they are loaded.
+    """
+
+    def __init__(self, path, config):
+        self.path = path
+        self.tables = {key: config['bq'][key].split('.')[-1] for key in [
+            'table_dim_books', 'table_dim_series', 'table_to_match', 'table_crawl_dates', 'table_reply_logs',
+            'table_error_logs'] if key in config['bq']}
+        self.tables.setdefault('table_error_logs', 'error_logs')
+        self.checkpoints = SQLiteCheckpoints(path, table=self.tables['table_crawl_dates'])
+        with self.connect() as connection:
+            for key, schema in [('table_to_match', TO_MATCH_SCHEMA), ('table_reply_logs', REPLY_LOGS_SCHEMA),
+                                ('table_error_logs', ERROR_LOGS_SCHEMA)]:
+                columns = ', '.join(f"{column} {SQLITE_TYPES[typ]}" for column, typ in schema.items())
+                connection.execute(f"CREATE TABLE IF NOT EXISTS {self.tables[key]} ({columns})")
+            connection.execute(
+                f"CREATE INDEX IF NOT EXISTS {self.tables['table_to_match']}_timestamp "
+                f"ON {self.tables['table_to_match']} (post_timestamp, post_id)")
+            connection.execute(
+                f"CREATE INDEX IF NOT EXISTS {self.tables['table_reply_logs']}_post "
+                f"ON {self.tables['table_reply_logs']} (post_id, post_type)")
+            connection.execute("CREATE TABLE IF NOT EXISTS json_columns (table_name TEXT, column_name TEXT)")
+
+    def connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def sql_to_df(self, query, params=()):
+        logging.info(f"""Attempting to run the query : "{query[0:50].strip()}" """)
+        with self.connect() as connection:
+            return pd.read_sql_query(query, connection, params=params)
+
+    def has_table(self, table):
+        with self.connect() as connection:
+            return connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is not None
+
+    # Dim tables
+
+    def import_table(self, df, table):
+        """
+        Writes a DataFrame as a table, list and dict values as JSON (decoded back by read_table)
+        """
+        df = df.copy()
+        json_columns = [column for column in df.columns if df[column].dtype == object
+                        and df[column].map(lambda x: isinstance(x, (list, tuple, dict))).any()]
+        for column in json_columns:
+            df[column] = df[column].map(lambda x: json.dumps(list(x) if isinstance(x, tuple) else x))
+        with self.connect() as connection:
+            df.to_sql(table, connection, if_exists='replace', index=False)
+            connection.execute("DELETE FROM json_columns WHERE table_name = ?", (table,))
+            connection.executemany("INSERT INTO json_columns VALUES (?, ?)", [(table, c) for c in json_columns])
+            if 'book_id' in df.columns:
+                connection.execute(f"CREATE INDEX IF NOT EXISTS {table}_book_id ON {table} (book_id)")
+            if 'series_id' in df.columns:
+                connection.execute(f"CREATE INDEX IF NOT EXISTS {table}_series_id ON {table} (series_id)")
+        logging.info(f"Imported {len(df)} rows into {table}")
+
+    def read_table(self, query, table, params=()):
+        df = self.sql_to_df(query, params)
+        with self.connect() as connection:
+            json_columns = [row[0] for row in connection.execute(
+                "SELECT column_name FROM json_columns WHERE table_name = ?", (table,))]
+        for column in json_columns:
+            if column in df.columns:
+                df[column] = df[column].map(lambda x: json.loads(x) if isinstance(x, str) else x)
+        return df
+
+    def download_book_db(self, table=None, local_path=None):
+        table = table or self.tables['table_dim_books']
+        if local_path is not None:
+            with open(local_path, 'rb') as handle:
+                df = pickle.load(handle)
+            if not self.has_table(table):
+                self.import_table(df, table)
+        else:
+            df = self.read_table(f"SELECT * FROM {table}", table)
+        return clean_dim_table(df)
+
+    def download_series_db(self, table=None, local_path=None):
+        return self.download_book_db(table=table or self.tables['table_dim_series'], local_path=local_path)
+
+    def download_book_db_changes(self, since, column, table=None):
+        """
+        Rows of the dim table changed (or added) since a watermark
+        :param since: highest value of `column` already loaded
+        :param column: column set when a row is written, e.g. an update timestamp
+        """
+        table = table or self.tables['table_dim_books']
+        return clean_dim_table(self.read_table(f"SELECT * FROM {table} WHERE {column} > ?", table, (since,)))
+
+    def download_series_db_changes(self, since, column, table=None):
+        return self.download_book_db_changes(since, column, table=table or self.tables['table_dim_series'])
+
+    def get_info(self, book_id_list, table=None):
+        if len(book_id_list) < 1:
+            return None
+        table = table or self.tables['table_dim_books']
+        book_id_list = [int(book_id) for book_id in book_id_list]
+        info_df = self.read_table(
+            f"SELECT * FROM {table} WHERE book_id IN ({', '.join('?' * len(book_id_list))})", table, book_id_list)
+        info = {}
+        for record in info_df.to_dict('records'):
+            info.setdefault(record['book_id'], {k: replace_nan(v, None) for k, v in record.items()})
+        return info
+
+    def book_ids_from_series_ids(self, series_ids, table_book=None):
+        """
+        :return: {series_id: book_id of its first book} of the series, in one query
+        """
+        if len(series_ids) < 1:
+            return {}
+        table_book = table_book or self.tables['table_dim_books']
+        series_ids = [int(series_id) for series_id in series_ids]
+        books = self.sql_to_df(
+            f"SELECT series_id, book_id, book_number FROM {table_book} "
+            f"WHERE series_id IN ({', '.join('?' * len(series_ids))})", series_ids)
+        books['order'] = books['book_number'].map(book_number_order)
+        first_books = books.sort_values('order').groupby('series_id').head(1)
+        return {int(series_id): int(book_id) for series_id, book_id in zip(first_books['series_id'], first_books['book_id'])}
+
+    def book_id_from_series_id(self, series_id, table_book=None):
+        """
+        :param series_id: series id, or a list holding it
+        """
+        if isinstance(series_id, (list, tuple)):
+            series_id = series_id[0]
+        return self.book_ids_from_series_ids([series_id], table_book=table_book)[int(series_id)]
+
+    # Crawl checkpoints
+
+    def get_last_timestamps(self, subreddits):
+        return self.checkpoints.load(subreddits)
+
+    def update_timestamps(self, timestamps):
+        """
+        :param timestamps: DataFrame (subreddit, crawl_timestamp)
+        """
+        self.checkpoints.upsert(dict(timestamps[['subreddit', 'crawl_timestamp']].values.tolist()))
+
+    # Work queue
+
+    def save_post_ids_to_match(self, post_ids):
+        rows = pd.DataFrame(post_ids, columns=list(TO_MATCH_SCHEMA)).drop_duplicates()
+        with self.connect() as connection:
+            connection.executemany(
+                f"INSERT INTO {self.tables['table_to_match']} VALUES (?, ?, ?, ?)",
+                [(sub, post_id, int(timestamp), post_type) for sub, post_id, timestamp, post_type in rows.values])
+
+    def get_posts_to_match(self, subreddits, batch_size=None, exclude=()):
+        """
+        See bq.get_posts_to_match
+        """
+        subreddits, exclude = list(subreddits), [str(post_id) for post_id in exclude]
+        df = self.sql_to_df(f"""
+            SELECT DISTINCT T.subreddit, T.post_id, T.post_type, T.post_timestamp
+            FROM {self.tables['table_to_match']} T
+            LEFT JOIN {self.tables['table_reply_logs']} T2
+                USING (post_id, post_type)
+            WHERE T2.post_id IS NULL -- Post has not been processed yet
+                AND T.subreddit IN ({', '.join('?' * len(subreddits))})
+                AND T.post_type = 'comment' -- Answering to submissions will be added later
+                AND T.post_timestamp >= {MIN_POST_TIMESTAMP}
+                {f"AND T.post_id NOT IN ({', '.join('?' * len(exclude))})" if exclude else ''}
+            ORDER BY T.post_timestamp, T.post_id
+            {f'LIMIT {int(batch_size)}' if batch_size is not None else ''}
+        """, subreddits + exclude)
+        if batch_size is None:
+            df = df.sort_values(['subreddit', 'post_id']).groupby('subreddit').head(1)  # FIFO
+        return df[['subreddit', 'post_id', 'post_type']].values.tolist()
+
+    def remove_post_ids_to_match(self, ids):
+        logging.info(f"Deleting ids {ids} from table {self.tables['table_to_match']}")
+        with self.connect() as connection:
+            connection.execute(
+                f"DELETE FROM {self.tables['table_to_match']} "
+                f"WHERE CAST(post_id AS TEXT) IN ({', '.join('?' * len(ids))})", [str(i) for i in ids])
+
+    # Logs
+
+    def save_reply_logs(self, df_to_log):
+        df = pd.DataFrame(df_to_log, columns=list(REPLY_LOGS_SCHEMA))
+        with self.connect() as connection:
+            df.to_sql(self.tables['table_reply_logs'], connection, if_exists='append', index=False)
+
+    def add_log_in_error_table(self, post, error):
+        return self.add_logs_in_error_table([error_log_row(post, error)])
+
+    def add_logs_in_error_table(self, rows):
+        df = pd.DataFrame(rows, columns=list(ERROR_LOGS_SCHEMA)).astype({'post_type': str})
+        with self.connect() as connection:
+            df.to_sql(self.tables['table_error_logs'], connection, if_exists='append', index=False)
+
+
+def from_config(config):
+    """
+    :return: storage of flow.mode, "sqlite" opening (or creating) the database flow.sqlite_path
+    """
+    if config['flow']['mode'] == 'sqlite':
+        return SQLiteStorage(config['flow'].get('sqlite_path', 'grbot.sqlite'), config)
+    from grbot import bq  # BigQuery client created at import
+    return bq
@@ -1,6 +1,7 @@
 import numpy as np
 import re
 import pickle
+import time
 
 from rapidfuzz import process, fuzz
 
@@ -11,6 +12,21 @@ def is_submission(reddit_post):
     else:
         return False
 
+def error_log_row(post, error):
+    """
+    Row of the error logs table for a post. `logged_at` is not a column: it tells apart the logs of a post in the
+    insert ids (see bq.add_logs_in_error_table)
+    """
+    return {
+        "subreddit": str(post.subreddit),
+        "post_id": post.id,
+        "post_type": is_submission(post),
+        "post_content": post.selftext if is_submission(post) else post.body,
+        "author": str(post.author),
+        "error": str(error),
+        "logged_at": time.time()
+    }
+
 def replace_nan(var, replacement="?"):
     if str(var) in ['nan', 'None', '<NA>', 'NaN', 'NA']:
         return replacement
@@ -48,6 +64,22 @@ def clean_start(s, words_to_exclude):
             return s[len(word):]
     return s
 
+def split_config_arguments(argv):
+    """
+    For scripts taking their own arguments besides --config, which configurator.py parses (strictly) when imported
+    :return: (the --config arguments of argv, the other arguments)
+    """
+    config_arguments, others = [], []
+    i = 0
+    while i < len(argv):
+        if argv[i] == '--config':
+            config_arguments += argv[i:i + 2]
+            i += 2
+        else:
+            (config_arguments if argv[i].startswith('--config=') else others).append(argv[i])
+            i += 1
+    return config_arguments, others
+
 def load_pickle(path):
     with open(path, 'rb') as handle:
         r = pickle.load(handle)
@@ -1,4 +1,4 @@
-from grbot import bot
+from grbot import bot, pipeline
 import logging
 import time
 from grbot.configurator import config, setup_logging
@@ -10,9 +10,15 @@ def sleep(minutes):
 
 def loop():
 
+    if config["flow"].get("pipeline"):
+        return run_pipeline()
+
     # Initiate instances
     my_bot = bot.Bot(config)
 
+    if config["flow"].get("streaming"):
+        return stream(my_bot)
+
     while True:
         logging.info("\n\n################## STARTING A LOOP #####################\n\n")
         try:
@@ -23,6 +29,30 @@ def loop():
             logging.info(f"ERROR IN LOOP ! {e}")
             sleep(minutes=8)
 
+def stream(my_bot):
+    """
+    Streaming mode: new posts are replied to as soon as they are seen, instead of once per loop
+    """
+    while True:
+        logging.info("\n\n################## STARTING TO STREAM #####################\n\n")
+        try:
+            my_bot.run_streaming()
+        except Exception as e:
+            logging.info(f"ERROR IN STREAM ! {e}")
+            sleep(minutes=1)
+
+def run_pipeline():
+    """
+    Pipeline mode: crawling, matching and replying run concurrently (see grbot/pipeline.py)
+    """
+    while True:
+        logging.info("\n\n################## STARTING THE PIPELINE #####################\n\n")
+        try:
+            pipeline.Pipeline(config).run()
+        except Exception as e:
+            logging.info(f"ERROR IN PIPELINE ! {e}")
+            sleep(minutes=1)
+
 def process_once(my_bot):
 
     # 1) Crawl comments
@@ -30,16 +60,22 @@ def process_once(my_bot):
         logging.info("Started Crawling")
         my_bot.run_crawling()
 
-    # 2) Answer one
+    # 2) Answer one per subreddit, or a batch of the oldest posts
     if config["flow"]["run_poster"]:
         logging.info("Started Matching")
-        my_bot.match_and_reply_one_by_sub()
+        if config["flow"].get("match_batch_size"):
+            my_bot.match_and_reply_batch(config["flow"]["match_batch_size"])
+        else:
+            my_bot.match_and_reply_one_by_sub()
 
     # 3) Check scores and remove downvoted
     if config["flow"]["run_check_scores"]:
         logging.info("Started Score Check")
         my_bot.check_scores()
 
+    # 4) Pick up the catalog changes, every matching.catalog_refresh_minutes
+    my_bot.refresh_catalog_if_due()
+
 if __name__ == "__main__":
     setup_logging()
     loop()
\ No newline at end of file
@@ -0,0 +1,74 @@
+"""
+The grbot modules read the config when imported (see configurator.py): the tests run with config_template.json,
+given as the only command line argument while the config is read. Fakes and synthetic data shared with the
+benchmarks are in the tests package (synthetic.py, fake_reddit.py), importable from the root of the repository.
+"""
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+argv, sys.argv = sys.argv, sys.argv[:1] + ['--config', os.path.join(ROOT, 'config_template.json')]
+from grbot.configurator import config
+sys.argv = argv
+
+import copy
+import pickle
+import pytest
+
+config['matching'].setdefault('draw_settle_key', 'sort_n')
+
+
+def copy_config(tmp_path, **sections):
+    """
+    Copy of the template config, the local settings of the storage and caches off, updated with sections
+    """
+    matcher_config = copy.deepcopy(config)
+    matcher_config['bq'].update({'local_path_dim_books': None, 'local_path_dim_series': None})
+    matcher_config['matching'].update({'cache_size': 0, 'snapshot_path': None})
+    matcher_config['reco'].update({'w2v_path': str(tmp_path / 'w2v.pkl'), 'precomputed_neighbours': 0})
+    for section, settings in sections.items():
+        matcher_config.setdefault(section, {}).update(settings)
+    return matcher_config
+
+
+@pytest.fixture
+def make_config(tmp_path):
+    """
+    :return: function of the sections to update, returning a copy of the template config (see copy_config)
+    """
+    return lambda **sections: copy_config(tmp_path, **sections)
+
+
+@pytest.fixture(scope='session')
+def catalog(tmp_path_factory):
+    """
+    Synthetic dim tables of 3000 books, one in two by "Stephen King" so that the author-filtered lists have
+    popularity tiers too, and the w2v model of their books
+    """
+    from tests.synthetic import make_dim_books, make_dim_series, make_embeddings
+
+    book_db = make_dim_books(3000)
+    book_db.loc[book_db.index % 2 == 0, 'author'] = 'Stephen King'
+    series_db = make_dim_series(book_db)
+    tmp_path = tmp_path_factory.mktemp('catalog')
+    with open(tmp_path / 'w2v.pkl', 'wb') as handle:
+        pickle.dump(make_embeddings(len(book_db), 8), handle)
+    return {'book_db': book_db, 'series_db': series_db, 'tmp_path': tmp_path}
+
+
+@pytest.fixture(scope='session')
+def make_matcher(catalog):
+    """
+    :return: function building a Matcher on the catalog, with the matching settings given
+    """
+    from tests.synthetic import SyntheticStorage
+    from grbot.matching import Matcher
+
+    def make(**matching):
+        return Matcher(
+            copy_config(catalog['tmp_path'], matching=matching), use_snapshot=False,
+            storage=SyntheticStorage(catalog['book_db'], catalog['series_db']))
+
+    return make
@@ -0,0 +1,247 @@
+"""
+Local fake of the Reddit API endpoints used by the bot, to test and benchmark the crawl and replies offline:
+access token, comment / submission listings (of one subreddit or "sub1+sub2", pages with `after` / `before`),
+posts by id (/api/info), replies and the bot's comments, with X-Ratelimit-* headers, 429s (with Retry-After) and
+the RATELIMIT error of replies sent too often. New posts can be added while serving (see add_posts), and listings
+can be made to fail (see failing).
+
+    python -m tests.fake_reddit --port 8765 --subreddits 8 --latency 0.05
+
+Then point the config to it: "reddit": {"reddit_url": "http://localhost:8765", "oauth_url": "http://localhost:8765"}
+"""
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+import argparse
+import json
+import math
+import threading
+import time
+
+TITLES = ['the hobbit', 'dune', 'the name of the wind', 'mistborn', 'the left hand of darkness', 'piranesi']
+
+
+class FakeReddit:
+    """
+    :param subreddits: names of the subreddits
+    :param posts_per_listing: number of comments (and of submissions) per subreddit, newest first
+    :param latency: seconds slept before each response
+    :param requests_per_window: rate limit, per window of `window` seconds
+    :param trigger_every: one post in `trigger_every` requests a book
+    :param reply_interval: minimum seconds between two replies of the account, replies sent earlier are refused
+    with a RATELIMIT error
+    """
+
+    def __init__(self, subreddits, posts_per_listing=300, latency=0.0, requests_per_window=600, window=600.0,
+                 trigger_every=3, start_utc=None, reply_interval=0.0):
+        self.latency = latency
+        self.requests_per_window = requests_per_window
+        self.window = window
+        self.lock = threading.Lock()
+        self.window_start, self.used = time.monotonic(), 0
+        self.requests = []  # (method, path), for the tests
+        self.replies = []  # (parent fullname, text)
+        self.reply_interval = reply_interval
+        self.last_reply = None
+        self.refused_replies = 0
+        self.trigger_every = trigger_every
+        self.throttled = 0  # Requests answered with a 429
+        self.failing = set()  # (subreddit, listing) answered with a 500
+        start_utc = int(time.time()) if start_utc is None else start_utc
+        self.listings = {}
+        for sub in subreddits:
+            for listing, kind in [('comments', 't1'), ('new', 't3')]:
+                self.listings[sub, listing] = [
+                    self.make_post(kind, sub, f"{sub}{kind[1]}{i}", start_utc - i, i % trigger_every == 0)
+                    for i in range(posts_per_listing)
+                ]
+        self.server = None
+
+    def add_posts(self, sub, n, created_utc=None):
+        """
+        Publishes n new comments and n new submissions on sub
+        """
+        created_utc = int(time.time()) if created_utc is None else created_utc
+        with self.lock:
+            for listing, kind in [('comments', 't1'), ('new', 't3')]:
+                posts = self.listings.setdefault((sub, listing), [])
+                start = len(posts)
+                posts[0:0] = [
+                    self.make_post(kind, sub, f"{sub}{kind[1]}{i}", created_utc, i % self.trigger_every == 0)
+                    for i in reversed(range(start, start + n))
+                ]
+
+    @staticmethod
+    def make_post(kind, sub, id, created_utc, triggers):
+        text = f"Looking for {{{{{TITLES[created_utc % len(TITLES)]}}}}}" if triggers else "Any advice?"
+        data = {'id': id, 'name': f"{kind}_{id}", 'subreddit': sub, 'author': f"user_{created_utc % 97}",
+                'created_utc': float(created_utc)}
+        data['body' if kind == 't1' else 'selftext'] = text
+        return {'kind': kind, 'data': data}
+
+    def rate_limit_headers(self):
+        """
+        :return: (headers, whether the request is allowed)
+        """
+        with self.lock:
+            now = time.monotonic()
+            if now - self.window_start >= self.window:
+                self.window_start, self.used = now, 0
+            allowed = self.used < self.requests_per_window
+            self.used += allowed
+            return {
+                'X-Ratelimit-Used': str(self.used),
+                'X-Ratelimit-Remaining': str(self.requests_per_window - self.used),
+                'X-Ratelimit-Reset': str(math.ceil(self.window - (now - self.window_start)))
+            }, allowed
+
+    def listing(self, subs, listing, limit, after=None, before=None):
+        with self.lock:
+            posts = sorted(
+                (post for sub in subs.split('+') for post in self.listings.get((sub, listing), [])),
+                key=lambda post: -post['data']['created_utc'])
+        start, end = 0, len(posts)
+        if after:
+            start = next((i + 1 for i, post in enumerate(posts) if post['data']['name'] == after), len(posts))
+        if before:
+            end = next((i for i, post in enumerate(posts) if post['data']['name'] == before), len(posts))
+            start = max(start, end - limit)
+        page = posts[start:min(start + limit, end)]
+        return {'kind': 'Listing', 'data': {
+            'children': page,
+            'after': page[-1]['data']['name'] if page and start + limit < len(posts) else None
+        }}
+
+    def info(self, fullnames):
+        with self.lock:
+            posts = {post['data']['name']: post for posts in self.listings.values() for post in posts}
+        return {'kind': 'Listing', 'data': {
+            'children': [posts[name] for name in fullnames.split(',') if name in posts], 'after': None
+        }}
+
+    def reply(self, parent, text):
+        with self.lock:
+            now = time.monotonic()
+            if self.last_reply is not None and now - self.last_reply < self.reply_interval:
+                self.refused_replies += 1
+                wait = int(self.reply_interval - (now - self.last_reply)) + 1
+                return {'json': {'errors': [[
+                    'RATELIMIT', f"Looks like you've been doing that a lot. Take a break for {wait} seconds "
+                                 f"before trying again.", 'ratelimit']]}}
+            self.last_reply = now
+            self.replies.append((parent, text))
+            reply_id = f"reply_{len(self.replies)}"
+        return {'json': {'errors': [], 'data': {
+            'things': [{'kind': 't1', 'data': {'id': reply_id, 'parent_id': parent}}]}}}
+
+    def user_comments(self, name):
+        """
+        Replies of the bot, newest first, each with a score of 1
+        """
+        with self.lock:
+            replies = list(enumerate(self.replies, 1))
+        return {'kind': 'Listing', 'data': {'after': None, 'children': [
+            {'kind': 't1', 'data': {'id': f"reply_{i}", 'name': f"t1_reply_{i}", 'parent_id': parent, 'body': text,
+                                    'author': name, 'subreddit': parent.split('_')[1][:2], 'score': 1,
+                                    'permalink': f"/r/sub/comments/x/reply_{i}/", 'created_utc': time.time()}}
+            for i, (parent, text) in reversed(replies)]}}
+
+    def handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def send_json(self, status, payload, headers=None):
+                body = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def handle_request(self, method):
+                url = urlparse(self.path)
+                fake.requests.append((method, url.path))
+                length = int(self.headers.get('Content-Length') or 0)
+                form = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode()).items()}
+                time.sleep(fake.latency)
+                if url.path == '/api/v1/access_token':
+                    return self.send_json(
+                        200, {'access_token': 'fake', 'token_type': 'bearer', 'expires_in': 3600, 'scope': '*'})
+                headers, allowed = fake.rate_limit_headers()
+                if not allowed:
+                    fake.throttled += 1
+                    return self.send_json(
+                        429, {'message': 'Too Many Requests'}, {**headers, 'Retry-After': headers['X-Ratelimit-Reset']})
+                parts = url.path.strip('/').split('/')
+                query = {k: v[0] for k, v in parse_qs(url.query).items()}
+                if method == 'GET' and url.path.rstrip('/') == '/api/info':
+                    return self.send_json(200, fake.info(query.get('id', '')), headers)
+                if method == 'GET' and len(parts) == 3 and parts[0] == 'r' and (parts[1], parts[2]) in fake.failing:
+                    return self.send_json(500, {'message': 'Internal Server Error'}, headers)
+                if method == 'GET' and len(parts) == 3 and parts[0] == 'r':
+                    return self.send_json(200, fake.listing(
+                        parts[1], parts[2], int(query.get('limit', 25)), query.get('after'), query.get('before')),
+                        headers)
+                if method == 'GET' and url.path.rstrip('/') == '/api/v1/me':
+                    return self.send_json(200, {'name': 'bot', 'id': 'bot'}, headers)
+                if method == 'GET' and len(parts) == 3 and parts[0] in ['user', 'u'] and parts[2] == 'comments':
+                    return self.send_json(200, fake.user_comments(parts[1]), headers)
+                if method == 'POST' and url.path.rstrip('/') == '/api/comment':
+                    return self.send_json(200, fake.reply(form.get('thing_id'), form.get('text')), headers)
+                return self.send_json(404, {'message': 'Not Found'}, headers)
+
+            def do_GET(self):
+                self.handle_request('GET')
+
+            def do_POST(self):
+                self.handle_request('POST')
+
+        return Handler
+
+    def start(self, port=0):
+        """
+        Serves in a background thread
+        :return: base url of the server
+        """
+        self.server = ThreadingHTTPServer(('localhost', port), self.handler())
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return f"http://localhost:{self.server.server_address[1]}"
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def fake_config(url, subreddits):
+    """
+    Bot config pointing to a fake server
+    """
+    return {
+        'creds': {'reddit_client_id': 'id', 'reddit_client_secret': 'secret', 'reddit_user_agent': 'bench',
+                  'reddit_username': 'bot', 'reddit_password': 'password'},
+        'reddit': {'subreddits': subreddits, 'reddit_url': url, 'oauth_url': url, 'limit': 100,
+                   'excluded_authors': [], 'max_search_per_post': 10}
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--subreddits', type=int, default=4)
+    parser.add_argument('--posts', type=int, default=300)
+    parser.add_argument('--latency', type=float, default=0.05)
+    args = parser.parse_args()
+    fake = FakeReddit([f"sub{i}" for i in range(args.subreddits)], args.posts, args.latency)
+    print(f"Fake Reddit serving {args.subreddits} subreddits on {fake.start(args.port)}")
+    while True:
+        time.sleep(3600)
+
+
+if __name__ == "__main__":
+    main()
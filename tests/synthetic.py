@@ -0,0 +1,147 @@
+"""
+Synthetic catalogs, embeddings and queries, for the tests and the benchmarks
+"""
+from grbot.reco import Embeddings
+
+import numpy as np
+import pandas as pd
+
+WORDS = [
+    'shadow', 'night', 'fire', 'king', 'queen', 'house', 'dark', 'light', 'blood', 'stone', 'river', 'winter',
+    'summer', 'dragon', 'song', 'city', 'girl', 'boy', 'war', 'peace', 'star', 'wind', 'sea', 'moon', 'sun',
+    'garden', 'secret', 'silent', 'lost', 'golden', 'iron', 'glass', 'ghost', 'wolf', 'heart', 'road', 'sky',
+    'storm', 'bone', 'crown', 'empire', 'witch', 'forest', 'memory', 'daughter', 'mountain', 'library', 'ocean',
+]
+FIRST_NAMES = ['john', 'mary', 'j k', 'stephen', 'ann', 'j r r', 'george', 'ursula', 'terry', 'neil', 'robin',
+               'brandon', 'patrick', 'joe', 'n k', 'v e', 'madeline', 'emily', 'toni', 'james']
+LAST_NAMES = ['rowling', 'king', 'leckie', 'tolkien', 'martin', 'le guin', 'pratchett', 'gaiman', 'hobb',
+              'sanderson', 'rothfuss', 'abercrombie', 'jemisin', 'schwab', 'miller', 'bronte', 'morrison', 'joyce']
+LETTERS = 'abcdefghijklmnopqrstuvwxyz'
+
+
+def make_titles(n, rng):
+    lengths = rng.integers(1, 6, size=n)
+    words = np.array(WORDS, dtype=object)[rng.integers(0, len(WORDS), size=(n, 5))]
+    titles = [' '.join(row[:length]).title() for row, length in zip(words, lengths)]
+    return [('The ' + title) if the else title for title, the in zip(titles, rng.random(n) < 0.3)]
+
+
+def make_authors(n, rng):
+    first = np.array(FIRST_NAMES, dtype=object)[rng.integers(0, len(FIRST_NAMES), size=n)]
+    # Suffix with a number to get a realistic amount of distinct authors
+    last = [f"{name}{i}" if i else name for name, i in zip(
+        np.array(LAST_NAMES, dtype=object)[rng.integers(0, len(LAST_NAMES), size=n)],
+        rng.integers(0, max(1, n // 50), size=n)
+    )]
+    return [f"{f} {l}".title() for f, l in zip(first, last)]
+
+
+def make_dim_books(n, seed=0):
+    """
+    Synthetic dim_books, in the format returned by `bq.download_book_db`
+    (popular books first, 'first_author' and 'short_title' already renamed)
+    """
+    rng = np.random.default_rng(seed)
+    book_id = np.arange(1, n + 1)
+    in_series = rng.random(n) < 0.4
+    series_id = np.where(in_series, book_id // 4, -1)
+    book_number = rng.choice(['1', '2', '3', '4', '0.5', '1-3'], size=n)
+    ratings_count = np.sort((rng.pareto(1.2, size=n) * 1000).astype(int))[::-1]
+    titles = make_titles(n, rng)
+    df = pd.DataFrame({
+        'book_id': book_id,
+        'book_title': titles,
+        'author': make_authors(n, rng),
+        'series_id': [int(s) if s >= 0 else None for s in series_id],
+        'series_title': [f"{titles[i]} Saga" if s >= 0 else None for i, s in enumerate(series_id)],
+        'book_number': [b if s >= 0 else None for b, s in zip(book_number, series_id)],
+        'master_grlink': [f"https://www.goodreads.com/book/show/{i}" for i in book_id],
+        'ratings_count': ratings_count,
+        'sort_n': ratings_count,
+        'pages': rng.integers(50, 1200, size=n),
+        'year': rng.integers(1850, 2024, size=n),
+        'summary': [f"Summary of {title}" for title in titles],
+        'tag_list': [['fantasy', 'fiction']] * n,
+    })
+    return df
+
+
+def make_dim_series(dim_books):
+    """
+    Synthetic dim_series matching make_dim_books, in the format returned by `bq.download_series_db`
+    """
+    return dim_books.dropna(subset=['series_id'])\
+                    .groupby('series_id', sort=False)\
+                    .agg(series_title=('series_title', 'first'), author=('author', 'first'),
+                         ratings_count=('ratings_count', 'sum'))\
+                    .reset_index()
+
+
+def make_embeddings(n, dim, seed=0):
+    """
+    Synthetic normalized embeddings, clustered like books of the same genres / authors
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(1, n // 100), dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, len(centers), size=n)] + 0.7 * rng.standard_normal((n, dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return Embeddings(np.arange(1, n + 1), vectors)
+
+
+class SyntheticStorage:
+    """
+    Storage serving the synthetic dim tables to the Matcher (see storage.py)
+    """
+
+    def __init__(self, book_db, series_db):
+        self.book_db = book_db
+        self.series_db = series_db
+
+    def download_book_db(self, local_path=None):
+        return self.book_db.copy()
+
+    def download_series_db(self, local_path=None):
+        return self.series_db.copy()
+
+
+def misspell(text, rng, n_typos=2):
+    """
+    Random deletions, substitutions, insertions and swaps of letters
+    """
+    chars = list(text)
+    for _ in range(n_typos):
+        if len(chars) < 4:
+            break
+        i = int(rng.integers(1, len(chars) - 1))
+        edit = rng.integers(0, 4)
+        if edit == 0:
+            del chars[i]
+        elif edit == 1:
+            chars[i] = LETTERS[rng.integers(0, len(LETTERS))]
+        elif edit == 2:
+            chars.insert(i, LETTERS[rng.integers(0, len(LETTERS))])
+        else:
+            chars[i - 1], chars[i] = chars[i], chars[i - 1]
+    return ''.join(chars)
+
+
+def make_queries(book_db, series_db, n, seed=1):
+    """
+    n queries of each kind, for books drawn by popularity like the requests on Reddit
+    :return: {kind: [query]}
+    """
+    rng = np.random.default_rng(seed)
+    weights = np.sqrt(book_db['ratings_count'].to_numpy() + 1.0)
+    rows = rng.choice(len(book_db), size=4 * n, p=weights / weights.sum())
+    titles = book_db['book_title'].to_numpy()[rows]
+    authors = book_db['author'].to_numpy()[rows]
+    long_titles = [title for title in titles if len(title.split()) >= 3]
+    series_titles = series_db['series_title'].to_numpy()[rng.integers(0, len(series_db), size=n)]
+    return {
+        'exact': [title.lower() if casing else title for title, casing in zip(titles[:n], rng.random(n) < 0.5)],
+        'misspelled': [misspell(title.lower(), rng) for title in titles[n:2 * n]],
+        'by_author': [f"{title} by {author}" for title, author in zip(titles[2 * n:3 * n], authors[2 * n:3 * n])],
+        'prefix': [' '.join(title.split()[:2]) for title in (long_titles or list(titles))[:n]],
+        'series': [title[:-len(' Saga')] + ' series' if suffix else title
+                   for title, suffix in zip(series_titles, rng.random(n) < 0.5)],
+    }
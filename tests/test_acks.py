@@ -0,0 +1,91 @@
+from grbot.acks import AckBuffer
+
+import pytest
+
+
+class FakeStorage:
+    """
+    Log tables and queue of a storage (see storage.py), failing the calls named in `failing` once each
+    """
+
+    def __init__(self, queued=(), failing=()):
+        self.reply_logs, self.error_logs = [], []
+        self.queued = set(queued)
+        self.failing = set(failing)
+
+    def fail(self, name):
+        if name in self.failing:
+            self.failing.remove(name)
+            raise ConnectionError(f"{name} failed")
+
+    def save_reply_logs(self, rows):
+        self.fail('save_reply_logs')
+        self.reply_logs += rows
+
+    def add_logs_in_error_table(self, rows):
+        self.fail('add_logs_in_error_table')
+        self.error_logs += rows
+
+    def remove_post_ids_to_match(self, ids):
+        self.fail('remove_post_ids_to_match')
+        self.queued -= set(ids)
+
+
+def reply_log(post_id):
+    return {'post_id': post_id, 'reply_id': f"r_{post_id}", 'score': 90.5}
+
+
+def fill(acks):
+    acks.add_reply_logs('a', [reply_log('a')])
+    acks.add_error_log('b', {'post_id': 'b', 'error': 'ValueError'})
+    acks.add_removed(['c'])
+
+
+def test_flush_writes_logs_then_removes_from_queue():
+    storage = FakeStorage(queued=['a', 'b', 'c', 'd'])
+    acks = AckBuffer(storage, max_posts=10)
+    fill(acks)
+    assert len(acks) == 3 and storage.queued == {'a', 'b', 'c', 'd'}
+    assert acks.flush()
+    assert storage.reply_logs == [reply_log('a')]
+    assert storage.error_logs == [{'post_id': 'b', 'error': 'ValueError'}]
+    assert storage.queued == {'d'} and len(acks) == 0
+
+
+def test_flushed_when_full():
+    storage = FakeStorage(queued=['a', 'b', 'c'])
+    acks = AckBuffer(storage, max_posts=3)
+    fill(acks)
+    assert len(acks) == 0 and storage.queued == set()
+
+
+def test_journal_replayed_after_crash(tmp_path):
+    journal_path = str(tmp_path / 'acks.jsonl')
+    fill(AckBuffer(FakeStorage(), max_posts=10, journal_path=journal_path))  # Never flushed
+    with open(journal_path, 'a') as journal:
+        journal.write('{"post_id": "d", "reply_')  # Cut by the crash
+
+    storage = FakeStorage(queued=['a', 'b', 'c'])
+    acks = AckBuffer(storage, max_posts=10, journal_path=journal_path)
+    assert len(acks) == 3
+    assert acks.flush()
+    assert storage.reply_logs == [reply_log('a')] and storage.queued == set()
+    assert len(AckBuffer(FakeStorage(), journal_path=journal_path)) == 0
+
+
+@pytest.mark.parametrize('crash', [False, True])
+@pytest.mark.parametrize('failing', ['save_reply_logs', 'add_logs_in_error_table', 'remove_post_ids_to_match'])
+def test_failed_flush_retried_without_duplicated_logs(tmp_path, failing, crash):
+    journal_path = str(tmp_path / 'acks.jsonl')
+    storage = FakeStorage(queued=['a', 'b', 'c'], failing=[failing])
+    acks = AckBuffer(storage, max_posts=10, journal_path=journal_path)
+    fill(acks)
+    assert not acks.flush()
+    assert len(acks) == 3 and storage.queued == {'a', 'b', 'c'}
+    if crash:  # Retried once replayed from the journal by the next run, else by the next flush
+        acks = AckBuffer(storage, max_posts=10, journal_path=journal_path)
+        assert len(acks) == 3
+    assert acks.flush()
+    assert storage.reply_logs == [reply_log('a')]
+    assert storage.error_logs == [{'post_id': 'b', 'error': 'ValueError'}]
+    assert storage.queued == set()
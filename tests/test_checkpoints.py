@@ -0,0 +1,57 @@
+from grbot.checkpoints import CheckpointStore, FileCheckpoints, SQLiteCheckpoints, StorageCheckpoints, from_config
+
+import pytest
+
+
+class FakeStorage:
+    """
+    Crawl dates table of a storage (see storage.py)
+    """
+
+    def __init__(self):
+        self.timestamps = {}
+
+    def get_last_timestamps(self, subreddits):
+        return {sub: self.timestamps.get(sub, 0) for sub in subreddits}
+
+    def update_timestamps(self, timestamps):
+        self.timestamps.update(dict(timestamps[['subreddit', 'crawl_timestamp']].values.tolist()))
+
+
+@pytest.mark.parametrize('backend, backend_class', [
+    ('storage', StorageCheckpoints), ('file', FileCheckpoints), ('sqlite', SQLiteCheckpoints)])
+def test_crawl_dates_round_trip_with_template_config(make_config, tmp_path, monkeypatch, backend, backend_class):
+    monkeypatch.chdir(tmp_path)  # checkpoint_path is null in the template: default file in the working directory
+    config = make_config(reddit={'checkpoint_backend': backend})
+    assert config['reddit']['checkpoint_path'] is None
+    storage = FakeStorage()
+    checkpoints = from_config(config, storage)
+    assert isinstance(checkpoints.backend, backend_class)
+    assert checkpoints.timestamps(['books', 'fantasy']) == {'books': 0, 'fantasy': 0}
+    assert checkpoints.update({'books': 1000, 'fantasy': 0}) == {'books': 1000}
+
+    # Read back by the next run
+    assert from_config(config, storage).timestamps(['books', 'fantasy']) == {'books': 1000, 'fantasy': 0}
+
+
+@pytest.mark.parametrize('backend', ['file', 'sqlite'])
+def test_checkpoint_path(make_config, tmp_path, backend):
+    path = str(tmp_path / 'checkpoints')
+    checkpoints = from_config(make_config(reddit={'checkpoint_backend': backend, 'checkpoint_path': path}), None)
+    checkpoints.update({'books': 1000})
+    assert from_config(make_config(reddit={'checkpoint_backend': backend, 'checkpoint_path': path}), None)\
+        .timestamps(['books']) == {'books': 1000}
+
+
+def test_only_newer_timestamps_written(tmp_path):
+    backend = FileCheckpoints(str(tmp_path / 'crawl_dates.json'))
+    backend.upsert({'books': 2000})
+    checkpoints = CheckpointStore(backend)
+    assert checkpoints.timestamps(['books', 'fantasy']) == {'books': 2000, 'fantasy': 0}
+    assert checkpoints.update({'books': 1000, 'fantasy': 500}) == {'fantasy': 500}
+    assert backend.load(['books', 'fantasy']) == {'books': 2000, 'fantasy': 500}
+
+
+def test_unknown_backend(make_config):
+    with pytest.raises(ValueError):
+        from_config(make_config(reddit={'checkpoint_backend': 'redis'}), None)
@@ -0,0 +1,117 @@
+from grbot import crawler, ratelimit
+from grbot.bot import Reader
+from tests.fake_reddit import FakeReddit, fake_config
+
+from types import SimpleNamespace
+import asyncio
+import pytest
+
+START_UTC = 1_700_000_000
+
+
+@pytest.fixture(autouse=True)
+def rate_limits(monkeypatch):
+    """
+    Rate limits of the accounts (see ratelimit.for_account), fresh for each test
+    """
+    monkeypatch.setattr(ratelimit, 'accounts', {})
+    return ratelimit.accounts
+
+
+@pytest.fixture
+def fake():
+    fake = FakeReddit(['books', 'fantasy', 'scifi'], posts_per_listing=250, start_utc=START_UTC)
+    fake.url = fake.start()
+    yield fake
+    fake.stop()
+
+
+def listing_requests(fake, sub, listing):
+    return [path for method, path in fake.requests if path == f"/r/{sub}/{listing}"]
+
+
+def test_crawl_follows_pages_until_last_timestamp(fake):
+    subs = ['books', 'fantasy', 'scifi']
+    last_timestamps = {'books': START_UTC - 230, 'fantasy': START_UTC - 40, 'scifi': START_UTC}
+    comments, submissions = crawler.crawl_subreddits(fake_config(fake.url, subs), last_timestamps, limit=1000)
+
+    for posts, kind in [(comments, 't1'), (submissions, 't3')]:
+        for sub in subs:
+            sub_posts = [post for post in posts if post.subreddit.display_name == sub]
+            expected = int(START_UTC - last_timestamps[sub])
+            # Newest first, without duplicates across pages, cut at the last timestamp
+            assert [post.id for post in sub_posts] == [f"{sub}{kind[1]}{i}" for i in range(expected)]
+    # 230 posts: 3 pages of 100, 40 posts: a single page
+    assert len(listing_requests(fake, 'books', 'comments')) == 3
+    assert len(listing_requests(fake, 'fantasy', 'new')) == 1
+    assert len(listing_requests(fake, 'scifi', 'new')) == 1
+
+
+def test_crawl_limit(fake):
+    comments, submissions = crawler.crawl_subreddits(fake_config(fake.url, ['books']), {'books': 0}, limit=150)
+    assert len(comments) == len(submissions) == 150
+    assert len(listing_requests(fake, 'books', 'comments')) == 2
+
+
+def test_crawl_waits_for_the_rate_limit_after_429(fake, rate_limits):
+    fake.requests_per_window, fake.window = 8, 1.0
+    fake.used = fake.requests_per_window  # Budget spent by another client of the account
+    subs = ['books', 'fantasy']
+    comments, submissions = crawler.crawl_subreddits(
+        fake_config(fake.url, subs), {sub: START_UTC - 150 for sub in subs}, limit=1000)
+
+    assert len(comments) == len(submissions) == 300
+    # The Retry-After of the 429 holds back all the concurrent listings, not just the one throttled
+    assert fake.throttled == 1
+    # One limit per account, shared by the clients of the bot (see ratelimit.for_account)
+    assert list(rate_limits) == ['bot']
+    assert rate_limits['bot'].limit == fake.requests_per_window
+    assert crawler.AsyncReddit(fake_config(fake.url, subs)).rate_limit is rate_limits['bot']
+
+
+def test_crawl_shares_the_budget_of_the_account(fake, rate_limits):
+    fake.requests_per_window, fake.window = 6, 1.0
+    config = fake_config(fake.url, ['books', 'fantasy', 'scifi'])
+
+    async def crawl_twice():
+        # Two crawls at once, e.g. the crawl stage and a catch-up crawl of a pipeline
+        return await asyncio.gather(*[
+            crawler.crawl(config, {sub: START_UTC - 150 for sub in config['reddit']['subreddits']}, 1000)
+            for _ in range(2)])
+
+    for comments, submissions in asyncio.run(crawl_twice()):
+        assert len(comments) == len(submissions) == 450
+    assert fake.throttled == 0
+
+
+def test_failing_subreddit_leaves_the_others(fake):
+    fake.failing.add(('fantasy', 'new'))
+    subs = ['books', 'fantasy', 'scifi']
+    for concurrent in [True, False]:
+        comments, submissions = asyncio.run(crawler.crawl(
+            fake_config(fake.url, subs), {sub: START_UTC - 50 for sub in subs}, 1000, concurrent=concurrent))
+        # The comments of fantasy are left out too: its timestamp would move past its submissions
+        assert {post.subreddit.display_name for post in comments + submissions} == {'books', 'scifi'}
+        assert len(comments) == len(submissions) == 100
+
+
+def test_failing_subreddit_is_crawled_again(fake, make_config, tmp_path):
+    subs = ['books', 'fantasy']
+    config = make_config(**fake_config(fake.url, subs))
+    config['reddit'].update({'async_crawl': True, 'limit': 1000, 'checkpoint_backend': 'file',
+                             'checkpoint_path': str(tmp_path / 'crawl_dates.json')})
+    reader = Reader(config, reddit=SimpleNamespace(subreddit=lambda sub: None), storage=object())
+    reader.checkpoints.update({sub: START_UTC - 50 for sub in subs})
+    reader.refresh_crawl_timestamp()
+
+    fake.failing.add(('fantasy', 'comments'))
+    reader.read_posts()
+    assert reader.last_timestamps == {'books': START_UTC, 'fantasy': START_UTC - 50}
+    assert len(reader.latest_comments) == len(reader.latest_submissions) == 50
+
+    fake.failing.clear()
+    reader.latest_comments, reader.latest_submissions = [], []
+    reader.read_posts()
+    assert reader.last_timestamps == {'books': START_UTC, 'fantasy': START_UTC}
+    assert {post.subreddit.display_name for post in reader.latest_comments} == {'fantasy'}
+    assert len(reader.latest_comments) == len(reader.latest_submissions) == 50
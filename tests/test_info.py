@@ -0,0 +1,60 @@
+from grbot import info
+from grbot.info import BookInfoLoader
+
+import pytest
+
+
+class FakeStorage:
+    """
+    get_info and book_ids_from_series_ids of a storage (see storage.py), recording the ids queried
+    """
+
+    def __init__(self, books, series):
+        self.books = books  # {book id: info}
+        self.series = series  # {series id: first book id}
+        self.queries = []
+
+    def get_info(self, book_id_list):
+        self.queries.append(('books', sorted(book_id_list)))
+        return {book_id: self.books[book_id] for book_id in book_id_list if book_id in self.books}
+
+    def book_ids_from_series_ids(self, series_ids):
+        self.queries.append(('series', sorted(series_ids)))
+        return {series_id: self.series[series_id] for series_id in series_ids if series_id in self.series}
+
+
+def book(book_id):
+    return {'book_id': book_id, 'short_title': f"Book {book_id}", 'first_author': 'Ann Leckie',
+            'book_number': 1.0, 'ratings_count': 10}
+
+
+@pytest.fixture
+def storage():
+    return FakeStorage({10**6 + i: book(10**6 + i) for i in range(3)}, {10**6: 10**6 + 2})
+
+
+def test_batched_and_cached(storage):
+    loader = BookInfoLoader(storage=storage, series_id_to_book_id={7: 10**6 + 1})
+    assert set(loader.get_info([10**6, 10**6 + 1, 42, 10**6])) == {10**6, 10**6 + 1}
+    assert loader.get_info([10**6])[10**6]['book_title'] == 'Book 1000000'  # Renamed like the catalog
+    assert loader.get_info([42]) == {}  # Not found: not queried again
+    assert storage.queries == [('books', [42, 10**6, 10**6 + 1])]
+
+    # Series resolved with the in-memory map first
+    assert loader.get_series_info([7, 10**6, 8]) == {7: loader.get_info([10**6 + 1])[10**6 + 1],
+                                                      10**6: loader.get_info([10**6 + 2])[10**6 + 2]}
+    assert storage.queries[1:] == [('series', [8, 10**6]), ('books', [10**6 + 2])]
+
+
+def test_matcher_fetches_the_books_missing_from_its_catalog(make_matcher, storage, monkeypatch):
+    monkeypatch.setattr(info, 'shared_loader', BookInfoLoader(storage=storage))
+    matcher = make_matcher(ngram_candidates=0)
+    recommendations = matcher.recommendation_infos([[1, 10**6], [10**6 + 9, 2]])  # The last one found nowhere
+    assert [[reco['book_title'] for reco in recos] for recos in recommendations] \
+           == [[matcher.book_info[1]['book_title'], 'Book 1000000'], [matcher.book_info[2]['book_title']]]
+    assert storage.queries == [('books', [10**6, 10**6 + 9])]
+
+    series_id = next(iter(matcher.series_id_to_book_id))
+    series_info = matcher.retrieve_series_infos([series_id, 10**6])
+    assert series_info[series_id] == matcher.book_info[matcher.series_id_to_book_id[series_id]]
+    assert series_info[10**6]['book_title'] == 'Book 1000002'
@@ -0,0 +1,163 @@
+"""
+Results of the Matcher against the matching of the first version of the bot (BaselineMatcher): one
+process.extract per search list and popularity tier, on titles lateralized with '#'. The Matcher scores on LCS
+matrices, shortlists with the trigram index and cascades over the tiers, but must pick the same best matches.
+"""
+from grbot.configurator import config
+from grbot.matching import Query, clean_title, clean_author
+from grbot.utils import extract_last_name
+from tests.synthetic import make_queries
+
+from collections import defaultdict
+from rapidfuzz import process, fuzz
+import numpy as np
+import pytest
+
+
+class BaselineMatcher:
+    """
+    Matcher.process_one_query as first written, on plain lists of (id, clean title) tuples
+    """
+
+    def __init__(self, book_db, series_db, min_ratio, author_min_ratio):
+        self.min_ratio = min_ratio
+        self.author_min_ratio = author_min_ratio
+        self.info = book_db.set_index('book_id')[['ratings_count', 'sort_n']].to_dict('index')
+        book_db = book_db.copy()
+        book_db['book_number_category'] = np.where(
+            book_db['book_number'].apply(lambda s: str(s).isdigit() and s != "0"), 1, np.where(
+            book_db['book_number'].str.contains("."), 2, np.where(
+            book_db['book_number'].str.contains("-"), 3, 4
+        )))
+        self.series_id_to_book_id = book_db.set_index("series_id").sort_values(["book_number_category", "book_number"])\
+                                           .groupby("series_id").head(1)["book_id"].to_dict()
+        self.books = [(book_id, clean_title(title))
+                      for book_id, title in zip(book_db['book_id'], book_db['book_title'])]
+        self.series = [(series_id, clean_title(title))
+                       for series_id, title in zip(series_db['series_id'], series_db['series_title'])]
+        self.books_by_author = self.by_author(self.books, book_db['author'])
+        self.series_by_author = self.by_author(self.series, series_db['author'])
+
+    @staticmethod
+    def by_author(search_list, authors):
+        dic = defaultdict(list)
+        for book, author in zip(search_list, authors):
+            dic[extract_last_name(clean_author(author))].append(book)
+        return dic
+
+    def process_one_query(self, query):
+        """
+        :return: (is_serie, id, raw score, title_was_shortened) of the best match
+        """
+        query = Query(query)
+        possible_matches = []
+        if query.has_by:
+            possible_matches += self.match_filtered_on_author(query, search_series=False) \
+                                + self.match_filtered_on_author(query, search_series=True)
+            if any(match[-1] > self.min_ratio for match in possible_matches):
+                return self.best(possible_matches)
+        possible_matches += self.match_process(query.clean_q, self.books, search_series=False) \
+                            + self.match_process(query.clean_q, self.series, search_series=True)
+        return self.best(possible_matches)
+
+    @staticmethod
+    def best(matches):
+        return sorted(matches, key=lambda match: match[-1], reverse=True)[0][:-1]
+
+    def match_filtered_on_author(self, query, search_series):
+        title, author = query.clean_q.rsplit(' by ', 1)
+        dic = self.series_by_author if search_series else self.books_by_author
+        closest_authors = [result[0] for result in process.extract(
+            author.split(' ')[-1], list(dic.keys()), scorer=fuzz.ratio, limit=5) if result[1] > self.author_min_ratio]
+        search_list = [book for last_name in closest_authors for book in dic[last_name]]
+        return self.match_process(title, search_list, search_series=search_series)
+
+    def match_process(self, title, search_list, search_series, k=4):
+        if len(search_list) > 1000:
+            matches = self.match_fuzz(title, search_list[:int(len(search_list) * 0.1)], search_series, k=k)
+            if max(match[-1] for match in matches) >= self.min_ratio:
+                return matches
+        matches = self.match_fuzz(title, search_list, search_series, k=k)
+        if any(match[-1] > self.min_ratio for match in matches):
+            return matches
+        shortened = [(book_id, clean[0:len(title)]) for book_id, clean in search_list]
+        return self.match_fuzz(title, shortened, search_series, k=5, shortened=True)
+
+    def match_fuzz(self, searched, search_list, is_serie, k, shortened=False):
+        if is_serie and searched[-7:] == ' series':
+            searched = searched[0:-7]
+        choices = [clean if shortened else clean.ljust(len(searched), '#') for _, clean in search_list]
+        matches = []
+        for _, raw_score, i in process.extract(searched, choices, scorer=fuzz.ratio, limit=k):
+            book_id = search_list[i][0]
+            info = self.info[self.series_id_to_book_id[book_id] if is_serie else book_id]
+            score = raw_score - is_serie - 5 * shortened + 6 * (info['ratings_count'] >= 100000)
+            matches.append((is_serie, book_id, raw_score, shortened, score))
+        return matches
+
+
+@pytest.fixture(scope='module')
+def baseline(catalog):
+    return BaselineMatcher(catalog['book_db'], catalog['series_db'], min_ratio=config['matching']['min_ratio'],
+                           author_min_ratio=config['matching']['author_min_ratio'])
+
+
+@pytest.fixture(scope='module')
+def queries(catalog):
+    queries = make_queries(catalog['book_db'], catalog['series_db'], 20)
+    # Shortened titles of "Stephen King", searched among his 1500 books: the ones of his top 10% (150 books) and
+    # the next ones settle on the tier of his books, not of the whole list
+    titles = catalog['book_db']['book_title'][:600:2]
+    queries['by_author'] += [f"{title[:max(4, len(title) - 3)]} by stephen king" for title in titles]
+    return queries
+
+
+def best_match(match):
+    return bool(match.is_serie), match.book.id, match.raw_score, bool(match.title_was_shortened)
+
+
+def possible_matches(matches):
+    return [best_match(match) for match in matches]
+
+
+def test_two_tiers_by_default(make_matcher):
+    assert make_matcher(ngram_candidates=0).popularity_tiers == [0.1, 1.0]
+
+
+@pytest.mark.parametrize('ngram_candidates', [0, 300])
+@pytest.mark.parametrize('kind', ['exact', 'misspelled', 'by_author', 'prefix', 'series'])
+def test_same_best_matches_as_baseline(make_matcher, baseline, queries, kind, ngram_candidates):
+    matcher = make_matcher(ngram_candidates=ngram_candidates)  # Default tiers
+    for query in queries[kind]:
+        assert best_match(matcher.process_one_query(query)) == pytest.approx(baseline.process_one_query(query)), query
+
+
+def test_batched_posts_match_like_single_queries(make_matcher, queries):
+    matcher = make_matcher(ngram_candidates=0)
+    posts = [[query for kind in sorted(queries) for query in queries[kind][i::5]] for i in range(5)]
+    for post, matches in zip(posts, matcher.process_posts(posts)):
+        assert [best_match(match) for match in matches] \
+               == [best_match(matcher.process_one_query(query)) for query in post]
+
+
+def test_tier_cutoff_keeps_the_matches(make_matcher, queries, monkeypatch):
+    """
+    The cascade prunes the choices of a middle tier that can't beat the k-th best score of the previous ones: its
+    matches are the ones of the tiers scored whole. One title at a time, as the cutoff is the lowest of the titles
+    scored. Books only, the series list of the catalog being too short for tiers.
+    """
+    matcher = make_matcher(ngram_candidates=0, popularity_tiers=[0.01, 0.1, 1.0])
+    titles = [Query(query).clean_q for kind in sorted(queries) for query in queries[kind]]
+    cutoffs, lcs_matrix = [], matcher.lcs_matrix
+
+    def recorded_lcs_matrix(*args, score_cutoff=0, **kwargs):
+        cutoffs.append(score_cutoff)
+        return lcs_matrix(*args, score_cutoff=score_cutoff, **kwargs)
+
+    monkeypatch.setattr(matcher, 'lcs_matrix', recorded_lcs_matrix)
+    pruned = [matcher.cascade([title])[0] for title in titles]
+    monkeypatch.undo()
+    assert any(cutoffs)
+    for title, matches in zip(titles, pruned):
+        assert possible_matches(matches) \
+               == possible_matches(matcher.match_process(title, lcs=matcher.lcs_matrix([title])[0])), title
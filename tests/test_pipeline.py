@@ -0,0 +1,254 @@
+from grbot.pipeline import Pipeline, StageStats, StorageWriter
+
+from types import SimpleNamespace
+import threading
+import pytest
+
+
+class FakeStorage:
+    """
+    Storage (see storage.py) recording its writes in order, failing the calls named in `failing` (`times` times each,
+    None for always)
+    """
+
+    def __init__(self, failing=(), times=None):
+        self.calls = []  # (name, args)
+        self.queued = {}  # post id: row
+        self.failing, self.times = set(failing), times
+        self.lock = threading.Lock()
+
+    def record(self, name, *args):
+        with self.lock:
+            if name in self.failing:
+                if self.times is None or self.times > 0:
+                    self.times = None if self.times is None else self.times - 1
+                    raise ConnectionError(f"{name} failed")
+            self.calls.append((name, args))
+
+    def names(self):
+        return [name for name, _ in self.calls]
+
+    def get_posts_to_match(self, subreddits, batch_size=1):
+        return [[row[0], post_id, row[3]] for post_id, row in self.queued.items()]
+
+    def save_post_ids_to_match(self, rows):
+        self.record('save_post_ids_to_match', rows)
+        self.queued.update({row[1]: row for row in rows})
+
+    def update_timestamps(self, timestamps):
+        self.record('update_timestamps', timestamps)
+
+    def save_reply_logs(self, rows):
+        self.record('save_reply_logs', rows)
+
+    def add_logs_in_error_table(self, rows):
+        self.record('add_logs_in_error_table', rows)
+
+    def remove_post_ids_to_match(self, ids):
+        self.record('remove_post_ids_to_match', ids)
+        for post_id in ids:
+            self.queued.pop(post_id, None)
+
+
+class FakeReader:
+    """
+    Reader crawling `per_crawl` new posts of a fake Reddit at each read_posts, saved through the storage
+    """
+
+    def __init__(self, bot, per_crawl):
+        self.bot, self.per_crawl = bot, per_crawl
+        self.crawled, self.latest = 0, []
+
+    def read_posts(self):
+        self.latest = [SimpleNamespace(id=f"p{self.crawled + i}", subreddit=SimpleNamespace(display_name='books'))
+                       for i in range(self.per_crawl)]
+        self.crawled += self.per_crawl
+
+    def save_posts(self):
+        posts = [(post, 'comment') for post in self.latest]
+        if posts:
+            self.bot.storage.save_post_ids_to_match([['books', post.id, 0, 'comment'] for post, _ in posts])
+            self.bot.storage.update_timestamps({'books': self.crawled})
+        self.latest = []
+        return posts
+
+
+class FakeBot:
+    """
+    Bot whose posts all match "Dune", replied to through the acknowledgements buffer of the pipeline
+    """
+
+    def __init__(self, per_crawl=5, scheduler=None):
+        self.subreddits_str = 'books'
+        self.reader = FakeReader(self, per_crawl)
+        self.poster = SimpleNamespace(scheduler=scheduler)
+        self.storage = self.acks = None  # Those of the pipeline, see make_pipeline
+        self.replied = []
+
+    def fetch_queued_posts(self, queued):
+        return [], []
+
+    def match_batch(self, posts):
+        return [(post, post_type, ['dune'], ['Dune']) for post, post_type in posts]
+
+    def reply_matched(self, post, post_type, books_requested, matched):
+        self.replied.append(post.id)
+        self.acks.add_reply_logs(post.id, [{'post_id': post.id, 'book': matched[0]}])
+
+    def refresh_catalog_if_due(self, restart_pool=True):
+        pass
+
+
+def make_pipeline(make_config, storage, bot, **flow):
+    config = make_config(flow={'ack_journal_path': None, 'ack_max_posts': 4, 'pipeline_crawl_seconds': 0.05,
+                               **flow})
+    pipeline = Pipeline(config, storage=storage, bot=bot)
+    bot.storage, bot.acks = pipeline.writer, pipeline.acks
+    pipeline.writer.poll_seconds = pipeline.writer.retry_seconds = 0.01
+    return pipeline
+
+
+def run(pipeline, stop, timeout=10):
+    """
+    Runs the pipeline in a thread, failing the test if it hangs
+    :return: exception raised by run, None if none
+    """
+    raised = []
+
+    def target():
+        try:
+            pipeline.run(stop=stop)
+        except Exception as e:
+            raised.append(e)
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "Pipeline still running"
+    return raised[0] if raised else None
+
+
+def test_writes_are_queued_and_done_in_order():
+    storage = FakeStorage()
+    writer = StorageWriter(storage, poll_seconds=0.01)
+    writer.save_post_ids_to_match([['books', 'a', 0, 'comment']])
+    writer.update_timestamps({'books': 1})
+    writer.remove_post_ids_to_match(ids=['a'])
+    # Queued, not written by the caller
+    assert storage.calls == [] and writer.tasks.qsize() == 3
+    # Reads go to the storage
+    assert writer.get_posts_to_match('books') == []
+
+    stop = threading.Event()
+    stop.set()  # Everything queued is written before stopping
+    writer.run(stop)
+    assert storage.calls == [('save_post_ids_to_match', ([['books', 'a', 0, 'comment']],)),
+                             ('update_timestamps', ({'books': 1},)),
+                             ('remove_post_ids_to_match', (['a'],))]
+    assert writer.stats.items == 3 and writer.failure is None
+
+
+def test_write_retried():
+    storage = FakeStorage(failing=['update_timestamps'], times=2)
+    writer = StorageWriter(storage, max_attempts=3, poll_seconds=0.01, retry_seconds=0.01)
+    writer.update_timestamps({'books': 1})
+    writer.save_reply_logs([{'post_id': 'a'}])
+    stop = threading.Event()
+    stop.set()
+    writer.run(stop)
+    assert storage.names() == ['update_timestamps', 'save_reply_logs']
+    assert writer.failure is None
+
+
+def test_write_failure_stops_the_writer():
+    storage = FakeStorage(failing=['save_post_ids_to_match'])
+    writer = StorageWriter(storage, max_attempts=2, poll_seconds=0.01, retry_seconds=0.01)
+    writer.save_post_ids_to_match([['books', 'a', 0, 'comment']])
+    writer.update_timestamps({'books': 1})
+    stop = threading.Event()
+    thread = threading.Thread(target=writer.run, args=(stop,))
+    thread.start()
+    thread.join(5)
+    # Stopped without the writes after the failing one: the timestamp would skip the posts not saved
+    assert not thread.is_alive()
+    assert isinstance(writer.failure, ConnectionError)
+    assert storage.calls == []
+    assert writer.stats.errors == 1
+    with pytest.raises(RuntimeError, match='save_reply_logs not written'):
+        writer.save_reply_logs([{'post_id': 'a'}])
+
+
+def test_stage_stats():
+    stats = StageStats('match')
+    stats.started -= 10
+    stats.record(5, 2.0)
+    stats.record(15, 3.0)
+    stats.error()
+    result = stats.stats()
+    assert result['items'] == 20 and result['errors'] == 1
+    assert result['throughput'] == pytest.approx(2.0, rel=0.05)
+    assert result['busy'] == pytest.approx(0.5, rel=0.05)
+    assert stats.summary().startswith('match: 20 items (')
+
+
+def test_pipeline_drains_before_stopping(make_config):
+    storage = FakeStorage()
+    bot = FakeBot(per_crawl=5)
+    pipeline = make_pipeline(make_config, storage, bot)
+    assert run(pipeline, stop=lambda: bot.reader.crawled >= 20) is None
+
+    # All the posts crawled before the stop are replied to and acknowledged
+    crawled = [f"p{i}" for i in range(bot.reader.crawled)]
+    assert bot.replied == crawled
+    assert storage.queued == {}
+    replied_logs = [row['post_id'] for name, args in storage.calls if name == 'save_reply_logs' for row in args[0]]
+    assert replied_logs == crawled
+    # Each post saved to the queue before its logs, its logs before its removal
+    names = storage.names()
+    for post_id in crawled:
+        saved = next(i for i, (name, args) in enumerate(storage.calls)
+                     if name == 'save_post_ids_to_match' and post_id in [row[1] for row in args[0]])
+        logged = next(i for i, (name, args) in enumerate(storage.calls)
+                      if name == 'save_reply_logs' and post_id in [row['post_id'] for row in args[0]])
+        removed = next(i for i, (name, args) in enumerate(storage.calls)
+                       if name == 'remove_post_ids_to_match' and post_id in args[0])
+        assert saved < logged < removed
+    assert names[-1] == 'remove_post_ids_to_match'
+    assert pipeline.stats['match'].items == pipeline.stats['reply'].items == len(crawled)
+    assert pipeline.stats['crawl'].items == len(crawled)
+
+
+class FailingScheduler:
+
+    def __len__(self):
+        return 0
+
+    def run(self):
+        raise ValueError("scheduler broken")
+
+    def log_stats(self):
+        pass
+
+
+def test_failing_stage_stops_the_pipeline(make_config):
+    storage = FakeStorage()
+    # The reply stage dies on its first idle poll, with small queues the other stages would block on
+    bot = FakeBot(per_crawl=20, scheduler=FailingScheduler())
+    pipeline = make_pipeline(make_config, storage, bot, pipeline_queue_size=2)
+    error = run(pipeline, stop=None)
+    assert isinstance(error, RuntimeError) and 'reply' in str(error)
+    assert isinstance(error.__cause__, ValueError)
+    assert pipeline.stats['reply'].errors == 1
+    # The posts not replied to are left in the storage queue for the next run
+    assert set(storage.queued) == {f"p{i}" for i in range(bot.reader.crawled)} - set(bot.replied)
+
+
+def test_writer_failure_stops_the_pipeline(make_config):
+    storage = FakeStorage(failing=['update_timestamps'])
+    bot = FakeBot(per_crawl=5)
+    pipeline = make_pipeline(make_config, storage, bot)
+    pipeline.writer.max_attempts = 2
+    error = run(pipeline, stop=None)
+    assert isinstance(error, RuntimeError) and 'write' in str(error)
+    assert isinstance(error.__cause__, ConnectionError)
+    assert 'update_timestamps' not in storage.names()
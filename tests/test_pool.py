@@ -0,0 +1,67 @@
+"""
+Matching processes of a MatcherPool against the Matcher they were forked from, across catalog changes
+"""
+from grbot.pool import MatcherPool
+
+import pandas as pd
+import pytest
+
+
+@pytest.fixture
+def matcher(make_matcher):
+    return make_matcher(ngram_candidates=300)
+
+
+@pytest.fixture
+def pool(matcher):
+    pool = MatcherPool(matcher, processes=2)
+    yield pool
+    pool.close()
+
+
+def changed_books(catalog, rows):
+    """
+    Rows of dim_books changed since the load: the given row numbers renamed, and one new book
+    """
+    book_db = catalog['book_db']
+    books = book_db.iloc[rows].copy()
+    books['book_title'] = [f"Unwritten Chronicle {i}" for i in range(len(books))]
+    new = book_db.iloc[[0]].copy()
+    new['book_id'], new['book_title'], new['series_id'] = book_db['book_id'].max() + 1, 'Quiet Lighthouse Keeper', None
+    return pd.concat([books, new])
+
+
+def pool_matches(pool, posts):
+    results = list(pool.match_posts(posts))
+    assert not any(isinstance(result, Exception) for result in results), results
+    return [[(match.is_serie, match.book.id, match.raw_score) for match in matches] for matches, _ in results]
+
+
+def matcher_matches(matcher, posts, catalog=None):
+    with matcher.pinned(catalog):
+        return [[(match.is_serie, match.book.id, match.raw_score) for match in matcher.process_queries(post)]
+                for post in posts]
+
+
+POSTS = [['unwritten chronicle 1', 'quiet lighthouse keeper'], ['unwritten chronicle 2 by stephen king']]
+
+
+def test_changes_replayed_by_the_workers(matcher, pool, catalog):
+    workers = pool.pool
+    before = matcher_matches(matcher, POSTS)
+    assert pool_matches(pool, POSTS) == before
+    for rows in [[10, 11], [12, 2000]]:  # Stacked changes, applied by the workers in one go
+        matcher.swap(matcher.apply_changes(matcher.catalog, books=changed_books(catalog, rows)))
+    after = matcher_matches(matcher, POSTS)
+    assert after != before
+    assert pool_matches(pool, POSTS) == after
+    assert pool.pool is workers and not pool.restart_if_reloaded()  # Not forked again
+
+
+def test_full_reload_needs_a_restart(make_matcher, matcher, pool, catalog):
+    forked = matcher.catalog
+    matcher.swap(make_matcher(ngram_candidates=300).catalog)  # Loaded again
+    matcher.swap(matcher.apply_changes(matcher.catalog, books=changed_books(catalog, [10])))
+    assert pool_matches(pool, POSTS) == matcher_matches(matcher, POSTS, catalog=forked)
+    assert pool.restart_if_reloaded()
+    assert pool_matches(pool, POSTS) == matcher_matches(matcher, POSTS)
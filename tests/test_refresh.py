@@ -0,0 +1,203 @@
+"""
+Catalog changes applied without a full load (see Matcher.apply_changes and the delta indexes of index.py), against a
+Matcher built from scratch on the updated dim tables
+"""
+from grbot.index import AuthorIndex, AuthorIndexDelta, NgramIndex, NgramIndexDelta
+from grbot.matching import Matcher
+from tests.synthetic import SyntheticStorage
+
+import numpy as np
+import pandas as pd
+import pytest
+
+NEW_AUTHOR = 'Octavia Quillfeather'
+
+
+class RefreshingStorage(SyntheticStorage):
+    """
+    Dim tables with an `updated_at` watermark column, changed rows being published with push
+    """
+
+    def __init__(self, book_db, series_db):
+        super().__init__(book_db.assign(updated_at=0), series_db.assign(updated_at=0))
+
+    def push(self, books=None, series=None):
+        for name, rows, key in [('book_db', books, 'book_id'), ('series_db', series, 'series_id')]:
+            if rows is None:
+                continue
+            table = getattr(self, name)
+            rows = rows.assign(updated_at=table['updated_at'].max() + 1)
+            setattr(self, name, upsert(table, rows, key))
+
+    def download_book_db_changes(self, since, column):
+        return self.book_db[self.book_db[column] > since].copy()
+
+    def download_series_db_changes(self, since, column):
+        return self.series_db[self.series_db[column] > since].copy()
+
+
+def upsert(table, rows, key):
+    """
+    table with the rows of the same key replaced in place, the others appended
+    """
+    table = table.copy()
+    positions = pd.Series(np.arange(len(table)), index=table[key])
+    known = rows[key].isin(positions.index).to_numpy()
+    table.iloc[positions[rows[key][known]].to_numpy()] = rows[known][table.columns].to_numpy()
+    return pd.concat([table, rows[~known][table.columns]], ignore_index=True)
+
+
+def first_changes(book_db):
+    """
+    Titles renamed, books of Stephen King moved to a new author, and new books (least popular, so that they rank
+    last in the popularity order as they would in a full load)
+    """
+    renamed = book_db.iloc[[3, 500, 2001]].assign(book_title=['Saltwater Cartographer', 'Brass Orchard Requiem',
+                                                              'Velvet Semaphore'])
+    moved = book_db.iloc[[10, 12, 1500]].assign(author=NEW_AUTHOR)
+    new = book_db.iloc[[2999, 2999]].assign(
+        book_id=[10001, 10002], book_title=['Quiet Lighthouse Keeper', 'Harbor Of Paper Kites'],
+        author=['Mirela Vantongeren', NEW_AUTHOR], series_id=None, series_title=None, book_number=None,
+        ratings_count=0, sort_n=0)
+    return pd.concat([renamed, moved, new])
+
+
+def second_changes(book_db):
+    """
+    Stacked on first_changes: a renamed book renamed again, a new book renamed, one more new book
+    """
+    updated = upsert(book_db, first_changes(book_db), 'book_id').set_index('book_id', drop=False)
+    renamed = updated.loc[[book_db['book_id'][500], 10001]].assign(
+        book_title=['Lanterns Under Ice', 'Quiet Lighthouse Keeper Returns'])
+    new = updated.loc[[10002]].assign(book_id=10003, book_title='Moth Season Almanac')
+    return pd.concat([renamed, new]).reset_index(drop=True)
+
+
+def queries(book_db):
+    return [
+        'saltwater cartographer', 'velvet semaphore', 'lanterns under ice', 'brass orchard requiem',
+        'quiet lighthouse keeper returns', 'moth season almanac', 'harbor of paper kites',
+        f"harbor of paper kites by {NEW_AUTHOR.lower()}",
+        f"{book_db['book_title'][10].lower()} by {NEW_AUTHOR.lower()}",
+        f"{book_db['book_title'][1500].lower()} by octavia quillfeather",
+        f"{book_db['book_title'][12].lower()} by stephen king",
+        f"{book_db['book_title'][14].lower()} by stephen king",
+        book_db['book_title'][3].lower(), book_db['book_title'][7].lower(), book_db['book_title'][2500].lower(),
+    ]
+
+
+def best_matches(matcher, queries):
+    return [(bool(match.is_serie), match.book.id, match.raw_score, bool(match.title_was_shortened))
+            for match in matcher.process_queries(queries)]
+
+
+@pytest.fixture
+def storage(catalog):
+    return RefreshingStorage(catalog['book_db'], catalog['series_db'])
+
+
+@pytest.fixture
+def matcher_on(make_config, catalog):
+    """
+    :return: function of a storage and matching settings, returning a Matcher on it and its config
+    """
+    def make(storage, **matching):
+        config = make_config(matching={'ngram_candidates': 300, **matching},
+                             reco={'w2v_path': str(catalog['tmp_path'] / 'w2v.pkl')})
+        return Matcher(config, use_snapshot=False, storage=storage), config
+
+    return make
+
+
+@pytest.fixture
+def fresh_matcher(matcher_on):
+    """
+    :return: function of a storage, returning a Matcher loaded in full from its current dim tables
+    """
+    return lambda storage: matcher_on(SyntheticStorage(storage.book_db, storage.series_db))[0]
+
+
+def test_stacked_changes_match_like_a_full_load(matcher_on, fresh_matcher, catalog, storage):
+    matcher, _ = matcher_on(storage)
+    book_db = catalog['book_db']
+    for changes in [first_changes(book_db), second_changes(book_db)]:
+        storage.push(books=changes)
+        matcher.swap(matcher.apply_changes(matcher.catalog, books=changes))
+    assert isinstance(matcher.books_ngrams, NgramIndexDelta) and matcher.books_ngrams.base is not None
+    assert not isinstance(matcher.books_ngrams.base, NgramIndexDelta)  # Merged, not chained
+    assert len(matcher.catalog.changes) == 2
+
+    fresh = fresh_matcher(storage)
+    assert best_matches(matcher, queries(book_db)) == best_matches(fresh, queries(book_db))
+    # The renamed, moved and new books are the ones found, not the titles renamed since
+    found = [book_id for _, book_id, _, _ in best_matches(matcher, queries(book_db))]
+    assert found[:3] == book_db['book_id'][[3, 2001, 500]].tolist()
+    assert found[3] != book_db['book_id'][500]
+    assert found[4:8] == [10001, 10003, 10002, 10002]
+    assert found[8:10] == book_db['book_id'][[10, 1500]].tolist()
+
+
+def test_series_changes_match_like_a_full_load(matcher_on, fresh_matcher, catalog, storage):
+    matcher, _ = matcher_on(storage)
+    series_db = catalog['series_db']
+    changes = pd.concat([
+        series_db.iloc[[5]].assign(series_title='Chronicles Of The Drowned Bell'),
+        series_db.iloc[[6]].assign(series_id=99999, series_title='Ember Cartographers', author=NEW_AUTHOR)
+    ])
+    books = catalog['book_db'][catalog['book_db']['series_id'] == series_db['series_id'][6]].iloc[[0]].assign(
+        book_id=10001, series_id=99999, book_number='1', ratings_count=0, sort_n=0)
+    storage.push(books=books, series=changes)
+    matcher.swap(matcher.apply_changes(matcher.catalog, books=books, series=changes))
+
+    posts = ['chronicles of the drowned bell series', 'ember cartographers series',
+             f"ember cartographers by {NEW_AUTHOR.lower()}", series_db['series_title'][7].lower()]
+    assert best_matches(matcher, posts) == best_matches(fresh_matcher(storage), posts)
+    assert best_matches(matcher, posts[1:2])[0][:2] == (True, 99999)
+
+
+def test_refresh_catalog_picks_up_the_changes(matcher_on, fresh_matcher, catalog, storage):
+    matcher, config = matcher_on(storage, catalog_watermark_column='updated_at')
+    assert matcher.watermarks == {'books': 0, 'series': 0}
+    assert not matcher.refresh_catalog(config)  # Nothing changed yet
+
+    book_db = catalog['book_db']
+    for changes in [first_changes(book_db), second_changes(book_db)]:
+        version = matcher.catalog_version
+        storage.push(books=changes)
+        assert matcher.refresh_catalog(config)
+        assert matcher.catalog_version > version
+    assert matcher.watermarks['books'] == 2
+    assert not matcher.refresh_catalog(config)
+    assert best_matches(matcher, queries(book_db)) == best_matches(fresh_matcher(storage), queries(book_db))
+
+
+def test_ngram_delta_scores_like_a_new_index():
+    strings = ['the hobbit', 'dune', 'the name of the wind', 'mistborn', 'piranesi']
+    changes = [{1: 'dune messiah', 5: 'the left hand of darkness'}, {5: 'the dispossessed', 6: 'kindred'}]
+    delta, updated = NgramIndex(strings), list(strings)
+    for strings_changed in changes:
+        delta = NgramIndexDelta(delta, strings_changed)
+        for position, s in strings_changed.items():
+            updated[position:position + 1] = [s]
+    assert updated == ['the hobbit', 'dune messiah', 'the name of the wind', 'mistborn', 'piranesi',
+                       'the dispossessed', 'kindred']
+    index = NgramIndex(updated)
+    assert len(delta) == len(index)
+    for s in ['dune', 'the dispossessed', 'left hand of darkness', 'kindred', 'hobbit', 'zzz']:
+        np.testing.assert_allclose(delta.similarity(s), index.similarity(s))
+        assert list(delta.shortlist(s, 3)) == list(index.shortlist(s, 3))
+
+
+def test_author_delta_finds_the_books_of_the_new_authors():
+    authors = ['stephen king', 'stephen king', 'ursula le guin', 'stephen king', 'terry pratchett']
+    # Books 0 and 3 moved out of "stephen king", book 5 added, then book 3 moved again
+    changes = [{0: 'octavia butler', 3: 'octavia butler', 5: 'stephen king'}, {3: 'neil gaiman'}]
+    delta, updated = AuthorIndex(authors), list(authors)
+    for authors_changed in changes:
+        delta = AuthorIndexDelta(delta, authors_changed)
+        for position, author in authors_changed.items():
+            updated[position:position + 1] = [author]
+    index = AuthorIndex(updated)
+    for author in ['stephen king', 'octavia butler', 'neil gaiman', 'ursula le guin', 'king']:
+        assert sorted(delta.closest(author)) == sorted(index.closest(author)), author
+    assert sorted(delta.closest('stephen king')) == [1, 5]
@@ -0,0 +1,166 @@
+from grbot import ratelimit
+from grbot.bot import Bot
+from grbot.ratelimit import RateLimit
+from grbot.storage import MIN_POST_TIMESTAMP
+from grbot.scheduler import ReplyScheduler, rate_limit_delay
+
+from types import SimpleNamespace
+import praw
+import prawcore
+import pytest
+
+
+class FakePost:
+    """
+    Post replied to with the outcomes given, in turn: an exception raised, or the id of the reply
+    """
+
+    def __init__(self, post_id, subreddit, created_utc, outcomes=('reply',)):
+        self.id = post_id
+        self.subreddit = SimpleNamespace(display_name=subreddit)
+        self.created_utc = created_utc
+        self.outcomes = list(outcomes)
+        self.attempts = 0
+
+    def reply(self, text):
+        self.attempts += 1
+        outcome = self.outcomes.pop(0) if len(self.outcomes) > 1 else self.outcomes[0]
+        if isinstance(outcome, Exception):
+            raise outcome
+        return SimpleNamespace(id=f"{outcome}_{self.id}")
+
+
+def rate_limit(remaining=100):
+    limit = RateLimit()
+    limit.observe({'X-Ratelimit-Remaining': remaining, 'X-Ratelimit-Reset': 600})
+    return limit
+
+
+def comment_rate_limit_error(message="Take a break for 3 minutes before trying again."):
+    return praw.exceptions.RedditAPIException([['RATELIMIT', message, 'ratelimit']])
+
+
+def too_many_requests(retry_after='5'):
+    return prawcore.exceptions.TooManyRequests(
+        SimpleNamespace(status_code=429, headers={'retry-after': retry_after}, text=''))
+
+
+def server_unreachable():
+    return prawcore.exceptions.RequestException(ConnectionError('unreachable'), (), {})
+
+
+@pytest.fixture
+def done():
+    return []
+
+
+def scheduler_for(done, remaining=100, **kwargs):
+    return ReplyScheduler(rate_limit(remaining), on_done=lambda post, post_type, reply, formatters: done.append(
+        (post.id, None if reply is None else reply.id)), **kwargs)
+
+
+def test_rate_limit_delay():
+    assert rate_limit_delay(comment_rate_limit_error()) == 180
+    assert rate_limit_delay(comment_rate_limit_error("Take a break for 30 seconds")) == 30
+    assert rate_limit_delay(comment_rate_limit_error("Slow down")) == 0
+    assert rate_limit_delay(too_many_requests()) == 5
+    assert rate_limit_delay(server_unreachable()) is None
+
+
+def test_oldest_first_taking_turns_between_subreddits(done):
+    scheduler = scheduler_for(done)
+    for post in [FakePost('a2', 'books', 2), FakePost('a1', 'books', 1), FakePost('a3', 'books', 3),
+                 FakePost('b1', 'fantasy', 4)]:
+        assert scheduler.submit(post, 'comment', 'text', None)
+    assert scheduler.run() == 4
+    assert done == [('a1', 'reply_a1'), ('b1', 'reply_b1'), ('a2', 'reply_a2'), ('a3', 'reply_a3')]
+    assert len(scheduler) == 0
+
+
+def test_duplicates_skipped(done):
+    scheduler = scheduler_for(done)
+    post = FakePost('a1', 'books', 1)
+    assert scheduler.submit(post, 'comment', 'text', None)
+    assert not scheduler.submit(post, 'comment', 'text', None)  # Pending
+    scheduler.run()
+    assert not scheduler.submit(post, 'comment', 'text', None)  # Done, until acknowledged
+    assert post.attempts == 1 and done == [('a1', 'reply_a1')]
+
+
+def test_budget_left_to_the_crawl(done):
+    scheduler = scheduler_for(done, remaining=5, reserve=10)
+    scheduler.submit(FakePost('a1', 'books', 1), 'comment', 'text', None)
+    assert scheduler.run() == 0
+    assert len(scheduler) == 1 and done == []
+
+
+def test_comment_rate_limit_defers_all_replies(done):
+    scheduler = scheduler_for(done)
+    refused = FakePost('a1', 'books', 1, outcomes=[comment_rate_limit_error(), 'reply'])
+    scheduler.submit(refused, 'comment', 'text', None)
+    scheduler.submit(FakePost('b1', 'fantasy', 2), 'comment', 'text', None)
+    assert scheduler.run() == 0
+    assert done == [] and len(scheduler) == 2 and scheduler.stats['deferred'] == 1
+    scheduler.paused_until = 0  # 3 minutes later
+    assert scheduler.run() == 2
+    assert done == [('a1', 'reply_a1'), ('b1', 'reply_b1')]
+
+
+def test_too_many_requests_spends_the_budget(done):
+    scheduler = scheduler_for(done)
+    scheduler.submit(FakePost('a1', 'books', 1, outcomes=[too_many_requests(), 'reply']), 'comment', 'text', None)
+    assert scheduler.run() == 0
+    assert scheduler.rate_limit.available() == 0 and len(scheduler) == 1 and done == []
+
+
+def test_transient_errors_retried_then_given_up(done):
+    scheduler = scheduler_for(done, max_attempts=3, retry_seconds=0)
+    post = FakePost('a1', 'books', 1, outcomes=[server_unreachable()])
+    scheduler.submit(post, 'comment', 'text', None)
+    for _ in range(3):
+        scheduler.run()
+    assert post.attempts == 3 and done == [('a1', None)]
+    assert scheduler.stats == {'posted': 0, 'deferred': 2, 'failed': 1}
+
+
+def test_replies_sent_through_send(done):
+    sent = []
+    scheduler = scheduler_for(done, send=lambda post, post_type, text: sent.append((post.id, post_type, text)) or
+                              SimpleNamespace(id='sent'))
+    scheduler.submit(FakePost('a1', 'books', 1), 'comment', 'text', None)
+    scheduler.run()
+    assert sent == [('a1', 'comment', 'text')] and done == [('a1', 'sent')]
+
+
+def test_deferred_reply_not_matched_again(make_config, tmp_path, monkeypatch):
+    monkeypatch.setattr(ratelimit, 'accounts', {})
+    config = make_config(
+        flow={'run_reader': False, 'run_matcher': False, 'run_poster': True, 'mode': 'sqlite',
+              'sqlite_path': str(tmp_path / 'grbot.sqlite'), 'ack_journal_path': None},
+        reddit={'subreddits': ['books', 'fantasy'], 'reply_scheduler': True, 'reply_retry_seconds': 600})
+    bot = Bot(config)
+    t = MIN_POST_TIMESTAMP + 1000
+    posts = {'a1': FakePost('a1', 'books', t + 1, outcomes=[server_unreachable(), 'reply']),
+             'a2': FakePost('a2', 'books', t + 2), 'b1': FakePost('b1', 'fantasy', t + 3),
+             'b2': FakePost('b2', 'fantasy', t + 4)}
+    bot.storage.save_post_ids_to_match([[post.subreddit.display_name, post.id, post.created_utc, 'comment']
+                                        for post in posts.values()])
+    bot.reddit = SimpleNamespace(comment=lambda id: posts[id])
+    bot.poster.scheduler.send = lambda post, post_type, text: post.reply(text)
+    matched = []
+    bot.books_requested = lambda post, post_type: ['dune']
+    bot.match_posts = lambda books_requested_by_post, post_ids: matched.append(post_ids) or [[]] * len(post_ids)
+    bot.reply = lambda post, post_type, books_requested, matched: bot.poster.send_reply(post, post_type, 'text', None)
+
+    bot.match_and_reply_one_by_sub()
+    assert matched == [['a1', 'b1']] and bot.poster.pending_ids() == {'a1'}
+    # a1 is still queued, waiting for its retry: a2 takes the turn of books
+    bot.match_and_reply_one_by_sub()
+    assert matched[1] == ['a2', 'b2'] and posts['a1'].attempts == 1
+
+    for jobs in bot.poster.scheduler.pending.values():
+        for job in jobs:
+            job.not_before = 0  # 10 minutes later
+    bot.match_and_reply_one_by_sub()
+    assert matched[2] == [] and posts['a1'].attempts == 2 and bot.poster.pending_ids() == set()
+    assert bot.storage.get_posts_to_match(['books', 'fantasy'], batch_size=10) == []
@@ -0,0 +1,94 @@
+from grbot import snapshot
+from grbot.matching import Matcher
+from tests.synthetic import SyntheticStorage, make_queries
+
+import numpy as np
+import os
+import pytest
+
+
+def corrupt(file_path):
+    """
+    Flips the last byte of a file, leaving its size (and .npy header) as is
+    """
+    with open(file_path, 'r+b') as handle:
+        handle.seek(-1, os.SEEK_END)
+        last = handle.read(1)
+        handle.seek(-1, os.SEEK_END)
+        handle.write(bytes([last[0] ^ 0xFF]))
+
+
+@pytest.fixture
+def arrays():
+    return {'index': {'offsets': np.arange(10, dtype=np.int64), 'sizes': np.ones(4, dtype=np.int32)},
+            'vectors': np.linspace(0, 1, 12, dtype=np.float32).reshape(3, 4), 'empty': np.zeros(0)}
+
+
+def test_round_trip(tmp_path, arrays):
+    path = str(tmp_path / 'snapshot')
+    snapshot.save(path, arrays, meta={'catalog_version': 7})
+    meta, loaded = snapshot.load(path, verify_checksums=True)
+    assert meta == {'catalog_version': 7}
+    assert sorted(loaded) == ['empty', 'index', 'vectors']
+    np.testing.assert_array_equal(loaded['index']['offsets'], arrays['index']['offsets'])
+    np.testing.assert_array_equal(loaded['vectors'], arrays['vectors'])
+    assert snapshot.verify(path) == []
+
+
+def test_corrupted_file_fails_verify_and_load(tmp_path, arrays):
+    path = str(tmp_path / 'snapshot')
+    snapshot.save(path, arrays)
+    corrupt(os.path.join(path, 'index.sizes.npy'))
+    assert snapshot.verify(path) == ['index.sizes']
+    with pytest.raises(ValueError, match='index.sizes'):
+        snapshot.load(path, verify_checksums=True)
+    snapshot.load(path)  # Not checked by default
+
+    os.remove(os.path.join(path, 'vectors.npy'))
+    assert snapshot.verify(path) == ['index.sizes', 'vectors']
+
+
+def test_saved_again_in_place(tmp_path, arrays):
+    path = str(tmp_path / 'snapshot')
+    snapshot.save(path, arrays, meta={'catalog_version': 1})
+    _, mapped = snapshot.load(path)
+    snapshot.save(path, {**arrays, 'vectors': arrays['vectors'] * 2}, meta={'catalog_version': 2})
+    # The arrays mapped before keep their data
+    np.testing.assert_array_equal(mapped['vectors'], arrays['vectors'])
+    assert snapshot.load(path)[0] == {'catalog_version': 2}
+    assert not os.path.exists(path + '.tmp') and not os.path.exists(path + '.old')
+
+
+@pytest.fixture
+def snapshot_config(make_config, catalog, tmp_path):
+    return make_config(matching={'ngram_candidates': 300, 'snapshot_path': str(tmp_path / 'snapshot')},
+                       reco={'w2v_path': str(catalog['tmp_path'] / 'w2v.pkl'), 'precomputed_neighbours': 5})
+
+
+def results(matcher, queries):
+    matches = matcher.process_queries(queries)
+    return [(bool(match.is_serie), match.book.id, match.raw_score, bool(match.title_was_shortened))
+            for match in matches], matcher.recommend_ids(matches, 5)
+
+
+def test_matcher_round_trip(catalog, snapshot_config):
+    built = Matcher(snapshot_config, use_snapshot=False,
+                    storage=SyntheticStorage(catalog['book_db'], catalog['series_db']))
+    built.save_snapshot(snapshot_config['matching']['snapshot_path'], meta={'source': 'tests'})
+    loaded = Matcher(snapshot_config)
+    assert loaded.catalog.base_version == loaded.catalog_version == built.catalog_version
+
+    queries = [query for kind_queries in make_queries(catalog['book_db'], catalog['series_db'], 10).values()
+               for query in kind_queries]
+    assert results(loaded, queries) == results(built, queries)
+    assert loaded.retrieve_infos([1, 2, 3]) == built.retrieve_infos([1, 2, 3])
+
+
+def test_corrupted_snapshot_not_opened(catalog, snapshot_config):
+    path = snapshot_config['matching']['snapshot_path']
+    Matcher(snapshot_config, use_snapshot=False,
+            storage=SyntheticStorage(catalog['book_db'], catalog['series_db'])).save_snapshot(path)
+    corrupt(os.path.join(path, 'embeddings.vectors.npy'))
+    snapshot_config['matching']['snapshot_verify'] = True
+    with pytest.raises(ValueError, match='embeddings.vectors'):
+        Matcher(snapshot_config)
@@ -0,0 +1,103 @@
+from grbot.storage import SQLiteStorage, MIN_POST_TIMESTAMP, from_config
+
+import pickle
+import pandas as pd
+import pytest
+
+T = MIN_POST_TIMESTAMP + 1000
+
+
+@pytest.fixture
+def storage(make_config, tmp_path):
+    config = make_config(flow={'mode': 'sqlite', 'sqlite_path': str(tmp_path / 'grbot.sqlite')})
+    return from_config(config)
+
+
+def reply_log(post_id, post_type='comment'):
+    return {'subreddit': 'books', 'post_id': post_id, 'post_type': post_type, 'reply_id': f"r_{post_id}",
+            'master_grlink': None, 'score': 90.0, 'author': 'reader'}
+
+
+def test_from_config(storage):
+    assert isinstance(storage, SQLiteStorage)
+    assert storage.tables['table_to_match'] == 'ids_to_match'
+
+
+def test_queue_oldest_post_of_each_subreddit(storage):
+    storage.save_post_ids_to_match([
+        ['books', 'a2', T + 2, 'comment'], ['books', 'a1', T + 1, 'comment'], ['fantasy', 'b1', T + 3, 'comment'],
+        ['fantasy', 'b1', T + 3, 'comment']])  # Saved twice by the crawl
+    assert storage.get_posts_to_match(['books', 'fantasy']) == [['books', 'a1', 'comment'],
+                                                                ['fantasy', 'b1', 'comment']]
+    assert storage.get_posts_to_match(['fantasy']) == [['fantasy', 'b1', 'comment']]
+
+
+def test_queue_batches_oldest_first_across_subreddits(storage):
+    storage.save_post_ids_to_match([
+        ['books', 'a1', T + 1, 'comment'], ['fantasy', 'b1', T + 2, 'comment'], ['books', 'a2', T + 3, 'comment'],
+        ['books', 's1', T, 'submission'],  # Submissions are not answered yet
+        ['books', 'old', MIN_POST_TIMESTAMP - 1, 'comment']])
+    assert storage.get_posts_to_match(['books', 'fantasy'], batch_size=2) == [['books', 'a1', 'comment'],
+                                                                              ['fantasy', 'b1', 'comment']]
+    assert len(storage.get_posts_to_match(['books', 'fantasy'], batch_size=10)) == 3
+
+
+def test_queue_skips_replied_and_removed_posts(storage):
+    storage.save_post_ids_to_match([
+        ['books', 'a1', T + 1, 'comment'], ['books', 'a2', T + 2, 'comment'], ['books', 'a3', T + 3, 'comment']])
+    storage.save_reply_logs([reply_log('a1')])
+    assert storage.get_posts_to_match(['books'], batch_size=10) == [['books', 'a2', 'comment'],
+                                                                    ['books', 'a3', 'comment']]
+    storage.remove_post_ids_to_match(['a2', 'a3'])
+    storage.remove_post_ids_to_match(['a3'])  # Removing twice is harmless (see AckBuffer.flush)
+    assert storage.get_posts_to_match(['books'], batch_size=10) == []
+
+
+def test_queue_leaves_out_the_excluded_posts(storage):
+    storage.save_post_ids_to_match([
+        ['books', 'a1', T + 1, 'comment'], ['books', 'a2', T + 2, 'comment'], ['fantasy', 'b1', T + 3, 'comment']])
+    # The next post of the subreddit takes the turn of the one left out
+    assert storage.get_posts_to_match(['books', 'fantasy'], exclude={'a1'}) == [['books', 'a2', 'comment'],
+                                                                               ['fantasy', 'b1', 'comment']]
+    assert storage.get_posts_to_match(['books', 'fantasy'], batch_size=2, exclude=['a1', 'b1']) == [
+        ['books', 'a2', 'comment']]
+    assert storage.get_posts_to_match(['books'], exclude=['a1', 'a2']) == []
+
+
+def test_logs(storage):
+    storage.save_reply_logs([reply_log('a1'), reply_log('a2')])
+    storage.add_logs_in_error_table([{'subreddit': 'books', 'post_id': 'a3', 'post_type': 'comment',
+                                      'post_content': '{{dune}}', 'author': 'reader', 'error': 'ValueError',
+                                      'logged_at': T}])  # Not a column (see error_log_row)
+    assert storage.sql_to_df("SELECT post_id FROM ids_matched")['post_id'].tolist() == ['a1', 'a2']
+    assert storage.sql_to_df("SELECT post_id, error FROM error_logs").values.tolist() == [['a3', 'ValueError']]
+
+
+def test_crawl_timestamps(storage):
+    assert storage.get_last_timestamps(['books']) == {'books': 0}
+    storage.update_timestamps(pd.DataFrame({'subreddit': ['books', 'fantasy'], 'crawl_timestamp': [T, T + 1]}))
+    storage.update_timestamps(pd.DataFrame({'subreddit': ['books'], 'crawl_timestamp': [T + 2]}))
+    assert storage.get_last_timestamps(['books', 'fantasy']) == {'books': T + 2, 'fantasy': T + 1}
+
+
+def test_dim_tables(storage, tmp_path):
+    books = pd.DataFrame({
+        'book_id': [1, 2, 3], 'short_title': ['Dune', 'Dune Messiah', 'Emma'],
+        'first_author': ['Frank Herbert', 'Frank Herbert', 'Jane Austen'], 'series_id': [10, 10, None],
+        'book_number': ['2', '1', None], 'tag_list': [['sf'], ['sf', 'classic'], ['classic']],
+        'updated_at': [1, 2, 3]})
+    local_path = str(tmp_path / 'dim_books.pkl')
+    with open(local_path, 'wb') as handle:
+        pickle.dump(books, handle)
+    # Imported from the pickle on first load, then read from the database
+    imported = storage.download_book_db(local_path=local_path)
+    assert imported['book_title'].tolist() == ['Dune', 'Dune Messiah', 'Emma']
+    book_db = storage.download_book_db()
+    assert book_db['author'].tolist() == ['Frank Herbert', 'Frank Herbert', 'Jane Austen']
+    assert book_db['book_number'].tolist()[:2] == ['2', '1']
+    assert book_db['tag_list'].tolist() == [['sf'], ['sf', 'classic'], ['classic']]
+
+    assert storage.download_book_db_changes(1, 'updated_at')['book_id'].tolist() == [2, 3]
+    assert storage.get_info([3, 1])[1]['tag_list'] == ['sf']
+    assert storage.book_ids_from_series_ids([10]) == {10: 2}
+    assert storage.book_id_from_series_id([10]) == 2
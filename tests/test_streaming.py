@@ -0,0 +1,188 @@
+"""
+Streaming mode (see Reader.stream_posts and Bot.run_streaming) on a fake praw client whose streams, as praw's, replay
+the latest posts each time they start
+"""
+from grbot.bot import Bot, Reader
+from grbot.crawler import ListingPost
+
+from types import SimpleNamespace
+import pytest
+
+START_UTC = 1_700_000_000
+
+
+class FakePrawReddit:
+    """
+    praw client of subreddits on which posts are published with publish. Their streams first yield the `replay`
+    latest posts, then the new ones as they come, None when there is nothing new (pause_after=0). A stream raises
+    ConnectionError once `fail_after` posts were yielded, if set.
+    """
+
+    def __init__(self, replay=100):
+        self.replay = replay
+        self.posts = {'comment': [], 'submission': []}
+        self.fail_after = None
+        self.yielded = 0
+
+    def publish(self, sub, n, triggers=True):
+        """
+        n new comments and n new submissions on sub, one second apart
+        :return: the new posts
+        """
+        published = []
+        for post_type, kind in [('comment', 't1'), ('submission', 't3')]:
+            posts = self.posts[post_type]
+            for i in range(n):
+                data = {'id': f"{sub}_{post_type}{len(posts)}", 'subreddit': sub, 'author': 'reader',
+                        'created_utc': float(START_UTC + len(posts)),
+                        'body' if kind == 't1' else 'selftext': "Looking for {{dune}}" if triggers else "Any advice?"}
+                posts.append(ListingPost(kind, data))
+                published.append(posts[-1])
+        return published
+
+    def subreddit(self, name):
+        return SimpleNamespace(display_name=name, stream=SimpleNamespace(
+            comments=lambda pause_after: self.stream('comment', name),
+            submissions=lambda pause_after: self.stream('submission', name)))
+
+    def stream(self, post_type, name):
+        subs = name.split('+')
+        posts = self.posts[post_type]
+        position = max(0, len(posts) - self.replay)
+        while True:
+            if position == len(posts):
+                yield None
+                continue
+            if self.fail_after is not None and self.yielded >= self.fail_after:
+                self.fail_after = None
+                raise ConnectionError("Stream closed")
+            post = posts[position]
+            position += 1
+            if post.subreddit.display_name in subs:
+                self.yielded += 1
+                yield post
+
+
+class FakeStorage:
+
+    def __init__(self):
+        self.saved = []
+
+    def save_post_ids_to_match(self, rows):
+        self.saved += [row[1] for row in rows]
+
+
+@pytest.fixture
+def config(make_config, tmp_path):
+    return make_config(
+        flow={'run_reader': True, 'run_matcher': False, 'run_poster': False, 'ack_journal_path': None},
+        reddit={'subreddits': ['books', 'fantasy'], 'excluded_authors': [], 'checkpoint_backend': 'file',
+                'checkpoint_path': str(tmp_path / 'crawl_dates.json'), 'stream_checkpoint_seconds': 3600,
+                'stream_pause_seconds': 0})
+
+
+def rounds(n):
+    """
+    :return: stop function of stream_posts, stopping after n rounds over the streams
+    """
+    calls = []
+
+    def stop():
+        calls.append(1)
+        return len(calls) > n
+
+    return stop
+
+
+def ids(posts):
+    return [post.id for post in posts]
+
+
+def test_posts_before_the_checkpoint_skipped(config):
+    reddit, storage = FakePrawReddit(), FakeStorage()
+    old = reddit.publish('books', 5) + reddit.publish('fantasy', 5)
+    reader = Reader(config, reddit=reddit, storage=storage)
+    reader.checkpoints.update({'books': max(post.created_utc for post in old)})
+    reader.refresh_crawl_timestamp()
+    new = reddit.publish('books', 3) + reddit.publish('fantasy', 2, triggers=False)
+
+    streamed = []
+    reader.stream_posts(on_post=lambda post, post_type: streamed.append(post), stop=rounds(1))
+    # The posts of books replayed by the streams are older than its checkpoint, fantasy was never crawled
+    expected = [post for post in old + new if post.subreddit.display_name == 'fantasy' or post in new]
+    triggering = [post for post in expected if 'dune' in getattr(post, 'body', getattr(post, 'selftext', ''))]
+    assert sorted(ids(streamed)) == sorted(ids(triggering))
+    assert sorted(storage.saved) == sorted(ids(triggering))
+    # Flushed once streaming stops
+    assert reader.checkpoints.timestamps(['books', 'fantasy']) == {
+        sub: max(post.created_utc for post in expected if post.subreddit.display_name == sub)
+        for sub in ['books', 'fantasy']}
+
+
+def test_restarted_streams_skip_the_replayed_posts(config):
+    reddit, storage = FakePrawReddit(replay=100), FakeStorage()
+    reader = Reader(config, reddit=reddit, storage=storage)
+    first = reddit.publish('books', 4)
+    streamed = []
+    on_post = lambda post, post_type: streamed.append(post.id)
+
+    reddit.fail_after = 3  # The stream fails mid-way
+    with pytest.raises(ConnectionError):
+        reader.stream_posts(on_post=on_post)
+    assert len(streamed) == 3
+    # Not flushed: the submissions, not streamed yet, are older than the comments streamed
+    assert reader.last_timestamps['books'] == 0
+
+    second = reddit.publish('books', 2)
+    reader.stream_posts(on_post=on_post, stop=rounds(2))  # Started again, replaying all the posts
+    assert sorted(streamed) == sorted(ids(first + second))
+    assert sorted(storage.saved) == sorted(streamed)
+
+    # New process: the ids seen are forgotten, the checkpoint skips the replayed posts
+    reader = Reader(config, reddit=reddit, storage=storage)
+    third = reddit.publish('books', 1)
+    reader.stream_posts(on_post=on_post, stop=rounds(1))
+    assert sorted(streamed) == sorted(ids(first + second + third))
+
+
+def test_failed_save_streamed_again(config):
+    reddit = FakePrawReddit()
+
+    class FailingStorage(FakeStorage):
+        failed = False
+
+        def save_post_ids_to_match(self, rows):
+            if not self.failed and rows[0][1] == 'books_comment1':
+                self.failed = True
+                raise ConnectionError("Storage unavailable")
+            super().save_post_ids_to_match(rows)
+
+    storage = FailingStorage()
+    reader = Reader(config, reddit=reddit, storage=storage)
+    published = reddit.publish('books', 3)
+    with pytest.raises(ConnectionError):
+        reader.stream_posts(stop=rounds(1))
+    assert storage.saved == ['books_comment0']
+    reader.stream_posts(stop=rounds(1))  # Replayed: saved this time
+    assert sorted(storage.saved) == sorted(ids(published))
+
+
+def test_run_streaming_replies_once_across_restarts(config):
+    config['flow']['run_poster'] = True
+    reddit, storage = FakePrawReddit(), FakeStorage()
+    bot = Bot(config, storage=storage)
+    bot.reader = Reader(config, reddit=reddit, storage=storage)
+    flushes, replied = [], []
+    bot.poster = SimpleNamespace(flush=lambda: flushes.append(1))
+    bot.match_and_reply_post = lambda post, post_type: replied.append(post.id)
+
+    published = reddit.publish('books', 3) + reddit.publish('fantasy', 3)
+    reddit.fail_after = 4
+    with pytest.raises(ConnectionError):
+        bot.run_streaming()
+    assert len(replied) == 4 and flushes == [1]  # Acknowledgements flushed despite the failure
+
+    published += reddit.publish('fantasy', 1)
+    bot.run_streaming(stop=rounds(2))
+    assert sorted(replied) == sorted(ids(published))
+    assert flushes == [1, 1]